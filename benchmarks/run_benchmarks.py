@@ -0,0 +1,350 @@
+import argparse
+import contextlib
+import copy
+import io
+import json
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from initiator.core import build_individual_houses_map, build_house_individual_map, build_individual_adult_map, \
+    build_individual_age_map, build_house_adult_map, build_individual_work_map, build_workplace_individual_map, \
+    build_geo_positions_house, build_geo_positions_store, build_geo_positions_workplace, build_block_assignment, \
+    build_house_store_map, build_store_house_map, build_individual_workblock_map, build_workblock_individual_map, \
+    build_individual_individual_transport_map, build_individual_houses_array, build_individual_adult_array, \
+    build_individual_age_array, build_individual_work_array, build_house_individual_csr, build_house_adult_csr, \
+    build_workplace_individual_csr, build_geo_positions_house_array, build_geo_positions_store_array, \
+    build_geo_positions_workplace_array, build_block_assignment_array, build_house_store_array, \
+    build_store_house_csr, build_individual_workblock_routes_csr, build_workblock_individual_csr, \
+    build_individual_workblock_csr, build_individual_rate_array
+from initiator.helper import covid_hospitalization_rate_table
+from simulator import run
+from simulator.dynamic_helper import propagate_to_houses, propagate_to_transportation, propagate_to_workplaces, \
+    propagate_to_stores, increment_pandemic_1_day
+from simulator.parameters import *
+from simulator.random_helper import get_seed_sequence, get_random_stream
+from simulator.simulation_helper import get_environment_simulation, get_environment_simulation_arrays, \
+    get_virus_simulation_t0, get_virus_state_t0
+from simulator.sparse_helper import get_sparse_environment
+
+# Version of the layout of the results file
+BENCHMARK_FORMAT_VERSION = 1
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+# The dictionary engine builds an individual x individual transport map, quadratic in the commuters per block
+DEFAULT_MAX_DICT_SIZE = 10000
+DEFAULT_SEED = 42
+DEFAULT_REPEAT = 3
+DEFAULT_NDAY = 30
+# Days simulated before timing the propagation steps, so that they run on a spreading pandemic
+WARMUP_DAYS = 10
+# A benchmark is a regression when it gets this much slower (or hungrier) than in the baseline
+DEFAULT_REGRESSION_THRESHOLD = 1.2
+
+ARRAY_ENGINE = 'array'
+SPARSE_ENGINE = 'sparse'
+DICT_ENGINE = 'dict'
+
+
+def measure(fn, setup_fn, repeat_arg=DEFAULT_REPEAT):
+    # Best wall time of repeat_arg calls of fn(*setup_fn()), then peak memory allocated by one more traced call
+    # The setup is neither timed nor traced, it hands fresh inputs (e.g. random streams) to each call
+    seconds = []
+    for _ in range(repeat_arg):
+        args = setup_fn()
+        start = time.perf_counter()
+        fn(*args)
+        seconds.append(time.perf_counter() - start)
+    args = setup_fn()
+    tracemalloc.start()
+    try:
+        fn(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(seconds), peak
+
+
+def get_array_builder_benchmarks(n_arg, seed_arg):
+    # (fn, setup) of the array builders, each one fed with the outputs of the previous steps
+    def get_rng():
+        return get_random_stream(get_seed_sequence(seed_arg), 0)
+
+    rng = get_rng()
+    indiv_house = build_individual_houses_array(n_arg, params[same_house_p_key], rng)
+    indiv_adult = build_individual_adult_array(indiv_house)
+    indiv_age = build_individual_age_array(indiv_adult, rng)
+    indiv_workplace = build_individual_work_array(indiv_adult, params[remote_work_key], rng)
+    number_house = int(indiv_house.max()) + 1
+    number_workplace = int(indiv_workplace.max()) + 1
+    number_store = int(number_house / params[store_per_house_key])
+    geo_house = build_geo_positions_house_array(number_house, rng)
+    geo_workplace = build_geo_positions_workplace_array(number_workplace, rng)
+    geo_store = build_geo_positions_store_array(number_store, rng)
+    house_store = build_house_store_array(geo_store, geo_house, params[store_preference_key], rng)
+    house_block = build_block_assignment_array(geo_house, params[nb_block_key])
+    workplace_block = build_block_assignment_array(geo_workplace, params[nb_block_key])
+    indiv_transport_block = build_individual_workblock_routes_csr(indiv_house, indiv_workplace, house_block,
+                                                                  workplace_block, params[nb_block_key])
+    return [
+        (build_individual_houses_array, lambda: (n_arg, params[same_house_p_key], get_rng())),
+        (build_individual_adult_array, lambda: (indiv_house,)),
+        (build_individual_age_array, lambda: (indiv_adult, get_rng())),
+        (build_individual_work_array, lambda: (indiv_adult, params[remote_work_key], get_rng())),
+        (build_house_individual_csr, lambda: (indiv_house, number_house)),
+        (build_house_adult_csr, lambda: (indiv_house, indiv_adult, number_house)),
+        (build_workplace_individual_csr, lambda: (indiv_workplace, number_workplace)),
+        (build_geo_positions_house_array, lambda: (number_house, get_rng())),
+        (build_geo_positions_workplace_array, lambda: (number_workplace, get_rng())),
+        (build_geo_positions_store_array, lambda: (number_store, get_rng())),
+        (build_house_store_array, lambda: (geo_store, geo_house, params[store_preference_key], get_rng())),
+        (build_store_house_csr, lambda: (house_store, number_store)),
+        (build_block_assignment_array, lambda: (geo_house, params[nb_block_key])),
+        (build_individual_workblock_routes_csr, lambda: (indiv_house, indiv_workplace, house_block, workplace_block,
+                                                         params[nb_block_key])),
+        (build_workblock_individual_csr, lambda: (indiv_transport_block, params[nb_block_key])),
+        (build_individual_rate_array, lambda: (indiv_age, covid_hospitalization_rate_table)),
+        (get_environment_simulation_arrays, lambda: get_environment_args(n_arg) + (get_rng(),)),
+    ]
+
+
+def get_dict_builder_benchmarks(n_arg, seed_arg):
+    # Same as get_array_builder_benchmarks for the dictionary builders, which draw from the random module
+    def seeded(*args):
+        def setup():
+            random.seed(seed_arg)
+            return args
+        return setup
+
+    random.seed(seed_arg)
+    indiv_house = build_individual_houses_map(n_arg, params[same_house_p_key])
+    house_indiv = build_house_individual_map(indiv_house)
+    indiv_adult = build_individual_adult_map(indiv_house)
+    indiv_workplace = build_individual_work_map(indiv_adult, params[remote_work_key])
+    workplace_indiv = build_workplace_individual_map(indiv_workplace)
+    geo_house = build_geo_positions_house(len(house_indiv))
+    geo_workplace = build_geo_positions_workplace(len(workplace_indiv))
+    geo_store = build_geo_positions_store(int(len(house_indiv) / params[store_per_house_key]))
+    house_store = build_house_store_map(geo_store, geo_house, params[store_preference_key])
+    house_block = build_block_assignment(geo_house, params[nb_block_key])
+    workplace_block = build_block_assignment(geo_workplace, params[nb_block_key])
+    indiv_transport_block = build_individual_workblock_map(indiv_house, indiv_workplace, house_block, workplace_block)
+    transport_block_indiv = build_workblock_individual_map(indiv_transport_block)
+    return [
+        (build_individual_houses_map, seeded(n_arg, params[same_house_p_key])),
+        (build_house_individual_map, seeded(indiv_house)),
+        (build_individual_adult_map, seeded(indiv_house)),
+        (build_individual_age_map, seeded(indiv_house)),
+        (build_house_adult_map, seeded(indiv_house, indiv_adult)),
+        (build_individual_work_map, seeded(indiv_adult, params[remote_work_key])),
+        (build_workplace_individual_map, seeded(indiv_workplace)),
+        (build_geo_positions_house, seeded(len(house_indiv))),
+        (build_geo_positions_workplace, seeded(len(workplace_indiv))),
+        (build_geo_positions_store, seeded(len(geo_store))),
+        (build_house_store_map, seeded(geo_store, geo_house, params[store_preference_key])),
+        (build_store_house_map, seeded(house_store)),
+        (build_block_assignment, seeded(geo_house, params[nb_block_key])),
+        (build_individual_workblock_map, seeded(indiv_house, indiv_workplace, house_block, workplace_block)),
+        (build_workblock_individual_map, seeded(indiv_transport_block)),
+        (build_individual_individual_transport_map, seeded(indiv_transport_block, transport_block_indiv)),
+        (build_individual_workblock_csr, seeded(indiv_transport_block, n_arg, params[nb_block_key])),
+        (get_environment_simulation, seeded(*get_environment_args(n_arg))),
+    ]
+
+
+def get_sparse_builder_benchmarks(n_arg, seed_arg):
+    # (fn, setup) of the incidence matrices built on top of the array environment
+    env_dic = get_environment_simulation_arrays(*get_environment_args(n_arg),
+                                                rng=get_random_stream(get_seed_sequence(seed_arg), 0))
+    return [(get_sparse_environment, lambda: (env_dic,))]
+
+
+def get_environment_args(n_arg):
+    return (n_arg, params[same_house_p_key], params[store_per_house_key], params[store_preference_key],
+            params[nb_block_key], params[remote_work_key])
+
+
+def get_kernel_benchmarks(engine_arg, n_arg, seed_arg):
+    # (fn, setup) of the daily steps, each call working on a copy of a population past WARMUP_DAYS days
+    seed_sequence = get_seed_sequence(seed_arg)
+    bounds = (params[contagion_bounds_key], params[hospitalization_bounds_key], params[death_bounds_key],
+              params[immunity_bounds_key])
+    if engine_arg in (ARRAY_ENGINE, SPARSE_ENGINE):
+        env_dic = get_environment_simulation_arrays(*get_environment_args(n_arg),
+                                                    rng=get_random_stream(seed_sequence, 0))
+        if engine_arg == SPARSE_ENGINE:
+            env_dic = get_sparse_environment(env_dic)
+        virus_dic = get_virus_state_t0(n_arg, params[innoculation_pct_key], *bounds,
+                                       rng=get_random_stream(seed_sequence, 1))
+    else:
+        random.seed(seed_arg)
+        env_dic = get_environment_simulation(*get_environment_args(n_arg))
+        virus_dic = get_virus_simulation_t0(n_arg, params[innoculation_pct_key], *bounds)
+    for i in range(WARMUP_DAYS):
+        run.simulate_day(env_dic, virus_dic, i)
+
+    def setup(*args):
+        def copy_population():
+            random.seed(seed_arg)
+            return (env_dic, copy.deepcopy(virus_dic)) + args
+        return copy_population
+
+    return [
+        (propagate_to_houses, setup(params[house_infect_key])),
+        (propagate_to_transportation, setup(params[transport_infection_key], params[transport_exact_key])),
+        (propagate_to_workplaces, setup(params[work_infection_key])),
+        (propagate_to_stores, setup(params[store_infection_key])),
+        (increment_pandemic_1_day, setup()),
+    ]
+
+
+def run_launch(n_arg, nday_arg, seed_arg):
+    # launch_run of one seeded run, its progress bar silenced
+    saved_params = dict(params)
+    params.update({nindividual_key: n_arg, nday_key: nday_arg, nrun_key: 1, njob_key: 1, seed_key: seed_arg,
+                   batch_key: False, env_cache_key: None, mmap_dir_key: None})
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            run.launch_run()
+    finally:
+        params.clear()
+        params.update(saved_params)
+
+
+def get_result(name_arg, engine_arg, n_arg, seconds_arg, peak_arg, person_days_arg=None):
+    # Throughput in person-days/sec for the simulation steps, individuals/sec for the builders
+    if person_days_arg is None:
+        throughput, unit = n_arg / seconds_arg, 'individuals/s'
+    else:
+        throughput, unit = person_days_arg / seconds_arg, 'person-days/s'
+    return {'name': name_arg, 'engine': engine_arg, 'size': n_arg, 'seconds': seconds_arg,
+            'throughput': throughput, 'unit': unit, 'peak_memory_bytes': peak_arg}
+
+
+def print_result(result_arg):
+    print('%-6s %8d  %-42s %10.4f s  %10.3g %-14s %9.1f MB' % (
+        result_arg['engine'], result_arg['size'], result_arg['name'], result_arg['seconds'],
+        result_arg['throughput'], result_arg['unit'], result_arg['peak_memory_bytes'] / 1e6))
+
+
+def run_benchmarks(sizes_arg=DEFAULT_SIZES, max_dict_size_arg=DEFAULT_MAX_DICT_SIZE, seed_arg=DEFAULT_SEED,
+                   repeat_arg=DEFAULT_REPEAT, nday_arg=DEFAULT_NDAY, filter_arg=None, verbose_arg=False):
+    # Results of every benchmark whose name matches filter_arg (a regular expression), at every size
+    # The dictionary engine is only measured up to max_dict_size_arg individuals
+    results = []
+
+    def add(name_arg, engine_arg, n_arg, fn, setup_fn, person_days_arg=None):
+        if filter_arg is not None and re.search(filter_arg, name_arg) is None:
+            return
+        seconds, peak = measure(fn, setup_fn, repeat_arg)
+        results.append(get_result(name_arg, engine_arg, n_arg, seconds, peak, person_days_arg))
+        if verbose_arg:
+            print_result(results[-1])
+
+    for n in sizes_arg:
+        engines = (ARRAY_ENGINE, SPARSE_ENGINE, DICT_ENGINE) if n <= max_dict_size_arg \
+            else (ARRAY_ENGINE, SPARSE_ENGINE)
+        for engine in engines:
+            if engine == ARRAY_ENGINE:
+                builders = get_array_builder_benchmarks(n, seed_arg)
+            elif engine == SPARSE_ENGINE:
+                builders = get_sparse_builder_benchmarks(n, seed_arg)
+            else:
+                builders = get_dict_builder_benchmarks(n, seed_arg)
+            for fn, setup_fn in builders:
+                add(fn.__name__, engine, n, fn, setup_fn)
+            for fn, setup_fn in get_kernel_benchmarks(engine, n, seed_arg):
+                # One call moves every individual through one day
+                add(fn.__name__, engine, n, fn, setup_fn, person_days_arg=n)
+        add('launch_run', ARRAY_ENGINE, n, run_launch, lambda: (n, nday_arg, seed_arg), person_days_arg=n * nday_arg)
+    return results
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_benchmark_report(results_arg, seed_arg, repeat_arg, nday_arg):
+    return {
+        'version': BENCHMARK_FORMAT_VERSION,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': get_git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'seed': seed_arg,
+        'repeat': repeat_arg,
+        'nday': nday_arg,
+        'results': results_arg,
+    }
+
+
+def compare_results(baseline_results_arg, results_arg, threshold_arg=DEFAULT_REGRESSION_THRESHOLD):
+    # (result, time ratio, memory ratio, is regression) of every result also in the baseline
+    # (same name, engine and size), ratios being current / baseline
+    baseline = {(r['name'], r['engine'], r['size']): r for r in baseline_results_arg}
+    comparisons = []
+    for result in results_arg:
+        old = baseline.get((result['name'], result['engine'], result['size']))
+        if old is None:
+            continue
+        time_ratio = result['seconds'] / old['seconds'] if old['seconds'] > 0 else float('inf')
+        memory_ratio = result['peak_memory_bytes'] / old['peak_memory_bytes'] if old['peak_memory_bytes'] > 0 \
+            else 1.0
+        comparisons.append((result, time_ratio, memory_ratio, time_ratio > threshold_arg or
+                            memory_ratio > threshold_arg))
+    return comparisons
+
+
+def print_comparisons(comparisons_arg):
+    for result, time_ratio, memory_ratio, is_regression in comparisons_arg:
+        print('%-6s %8d  %-42s time x%-7.2f memory x%-7.2f%s' % (
+            result['engine'], result['size'], result['name'], time_ratio, memory_ratio,
+            '  REGRESSION' if is_regression else ''))
+
+
+def get_benchmark_parser():
+    parser = argparse.ArgumentParser(description='Times the environment builders and the simulation steps')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='Numbers of individuals')
+    parser.add_argument('--max-dict-size', type=int, default=DEFAULT_MAX_DICT_SIZE,
+                        help='Largest size measured with the dictionary engine')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='Seed of every measured call')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Timed calls, the best one is kept')
+    parser.add_argument('--nday', type=int, default=DEFAULT_NDAY, help='Days simulated by launch_run')
+    parser.add_argument('--filter', type=str, help='Only the benchmarks whose name matches this regular expression')
+    parser.add_argument('--output', type=str, help='JSON file receiving the results')
+    parser.add_argument('--from-results', type=str, help='JSON results compared instead of running the benchmarks')
+    parser.add_argument('--compare', type=str, help='JSON results of a baseline, slower benchmarks are reported')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help='Time or memory ratio to the baseline beyond which a benchmark is a regression')
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_benchmark_parser().parse_args()
+    if args.from_results is not None:
+        with open(args.from_results) as f:
+            report = json.load(f)
+    else:
+        report = get_benchmark_report(run_benchmarks(args.sizes, args.max_dict_size, args.seed, args.repeat,
+                                                     args.nday, args.filter, verbose_arg=True),
+                                      args.seed, args.repeat, args.nday)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline_report = json.load(f)
+        comparisons = compare_results(baseline_report['results'], report['results'], args.threshold)
+        print_comparisons(comparisons)
+        # Non zero exit status on regression, e.g. to fail a CI job
+        sys.exit(1 if any(c[3] for c in comparisons) else 0)
@@ -1,9 +1,11 @@
 import random
 
+import numpy as np
 from scipy import spatial
 
 from initiator.helper import get_r, invert_map, pick_age, get_center_squized_random, pick_random_company_size, \
-    rec_get_manhattan_walk, invert_map_list
+    get_manhattan_walk, get_manhattan_walk_csr, invert_map_list, invert_array, invert_csr, get_rates, pick_ages, \
+    pick_random_company_sizes
 
 
 def build_individual_houses_map(number_individual_arg, proba_same_house_rate):
@@ -139,7 +141,7 @@ def build_individual_workblock_map(individual_house_map_arg, individual_workplac
     for ind, work in individual_workplace_map_arg.items():
         house_block = house_block_map_arg[individual_house_map_arg[ind]]
         workplace_block = workplace_block_map_arg[individual_workplace_map_arg[ind]]
-        intermediate_blocks[ind] = list(set(rec_get_manhattan_walk([], house_block, workplace_block)))
+        intermediate_blocks[ind] = get_manhattan_walk(house_block, workplace_block)
     return intermediate_blocks
 
 
@@ -155,3 +157,132 @@ def build_individual_individual_transport_map(individual_transport_block_map_arg
             individual_individual_transport_dic[ind] = individual_individual_transport_dic.get(ind, set())
             individual_individual_transport_dic[ind].update(set(transport_block_individual_map_arg[block]))
     return individual_individual_transport_dic
+
+
+def build_individual_houses_array(number_individual_arg, proba_same_house_rate, rng):
+    # Individual -> House, same process as build_individual_houses_map : a house drawing u gets
+    # one more person for each halving of u staying above the rate, i.e. 1 + ceil(log2(u / rate)) people
+    u = rng.random(number_individual_arg)
+    sizes = np.ones(number_individual_arg, dtype=np.int64)
+    is_shared = u > proba_same_house_rate
+    with np.errstate(divide='ignore'):
+        sizes[is_shared] += np.minimum(np.ceil(np.log2(u[is_shared] / proba_same_house_rate)),
+                                       number_individual_arg).astype(np.int64)
+    # Houses are filled in order, the last one is cut to the number of individuals
+    number_house = int(np.searchsorted(np.cumsum(sizes), number_individual_arg)) + 1
+    sizes = sizes[:number_house]
+    sizes[-1] = number_individual_arg - np.sum(sizes[:-1])
+    return np.repeat(np.arange(number_house, dtype=np.int64), sizes)
+
+
+def get_position_in_house(individual_house_arg):
+    # Rank of each individual in its house, houses being contiguous ranges of individuals
+    is_first = np.ones(len(individual_house_arg), dtype=bool)
+    is_first[1:] = individual_house_arg[1:] != individual_house_arg[:-1]
+    first = np.flatnonzero(is_first)
+    house_sizes = np.diff(np.append(first, len(individual_house_arg)))
+    return np.arange(len(individual_house_arg)) - np.repeat(first, house_sizes)
+
+
+def build_individual_adult_array(individual_house_arg):
+    # First two persons in a house are adults since children cannot live alone
+    return (get_position_in_house(individual_house_arg) < 2).astype(np.int8)
+
+
+def build_individual_age_array(individual_adult_arg, rng):
+    return pick_ages(individual_adult_arg == 0, rng).astype(np.int16)
+
+
+def build_individual_work_array(individual_adult_arg, probability_remote_work_arg, rng):
+    # Individual -> Workplace (-1 for non workers), workers are shuffled then poured into companies
+    # whose sizes are drawn in bulk
+    workers = np.flatnonzero((rng.random(len(individual_adult_arg)) < probability_remote_work_arg)
+                             & (individual_adult_arg == 1))
+    workers = workers[np.argsort(rng.random(len(workers)), kind='stable')]
+    company_sizes = np.zeros(0, dtype=np.int64)
+    while np.sum(company_sizes) < len(workers):
+        company_sizes = np.append(company_sizes, pick_random_company_sizes(len(workers) // 8 + 1, rng))
+    all_ind_wor = np.full(len(individual_adult_arg), -1, dtype=np.int64)
+    all_ind_wor[workers] = np.searchsorted(np.cumsum(company_sizes), np.arange(len(workers)), side='right')
+    return all_ind_wor
+
+
+def build_geo_positions_house_array(number_house_arg, rng):
+    return rng.random(2 * number_house_arg).reshape(number_house_arg, 2)
+
+
+def build_geo_positions_store_array(number_store_arg, rng):
+    return rng.random(2 * number_store_arg).reshape(number_store_arg, 2)
+
+
+def build_geo_positions_workplace_array(number_workplace_arg, rng):
+    u = rng.random(2 * number_workplace_arg).reshape(number_workplace_arg, 2)
+    return 4 * (u - 0.5) * (u - 0.5) * (u - 0.5) + 0.5
+
+
+def build_block_assignment_array(geo_arg, nb_blocks_arg):
+    return (np.asarray(geo_arg).reshape(-1, 2) * nb_blocks_arg).astype(np.int64)
+
+
+def build_house_store_array(geo_position_store_arg, geo_position_house_arg, prob_preference_store, rng):
+    # House -> nearest store, or the second nearest one
+    distance, indexes = spatial.KDTree(geo_position_store_arg).query(geo_position_house_arg, k=2)
+    return np.where(rng.random(len(indexes)) < prob_preference_store, indexes[:, 0], indexes[:, 1]).astype(np.int64)
+
+
+def build_house_individual_csr(individual_house_arg, number_house_arg):
+    # House -> individuals as an (offsets, indices) pair
+    return invert_array(individual_house_arg, number_house_arg)
+
+
+def build_house_adult_csr(individual_house_arg, individual_adult_arg, number_house_arg):
+    # House -> adults as an (offsets, indices) pair
+    return invert_array(np.where(individual_adult_arg == 1, individual_house_arg, -1), number_house_arg)
+
+
+def build_store_house_csr(house_store_arg, number_store_arg):
+    # Grocerie store -> houses as an (offsets, indices) pair
+    return invert_array(house_store_arg, number_store_arg)
+
+
+def build_workplace_individual_csr(individual_workplace_arg, number_workplace_arg):
+    # Workplace -> individuals as an (offsets, indices) pair, remote workers (-1) are dropped
+    return invert_array(individual_workplace_arg, number_workplace_arg)
+
+
+def build_individual_workblock_csr(individual_workblock_map_arg, number_individual_arg, nb_block_arg):
+    # Individual -> ids (x * nb_block + y) of the blocks used during public transport
+    lengths = np.zeros(number_individual_arg, dtype=np.int64)
+    for ind, blocks in individual_workblock_map_arg.items():
+        lengths[ind] = len(blocks)
+    offsets = np.zeros(number_individual_arg + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    indices = np.array([block[0] * nb_block_arg + block[1] for ind in sorted(individual_workblock_map_arg.keys())
+                        for block in individual_workblock_map_arg[ind]], dtype=np.int64)
+    return offsets, indices
+
+
+def build_individual_workblock_routes_csr(individual_house_arg, individual_workplace_arg,
+                                          house_block_arg, workplace_block_arg, nb_block_arg):
+    # Individual -> blocks used during public transport, all the walks built at once
+    # Non workers (-1 workplace) have no blocks
+    is_worker = individual_workplace_arg >= 0
+    workers = np.flatnonzero(is_worker)
+    worker_offsets, indices = get_manhattan_walk_csr(house_block_arg[individual_house_arg[workers]],
+                                                     workplace_block_arg[individual_workplace_arg[workers]],
+                                                     nb_block_arg)
+    lengths = np.zeros(len(individual_workplace_arg), dtype=np.int64)
+    lengths[workers] = np.diff(worker_offsets)
+    offsets = np.zeros(len(individual_workplace_arg) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets, indices
+
+
+def build_workblock_individual_csr(individual_workblock_csr_arg, nb_block_arg):
+    # Block -> individuals using public transport through it
+    return invert_csr(individual_workblock_csr_arg, nb_block_arg * nb_block_arg)
+
+
+def build_individual_rate_array(individual_age_arg, rate_table_arg):
+    # Individual -> probability (hospitalization or death), looked up once from the age
+    return get_rates(individual_age_arg, rate_table_arg)
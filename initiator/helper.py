@@ -1,6 +1,6 @@
 import random
 
-import pandas as pd
+import numpy as np
 
 from initiator.parameters import covid_mortality_rate, covid_hospitalization_rate, world_age_distribution, \
     TPE_MAX_EMPLOYEES, PME_MAX_EMPLOYEES, GE_MAX_EMPLOYEES
@@ -29,14 +29,27 @@ def get_infection_parameters(lower_contagion_bound, upper_contagion_bound,
            int(lower_immunity_bound + (upper_immunity_bound - lower_immunity_bound) * get_r())
 
 
+def get_rate_table(rate_dic_arg):
+    # Decade -> rate lookup table, the last decade holding the rate of every older age
+    return np.array([rate_dic_arg[max(k for k in rate_dic_arg.keys() if k <= decade)]
+                     for decade in range(max(rate_dic_arg.keys()) + 1)])
+
+
+covid_mortality_rate_table = get_rate_table(covid_mortality_rate)
+covid_hospitalization_rate_table = get_rate_table(covid_hospitalization_rate)
+
+
+def get_rates(ages_arg, rate_table_arg):
+    # Vectorized lookup of the rates of an array of ages
+    return rate_table_arg[np.minimum(np.asarray(ages_arg) // 10, len(rate_table_arg) - 1)]
+
+
 def get_mortalty_rate(age):
-    i = next(x for x in enumerate(list(covid_mortality_rate.keys())) if x[1] <= age / 10)
-    return covid_mortality_rate[i[1]]
+    return float(covid_mortality_rate_table[min(int(age // 10), len(covid_mortality_rate_table) - 1)])
 
 
 def get_hospitalization_rate(age):
-    i = next(x for x in enumerate(list(covid_hospitalization_rate.keys())) if x[1] <= age / 10)
-    return covid_hospitalization_rate[i[1]]
+    return float(covid_hospitalization_rate_table[min(int(age // 10), len(covid_hospitalization_rate_table) - 1)])
 
 
 def flatten(list_arg):
@@ -60,38 +73,116 @@ def invert_map_list(dic_arg):
     return inverted_dic_arg
 
 
-def get_age_distribution():
+def map_to_array(dic_arg, size_arg, fill_arg=-1):
+    # Individual -> value dictionary as a dense array, missing individuals get fill_arg
+    result = np.full(size_arg, fill_arg, dtype=np.int64)
+    if len(dic_arg) > 0:
+        result[np.fromiter(dic_arg.keys(), dtype=np.int64, count=len(dic_arg))] = \
+            np.fromiter(dic_arg.values(), dtype=np.int64, count=len(dic_arg))
+    return result
+
+
+def invert_array(values_arg, n_keys_arg):
+    # Sort based version of invert_map : value -> (offsets, indices) CSR pair
+    # Members of key k are indices[offsets[k]:offsets[k + 1]], negative values (no key) are dropped
+    values = np.asarray(values_arg)
+    kept = np.flatnonzero(values >= 0)
+    indices = kept[np.argsort(values[kept], kind='stable')]
+    offsets = np.zeros(n_keys_arg + 1, dtype=np.int64)
+    np.cumsum(np.bincount(values[kept], minlength=n_keys_arg), out=offsets[1:])
+    return offsets, indices
+
+
+def invert_csr(csr_arg, n_keys_arg):
+    # Sort based version of invert_map_list : row -> values CSR becomes value -> rows CSR
+    offsets, indices = csr_arg
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    inverted_offsets, order = invert_array(indices, n_keys_arg)
+    return inverted_offsets, rows[order]
+
+
+def get_csr_members(csr_arg, rows_arg):
+    # Concatenated members of all given rows, in one pass
+    offsets, indices = csr_arg
+    rows = np.asarray(rows_arg, dtype=np.int64)
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    shifts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return indices[shifts + np.arange(len(shifts))]
+
+
+def get_csr_sizes(csr_arg, rows_arg=None):
+    offsets = csr_arg[0]
+    if rows_arg is None:
+        return np.diff(offsets)
+    return offsets[np.asarray(rows_arg, dtype=np.int64) + 1] - offsets[rows_arg]
+
+
+def replicate_array(values_arg, n_replicas_arg, n_keys_arg):
+    # n_replicas_arg copies of an individual -> key array, copy r pointing to keys offset by r * n_keys_arg
+    # (-1 stays -1)
+    values = np.asarray(values_arg)
+    offsets = np.repeat(np.arange(n_replicas_arg, dtype=np.int64) * n_keys_arg, len(values))
+    replicated = np.tile(values, n_replicas_arg).astype(np.int64)
+    return np.where(replicated >= 0, replicated + offsets, -1)
+
+
+def replicate_csr(csr_arg, n_replicas_arg, n_members_arg):
+    # n_replicas_arg copies of a CSR pair whose rows and members are both offset by replica
+    offsets, indices = csr_arg
+    replicated_offsets = np.concatenate(
+        [(offsets[:-1] + r * len(indices)) for r in range(n_replicas_arg)] + [[n_replicas_arg * len(indices)]])
+    replicated_indices = (np.tile(indices, n_replicas_arg) +
+                          np.repeat(np.arange(n_replicas_arg, dtype=np.int64) * n_members_arg, len(indices)))
+    return replicated_offsets.astype(np.int64), replicated_indices
+
+
+def get_age_table(age_distribution_arg):
+    # Cumulative probabilities and [min, max) bounds of the age classes, computed once
     # Source https://www.populationpyramid.net/world/2019/
-    age_distribution = pd.DataFrame(world_age_distribution, columns=['age', 'nb_men', 'nb_women'])
-    age_distribution['nb'] = age_distribution['nb_men'] + age_distribution['nb_women']
-    age_distribution['pct'] = age_distribution['nb'] / age_distribution['nb'].sum()
-    age_distribution['min_age'] = age_distribution['age'].map(lambda s: int(s.split('-')[0]))
-    age_distribution['max_age'] = age_distribution['age'].map(lambda s: int(s.split('-')[1]))
-    # We did a cut to 25 years old for adult
-    age_distribution_children = age_distribution.iloc[:7]
-    age_distribution_adults = age_distribution.iloc[4:]
-    age_distribution_children_cumsum = \
-        age_distribution_children['pct'].cumsum() / age_distribution_children['pct'].cumsum().max()
-    age_distribution_adults_cumsum = \
-        age_distribution_adults['pct'].cumsum() / age_distribution_adults['pct'].cumsum().max()
-    return age_distribution_children, age_distribution_children_cumsum, age_distribution_adults, \
-           age_distribution_adults_cumsum
+    nb = np.array([nb_men + nb_women for age, nb_men, nb_women in age_distribution_arg], dtype=np.int64)
+    cumsum = np.cumsum(nb / nb.sum())
+    min_age = np.array([int(age.split('-')[0]) for age, nb_men, nb_women in age_distribution_arg], dtype=np.int64)
+    max_age = np.array([int(age.split('-')[1]) for age, nb_men, nb_women in age_distribution_arg], dtype=np.int64)
+    return cumsum / cumsum.max(), min_age, max_age
+
 
+def get_redraw_cumsum(cumsum_arg):
+    # Cumulative probabilities of the classes picked by pick_age, which draws a new random number at each
+    # comparison: class i comes with probability cs[i] * prod_{j<i} (1 - cs[j]), the last one (cs = 1) takes the rest
+    not_picked = np.concatenate(([1.], np.cumprod(1. - cumsum_arg[:-1])))
+    cumsum = np.cumsum(cumsum_arg * not_picked)
+    return cumsum / cumsum[-1]
 
-age_dist_children, age_dist_children_cs, age_dist_adults, age_dist_adults_cs = get_age_distribution()
+
+# We did a cut to 25 years old for adult
+age_children_table = get_age_table(world_age_distribution[:7])
+age_adults_table = get_age_table(world_age_distribution[4:])
+# Same tables as lists, faster to go through one value at a time
+age_children_list = tuple(t.tolist() for t in age_children_table)
+age_adults_list = tuple(t.tolist() for t in age_adults_table)
+# Tables inverted by pick_ages, giving the same age distribution as pick_age
+age_children_pick_table = (get_redraw_cumsum(age_children_table[0]),) + age_children_table[1:]
+age_adults_pick_table = (get_redraw_cumsum(age_adults_table[0]),) + age_adults_table[1:]
 
 
 def pick_age(is_child):
-    if is_child:
-        l_cs = age_dist_children_cs
-        l_dis = age_dist_children
-    else:
-        l_cs = age_dist_adults_cs
-        l_dis = age_dist_adults
-    i = next(x[0] for x in enumerate(l_cs.values) if x[1] > get_r())
-    min_age_i = l_dis.iloc[i]['min_age']
-    max_age_i = l_dis.iloc[i]['max_age']
-    return int(min_age_i + (max_age_i - min_age_i) * get_r())
+    l_cs, l_min_age, l_max_age = age_children_list if is_child else age_adults_list
+    # A new random number is drawn at each comparison, which favours the first age classes
+    # (kept as is so that results do not move, pick_ages draws from the same distribution)
+    i = next(x[0] for x in enumerate(l_cs) if x[1] > get_r())
+    return int(l_min_age[i] + (l_max_age[i] - l_min_age[i]) * get_r())
+
+
+def pick_ages(is_child_arg, rng):
+    # Vectorized age picking, one age per flag drawn by inverting the cumulative distribution of pick_age
+    is_child_arg = np.asarray(is_child_arg, dtype=bool)
+    ages = np.empty(len(is_child_arg), dtype=np.int64)
+    for is_child, (l_cs, l_min_age, l_max_age) in ((True, age_children_pick_table), (False, age_adults_pick_table)):
+        n = int(np.count_nonzero(is_child_arg == is_child))
+        i = np.searchsorted(l_cs, rng.random(n), side='right')
+        ages[is_child_arg == is_child] = (l_min_age[i] + (l_max_age[i] - l_min_age[i]) * rng.random(n)).astype(np.int64)
+    return ages
 
 
 def get_center_squized_random():
@@ -112,19 +203,61 @@ def pick_random_company_size():
         return int(PME_MAX_EMPLOYEES + (GE_MAX_EMPLOYEES - PME_MAX_EMPLOYEES) * get_r())
 
 
-# Recursive Manhattan walk
+def pick_random_company_sizes(n_arg, rng):
+    # Vectorized pick_random_company_size : TPE, PME or GE then a uniform size within its bounds
+    p = rng.random(n_arg)
+    is_tpe = p < 0.44
+    is_pme = ~is_tpe & (p < 0.86)
+    lower = np.where(is_tpe, 1, np.where(is_pme, TPE_MAX_EMPLOYEES, PME_MAX_EMPLOYEES))
+    upper = np.where(is_tpe, TPE_MAX_EMPLOYEES, np.where(is_pme, PME_MAX_EMPLOYEES, GE_MAX_EMPLOYEES))
+    return (lower + (upper - lower) * rng.random(n_arg)).astype(np.int64)
+
+
+def get_manhattan_walk(p1, p2):
+    # Blocks of the Manhattan walk between p1 and p2, each block once : up from the point with the smallest
+    # second coordinate (a, b) to the other one's (c, d), then across from (a, d) to (c, d)
+    (a, b), (c, d) = (p1, p2) if p1[1] <= p2[1] else (p2, p1)
+    step = 1 if c >= a else -1
+    return [(a, y) for y in range(b, d + 1)] + [(x, d) for x in range(a + step, c + step, step)]
+
+
+def get_manhattan_walk_csr(p1_arg, p2_arg, nb_block_arg):
+    # Vectorized get_manhattan_walk over arrays of (x, y) points, as an (offsets, block ids) pair
+    # with block id x * nb_block_arg + y
+    p1_arg, p2_arg = np.asarray(p1_arg).reshape(-1, 2), np.asarray(p2_arg).reshape(-1, 2)
+    is_p1_lower = p1_arg[:, 1] <= p2_arg[:, 1]
+    a, b = np.where(is_p1_lower, p1_arg[:, 0], p2_arg[:, 0]), np.where(is_p1_lower, p1_arg[:, 1], p2_arg[:, 1])
+    c, d = np.where(is_p1_lower, p2_arg[:, 0], p1_arg[:, 0]), np.where(is_p1_lower, p2_arg[:, 1], p1_arg[:, 1])
+    nb_vertical = d - b + 1
+    sizes = nb_vertical + np.abs(c - a)
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    # Step of each block within its walk
+    walk = np.repeat(np.arange(len(sizes)), sizes)
+    t = np.arange(offsets[-1]) - offsets[walk]
+    is_vertical = t < nb_vertical[walk]
+    x = np.where(is_vertical, a[walk], a[walk] + np.sign(c - a)[walk] * (t - nb_vertical[walk] + 1))
+    y = np.where(is_vertical, b[walk] + t, d[walk])
+    return offsets, (x * nb_block_arg + y).astype(np.int64)
+
+
 def rec_get_manhattan_walk(result, p1, p2):
-    i, j = p1
-    k, l = p2
-    if i == k and j == l:
-        return result + [p1]
-    if j == l:
-        if i < k:
-            return rec_get_manhattan_walk(result + [p1, p2], (k, l), (i + 1, j))
-        else:
-            return rec_get_manhattan_walk(result + [p1, p2], (k + 1, l), (i, j))
-    else:
-        if j < l:
-            return rec_get_manhattan_walk(result + [p1, p2], (i, j + 1), (k, l))
+    # Former recursive Manhattan walk (with repeated blocks) turned into a loop, same output
+    result = list(result)
+    while True:
+        i, j = p1
+        k, l = p2
+        if i == k and j == l:
+            result.append(p1)
+            return result
+        result += [p1, p2]
+        if j == l:
+            if i < k:
+                p1, p2 = (k, l), (i + 1, j)
+            else:
+                p1, p2 = (k + 1, l), (i, j)
         else:
-            return rec_get_manhattan_walk(result + [p1, p2], (k, l + 1), (i, j))
+            if j < l:
+                p1 = (i, j + 1)
+            else:
+                p1, p2 = (k, l + 1), (i, j)
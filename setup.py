@@ -18,5 +18,5 @@ setup(
     author_email='issam.github@issam.ma',
     url='https://github.com/AshtonIzmev',
     license=license,
-    packages=find_packages(exclude=('tests', 'docs'))
+    packages=find_packages(exclude=('tests', 'docs', 'benchmarks'))
 )
\ No newline at end of file
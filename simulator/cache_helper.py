@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# Bump when the layout of the array environment changes, older cache files are then never read again
+ENVIRONMENT_CACHE_VERSION = 1
+ENVIRONMENT_CACHE_EXTENSION = '.npz'
+# CSR (offsets, indices) pairs are stored as two arrays suffixed as below
+OFFSETS_SUFFIX = '.offsets'
+INDICES_SUFFIX = '.indices'
+
+
+def get_environment_cache_key(environment_params_arg, seed_arg):
+    # Hash of the parameters the environment is built from and of the seed of its random stream
+    description = json.dumps({'version': ENVIRONMENT_CACHE_VERSION, 'params': environment_params_arg,
+                              'seed': seed_arg}, sort_keys=True)
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()[:32]
+
+
+def get_environment_cache_path(cache_dir_arg, environment_params_arg, seed_arg):
+    return os.path.join(cache_dir_arg, get_environment_cache_key(environment_params_arg, seed_arg) +
+                        ENVIRONMENT_CACHE_EXTENSION)
+
+
+def save_environment(path_arg, env_dic):
+    # Uncompressed npz so that loading is a plain read, written aside then renamed so that
+    # a concurrent reader never sees a partial file
+    arrays = {}
+    for k, v in env_dic.items():
+        if isinstance(v, tuple):
+            arrays[k + OFFSETS_SUFFIX], arrays[k + INDICES_SUFFIX] = v
+        else:
+            arrays[k] = v
+    tmp_path = path_arg + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path_arg)
+
+
+def load_environment(path_arg):
+    env_dic = {}
+    with np.load(path_arg) as arrays:
+        for name in arrays.files:
+            if name.endswith(OFFSETS_SUFFIX):
+                k = name[:-len(OFFSETS_SUFFIX)]
+                env_dic[k] = (arrays[name], arrays[k + INDICES_SUFFIX])
+            elif not name.endswith(INDICES_SUFFIX):
+                env_dic[name] = arrays[name]
+    return env_dic
+
+
+def evict_environment_cache(cache_dir_arg, max_size_bytes_arg):
+    # Least recently used files (loading touches them) are removed until the cache fits
+    entries = []
+    for name in os.listdir(cache_dir_arg):
+        if name.endswith(ENVIRONMENT_CACHE_EXTENSION):
+            stat = os.stat(os.path.join(cache_dir_arg, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total_size <= max_size_bytes_arg:
+            break
+        try:
+            os.remove(os.path.join(cache_dir_arg, name))
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+
+def get_cached_environment(cache_dir_arg, max_size_mb_arg, environment_params_arg, seed_arg, build_fn):
+    # Environment built by build_fn(), or read back from cache_dir_arg when it was already built
+    # with the same parameters and seed
+    os.makedirs(cache_dir_arg, exist_ok=True)
+    path = get_environment_cache_path(cache_dir_arg, environment_params_arg, seed_arg)
+    if os.path.exists(path):
+        try:
+            env_dic = load_environment(path)
+            os.utime(path)
+            return env_dic
+        except (OSError, ValueError, KeyError):
+            # Unreadable file (e.g. evicted while loading), built again below
+            pass
+    env_dic = build_fn()
+    save_environment(path, env_dic)
+    evict_environment_cache(cache_dir_arg, max_size_mb_arg * 1024 * 1024)
+    return env_dic
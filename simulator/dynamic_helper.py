@@ -1,6 +1,16 @@
+import numpy as np
+
 from initiator.helper import flatten, get_random_choice_list
-from initiator.helper import get_r, get_mortalty_rate, get_hospitalization_rate
+from initiator.helper import get_r, get_mortalty_rate, get_hospitalization_rate, get_rates, \
+    covid_hospitalization_rate_table, covid_mortality_rate_table
+from simulator.kernel_helper import propagate_to_houses_array, propagate_to_workplaces_array, \
+    propagate_to_transportation_array, propagate_to_stores_array
 from simulator.keys import *
+from simulator.simulation_helper import is_array_environment
+from simulator.sparse_helper import is_sparse_environment, propagate_to_houses_sparse, \
+    propagate_to_workplaces_sparse, propagate_to_transportation_sparse, propagate_to_stores_sparse
+from simulator.virus_state import VirusState, TRACKED_STATES, SICK_STATES, HOSPITAL_EVENT, DECISION_EVENT, \
+    IMMUNITY_EVENT
 
 
 # Assuming 0 is Monday
@@ -9,6 +19,9 @@ def is_weekend(i):
 
 
 def update_infection_period(newly_infected_individuals_arg, virus_dic):
+    if isinstance(virus_dic, VirusState):
+        virus_dic.infect(newly_infected_individuals_arg)
+        return
     for i in newly_infected_individuals_arg:
         if virus_dic[STA_K][i] == HEALTHY_V:
             virus_dic[STA_K][i] = INFECTED_V
@@ -16,6 +29,9 @@ def update_infection_period(newly_infected_individuals_arg, virus_dic):
 
 
 def increment_pandemic_1_day(env_dic, virus_dic):
+    if isinstance(virus_dic, VirusState):
+        increment_pandemic_1_day_state(env_dic, virus_dic)
+        return
     for i in get_infected_people(virus_dic) + get_hospitalized_people(virus_dic):
         # Contagion and decision periods are decremented
         virus_dic[CON_K][i] = virus_dic[CON_K][i] - 1
@@ -42,27 +58,75 @@ def increment_pandemic_1_day(env_dic, virus_dic):
             virus_dic[IMM_K][i] = imm
 
 
+def get_individual_rates(env_dic, individuals_arg, rate_key_arg, rate_table_arg):
+    if rate_key_arg in env_dic:
+        return env_dic[rate_key_arg][individuals_arg]
+    # Dictionary environment, rates are looked up from the ages
+    return get_rates(np.array([env_dic[IAG_K][i] for i in individuals_arg], dtype=np.int64), rate_table_arg)
+
+
+def increment_pandemic_1_day_state(env_dic, virus_dic):
+    # Same progression as increment_pandemic_1_day, draining today's buckets of the calendar queue
+    # Hospitalization check when the hospitalization countdown reaches 0
+    to_hospital = virus_dic.pop_events(HOSPITAL_EVENT, SICK_STATES)
+    is_hospitalized = virus_dic.rng.random(len(to_hospital)) < \
+        get_individual_rates(env_dic, to_hospital, IHR_K, covid_hospitalization_rate_table)
+    virus_dic.set_state(to_hospital[is_hospitalized], HOSPITALIZED_V)
+
+    # Decide over life
+    decided = virus_dic.pop_events(DECISION_EVENT, SICK_STATES)
+    is_dying = virus_dic.rng.random(len(decided)) < \
+        get_individual_rates(env_dic, decided, IMR_K, covid_mortality_rate_table)
+    virus_dic.end_infection(decided)
+    virus_dic.kill(decided[is_dying])
+    virus_dic.set_state(decided[~is_dying], IMMUNE_V)
+    virus_dic.schedule_immunity(decided[~is_dying])
+
+    # Losing immunity
+    not_immune = virus_dic.pop_events(IMMUNITY_EVENT, (IMMUNE_V,))
+    virus_dic.set_state(not_immune, HEALTHY_V)
+    virus_dic.contagion[not_immune], virus_dic.hospitalization[not_immune], virus_dic.death[not_immune], \
+        virus_dic.immunity[not_immune] = virus_dic.draw_infection_params(len(not_immune))
+
+    virus_dic.day = virus_dic.day + 1
+
+
+def get_people(virus_dic, state_value):
+    if isinstance(virus_dic, VirusState):
+        if state_value in TRACKED_STATES:
+            return virus_dic.get_members(state_value).tolist()
+        return np.flatnonzero(virus_dic.state == state_value).tolist()
+    return [k for k, v in virus_dic[STA_K].items() if v == state_value]
+
+
 def get_hospitalized_people(virus_dic):
-    return [k for k, v in virus_dic[STA_K].items() if v == HOSPITALIZED_V]
+    return get_people(virus_dic, HOSPITALIZED_V)
 
 
 def get_infected_people(virus_dic):
-    return [k for k, v in virus_dic[STA_K].items() if v == INFECTED_V]
+    return get_people(virus_dic, INFECTED_V)
 
 
 def get_deadpeople(virus_dic):
-    return [k for k, v in virus_dic[STA_K].items() if v == DEAD_V]
+    return get_people(virus_dic, DEAD_V)
 
 
 def get_healthy_people(virus_dic):
-    return [k for k, v in virus_dic[STA_K].items() if v == HEALTHY_V]
+    return get_people(virus_dic, HEALTHY_V)
 
 
 def get_immune_people(virus_dic):
-    return [k for k, v in virus_dic[STA_K].items() if v == IMMUNE_V]
+    return get_people(virus_dic, IMMUNE_V)
 
 
 def get_pandemic_statistics(virus_dic):
+    if isinstance(virus_dic, VirusState):
+        # O(1), counters are maintained on every state transition
+        counts = virus_dic.get_counts()
+        results = (int(counts[HEALTHY_V]), int(counts[INFECTED_V]), int(counts[HOSPITALIZED_V]),
+                   int(counts[DEAD_V]), int(counts[IMMUNE_V]), virus_dic[NC_K])
+        virus_dic[NC_K] = 0
+        return results
     results = (len(get_healthy_people(virus_dic)), len(get_infected_people(virus_dic)),
                len(get_hospitalized_people(virus_dic)), len(get_deadpeople(virus_dic)),
                len(get_immune_people(virus_dic)), virus_dic[NC_K])
@@ -71,7 +135,22 @@ def get_pandemic_statistics(virus_dic):
     return results
 
 
+def get_replica_statistics(virus_dic):
+    # get_pandemic_statistics of each replica of a batched VirusState, as a (n_replicas, 6) array
+    counts = virus_dic.get_replica_counts()
+    new_cases = virus_dic.replica_new_cases if virus_dic.replica_new_cases is not None \
+        else np.array([virus_dic[NC_K]])
+    results = np.column_stack((counts[:, HEALTHY_V], counts[:, INFECTED_V], counts[:, HOSPITALIZED_V],
+                               counts[:, DEAD_V], counts[:, IMMUNE_V], new_cases))
+    virus_dic[NC_K] = 0
+    if virus_dic.replica_new_cases is not None:
+        virus_dic.replica_new_cases[:] = 0
+    return results
+
+
 def is_contagious(individual_arg, virus_dic):
+    if isinstance(virus_dic, VirusState):
+        return bool(virus_dic.is_contagious(individual_arg))
     return virus_dic[STA_K][individual_arg] == INFECTED_V and virus_dic[CON_K][individual_arg] < 0
 
 
@@ -80,6 +159,12 @@ def is_alive(individual_arg, virus_dic):
 
 
 def propagate_to_houses(env_dic, virus_dic, probability_home_infection_arg):
+    if is_sparse_environment(env_dic):
+        propagate_to_houses_sparse(env_dic, virus_dic, probability_home_infection_arg)
+        return
+    if is_array_environment(env_dic):
+        propagate_to_houses_array(env_dic, virus_dic, probability_home_infection_arg)
+        return
     # Houses that contain an infected and contagious person
     infected_houses = [env_dic[IH_K][i] for i in get_infected_people(virus_dic)
                        if is_contagious(i, virus_dic)]
@@ -93,6 +178,12 @@ def propagate_to_houses(env_dic, virus_dic, probability_home_infection_arg):
 
 
 def propagate_to_workplaces(env_dic, virus_dic, probability_work_infection_arg):
+    if is_sparse_environment(env_dic):
+        propagate_to_workplaces_sparse(env_dic, virus_dic, probability_work_infection_arg)
+        return
+    if is_array_environment(env_dic):
+        propagate_to_workplaces_array(env_dic, virus_dic, probability_work_infection_arg)
+        return
     # Contagious people who will go to work
     infected_gotowork = [i for i in get_infected_people(virus_dic) if i in env_dic[IW_K].keys()
                          and is_contagious(i, virus_dic)]
@@ -105,7 +196,16 @@ def propagate_to_workplaces(env_dic, virus_dic, probability_work_infection_arg):
     update_infection_period(infected_backfromwork, virus_dic)
 
 
-def propagate_to_transportation(env_dic, virus_dic, probability_transport_infection_arg):
+def propagate_to_transportation(env_dic, virus_dic, probability_transport_infection_arg, transport_exact_arg=False):
+    if is_sparse_environment(env_dic):
+        propagate_to_transportation_sparse(env_dic, virus_dic, probability_transport_infection_arg,
+                                           transport_exact_arg)
+        return
+    if is_array_environment(env_dic):
+        # Exposures are drawn per infected block unless transport_exact_arg is set
+        propagate_to_transportation_array(env_dic, virus_dic, probability_transport_infection_arg,
+                                          transport_exact_arg)
+        return
     # Contagious people who will go to work
     infected_who_goto_work = [i for i in get_infected_people(virus_dic) if i in env_dic[IW_K].keys()
                               and is_contagious(i, virus_dic)]
@@ -120,6 +220,12 @@ def propagate_to_transportation(env_dic, virus_dic, probability_transport_infect
 
 
 def propagate_to_stores(env_dic, virus_dic, probability_store_infection_arg):
+    if is_sparse_environment(env_dic):
+        propagate_to_stores_sparse(env_dic, virus_dic, probability_store_infection_arg)
+        return
+    if is_array_environment(env_dic):
+        propagate_to_stores_array(env_dic, virus_dic, probability_store_infection_arg)
+        return
     # Filter on living people because we have a random choice to make in each house
     # People who will go to their store (one person per house as imposed by lockdown)
     individuals_gotostore = get_random_choice_list([[i for i in env_dic[HA_K][h] if is_alive(i, virus_dic)]
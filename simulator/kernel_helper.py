@@ -0,0 +1,110 @@
+import numpy as np
+
+from initiator.helper import get_csr_members, get_csr_sizes
+from simulator.keys import *
+
+
+# Vectorized propagation kernels working on an array environment (see get_environment_simulation_arrays)
+# and a VirusState
+
+
+def get_contagious_people_array(virus_dic):
+    # Goes through the infected index only, not the whole population
+    return virus_dic.get_contagious_people()
+
+
+def get_exposure_probability(probability_arg, n_exposures_arg):
+    # Probability of being infected at least once over n independent exposures
+    return 1 - (1 - probability_arg) ** n_exposures_arg
+
+
+def get_infected_by_group(individual_group_arg, group_individual_arg, contagious_arg, virus_dic, probability_arg):
+    # Infected groups and their number of contagious people (-1 means no group)
+    contagious_group = individual_group_arg[contagious_arg]
+    infected_groups, contagious_per_group = np.unique(contagious_group[contagious_group >= 0], return_counts=True)
+
+    # Each member is exposed once per contagious person of its group
+    exposed = get_csr_members(group_individual_arg, infected_groups)
+    exposures = np.repeat(contagious_per_group, get_csr_sizes(group_individual_arg, infected_groups))
+    virus_dic.exposures += len(exposed)
+    return exposed[virus_dic.rng.random(len(exposed)) < get_exposure_probability(probability_arg, exposures)]
+
+
+def propagate_to_houses_array(env_dic, virus_dic, probability_home_infection_arg):
+    # People infected (not necessarily contagious) from a contagious person living in their house
+    # Each housemate used to be drawn once per contagious person living in the house
+    infected_athome = get_infected_by_group(env_dic[IH_K], env_dic[HI_K], get_contagious_people_array(virus_dic),
+                                            virus_dic, probability_home_infection_arg)
+
+    # INFECTION STATE UPDATE
+    virus_dic.infect(infected_athome)
+
+
+def propagate_to_workplaces_array(env_dic, virus_dic, probability_work_infection_arg):
+    # Infected workplaces are deduplicated, co-workers exposed to k contagious people get a single draw
+    # Remote workers and non workers have a -1 workplace and never go to work
+    infected_backfromwork = get_infected_by_group(env_dic[IW_K], env_dic[WI_K],
+                                                  get_contagious_people_array(virus_dic),
+                                                  virus_dic, probability_work_infection_arg)
+
+    # INFECTION STATE UPDATE
+    virus_dic.infect(infected_backfromwork)
+
+
+def propagate_to_transportation_array(env_dic, virus_dic, probability_transport_infection_arg,
+                                      transport_exact_arg=False):
+    # Public transportation blocks crossed by at least one contagious commuter (non workers have no blocks)
+    infected_blocks = np.unique(get_csr_members(env_dic[IB_K], get_contagious_people_array(virus_dic)))
+    # Commuters crossing an infected block, once per infected block on their way
+    exposed = get_csr_members(env_dic[BI_K], infected_blocks)
+    if transport_exact_arg:
+        # Same as the individual x individual map : a single draw for anyone sharing a block
+        exposed = np.unique(exposed)
+    virus_dic.exposures += len(exposed)
+    infected_bad_luck_transport = exposed[virus_dic.rng.random(len(exposed)) < probability_transport_infection_arg]
+
+    # INFECTION STATE UPDATE
+    virus_dic.infect(infected_bad_luck_transport)
+
+
+def pick_shoppers(virus_dic, houses_arg):
+    # One living adult per house (houses must have one), picked uniformly in one draw
+    living_adult_counts = virus_dic.living_adult_counts[houses_arg]
+    picks = virus_dic.living_adult_offsets[houses_arg] + \
+        (virus_dic.rng.random(len(houses_arg)) * living_adult_counts).astype(np.int64)
+    return virus_dic.living_adults[picks]
+
+
+def propagate_to_stores_array(env_dic, virus_dic, probability_store_infection_arg):
+    # Living adults are maintained by the VirusState (updated on deaths) instead of being filtered every day
+    if virus_dic.living_adults is None:
+        virus_dic.track_living_adults(env_dic[HA_K], env_dic[IH_K])
+
+    # Only houses with a contagious living adult can send a contagious person to their store
+    contagious = get_contagious_people_array(virus_dic)
+    contagious_houses = np.unique(env_dic[IH_K][contagious[virus_dic.living_adult_positions[contagious] >= 0]])
+    contagious_houses_shoppers = pick_shoppers(virus_dic, contagious_houses)
+
+    # Stores that will be visited by a contagious person
+    infected_stores = np.unique(env_dic[HS_K][contagious_houses[virus_dic.is_contagious(contagious_houses_shoppers)]])
+
+    # People who did go to that contagious store (one person per house as imposed by lockdown)
+    # Shoppers are picked only for the houses attached to an infected store, keeping the picks already made
+    houses_goto_infected_store = get_csr_members(env_dic[SH_K], infected_stores)
+    houses_goto_infected_store = houses_goto_infected_store[
+        virus_dic.living_adult_counts[houses_goto_infected_store] > 0]
+    individuals_goto_infected_store = pick_shoppers(virus_dic, houses_goto_infected_store)
+    already_picked = np.searchsorted(contagious_houses, houses_goto_infected_store)
+    is_already_picked = already_picked < len(contagious_houses)
+    is_already_picked[is_already_picked] = \
+        contagious_houses[already_picked[is_already_picked]] == houses_goto_infected_store[is_already_picked]
+    individuals_goto_infected_store[is_already_picked] = \
+        contagious_houses_shoppers[already_picked[is_already_picked]]
+
+    # People who got infected from going to their store
+    virus_dic.exposures += len(individuals_goto_infected_store)
+    infected_backfromstore = individuals_goto_infected_store[
+        virus_dic.rng.random(len(individuals_goto_infected_store)) < probability_store_infection_arg]
+
+    # INFECTION STATE UPDATE
+    virus_dic.infect(infected_backfromstore)
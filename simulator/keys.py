@@ -2,12 +2,25 @@ IH_K = "individual_to_house_mapping"
 HI_K = "house_to_individual_mapping"
 IAD_K = "individual_to_adult_mapping"
 IAG_K = "individual_to_age_mapping"
+IHR_K = "individual_to_hospitalization_rate_mapping"
+IMR_K = "individual_to_mortality_rate_mapping"
 IW_K = "individual_to_work_mapping"
 WI_K = "work_to_individual_mapping"
 HA_K = "house_to_adult_mapping"
 HS_K = "house_to_store_mapping"
 SH_K = "store_to_house_mapping"
 ITI_K = "individual_transport_individual_mapping"
+IB_K = "individual_to_transport_block_mapping"
+BI_K = "transport_block_to_individual_mapping"
+# Incidence matrices of the sparse engine
+IHX_K = "individual_house_incidence"
+HIX_K = "house_individual_incidence"
+IWX_K = "individual_work_incidence"
+WIX_K = "work_individual_incidence"
+ISX_K = "individual_store_incidence"
+SIX_K = "store_individual_incidence"
+IBX_K = "individual_transport_block_incidence"
+BIX_K = "transport_block_individual_incidence"
 
 CON_K = "individual_to_contagion_mapping"
 HOS_K = "individual_to_hospital_mapping"
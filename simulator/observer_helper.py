@@ -0,0 +1,92 @@
+import time
+
+from simulator.plot_helper import print_progress_bar
+
+# Minimum number of seconds between two redraws of the progress bar
+DEFAULT_PROGRESS_INTERVAL = 0.5
+
+
+class RunObserver:
+    # Hooks called by the simulation loops, an observer overrides the ones it needs
+    # Rows are get_pandemic_statistics rows, the same ones the stats sink receives
+
+    def on_run_start(self, run_arg):
+        pass
+
+    def on_day_end(self, run_arg, day_arg, row_arg):
+        pass
+
+    def on_days_end(self, runs_arg, days_arg, rows_arg):
+        # Several rows at once : one day of every batched run, or every day of a run done by a worker process
+        for run, day, row in zip(runs_arg, days_arg, rows_arg):
+            self.on_day_end(run, day, row)
+
+    def on_run_end(self, run_arg):
+        pass
+
+
+def is_overridden(observer_arg, hook_arg):
+    return getattr(type(observer_arg), hook_arg) is not getattr(RunObserver, hook_arg)
+
+
+class ObserverGroup(RunObserver):
+    # Hands every hook to the observers overriding it, so that observers not interested in the days
+    # cost nothing in the daily loop
+
+    def __init__(self, observers_arg):
+        self.observers = list(observers_arg)
+        self.run_start_observers = [o for o in self.observers if is_overridden(o, 'on_run_start')]
+        self.day_end_observers = [o for o in self.observers
+                                  if is_overridden(o, 'on_day_end') or is_overridden(o, 'on_days_end')]
+        self.run_end_observers = [o for o in self.observers if is_overridden(o, 'on_run_end')]
+
+    def on_run_start(self, run_arg):
+        for observer in self.run_start_observers:
+            observer.on_run_start(run_arg)
+
+    def on_day_end(self, run_arg, day_arg, row_arg):
+        for observer in self.day_end_observers:
+            observer.on_day_end(run_arg, day_arg, row_arg)
+
+    def on_days_end(self, runs_arg, days_arg, rows_arg):
+        for observer in self.day_end_observers:
+            observer.on_days_end(runs_arg, days_arg, rows_arg)
+
+    def on_run_end(self, run_arg):
+        for observer in self.run_end_observers:
+            observer.on_run_end(run_arg)
+
+
+def get_observer(observers_arg):
+    # Single observer notifying observers_arg (None when there is nothing to notify)
+    observers = [o for o in observers_arg if o is not None]
+    if len(observers) == 0:
+        return None
+    if len(observers) == 1:
+        return observers[0]
+    return ObserverGroup(observers)
+
+
+class ProgressObserver(RunObserver):
+    # Progress bar over total_arg simulated days, redrawn at most every interval_arg seconds (and when complete)
+
+    def __init__(self, total_arg, interval_arg=DEFAULT_PROGRESS_INTERVAL):
+        self.total = total_arg
+        self.interval = interval_arg
+        self.done = 0
+        self.last_draw = None
+
+    def advance(self, n_arg=1):
+        self.done = self.done + n_arg
+        now = time.monotonic()
+        if self.done >= self.total or self.last_draw is None or now - self.last_draw >= self.interval:
+            self.last_draw = now
+            print_progress_bar(min(self.done, self.total), self.total, prefix='Progress:', suffix='Complete',
+                               length=50)
+
+    def on_day_end(self, run_arg, day_arg, row_arg):
+        self.advance()
+
+    def on_days_end(self, runs_arg, days_arg, rows_arg):
+        self.advance(len(rows_arg))
+
@@ -1,5 +1,16 @@
 # Default parameters
 nrun_key = "NRUN"
+njob_key = "N_JOBS"
+seed_key = "SEED"
+batch_key = "BATCH_RUNS"
+env_cache_key = "ENV_CACHE_DIR"
+env_cache_size_key = "ENV_CACHE_SIZE_MB"
+mmap_dir_key = "MMAP_DIR"
+profile_key = "PROFILE_FILE"
+engine_key = "ENGINE"
+# Engines running the propagation steps (see kernel_helper and sparse_helper)
+array_engine = "array"
+sparse_engine = "sparse"
 
 nindividual_key = "N_INDIVIDUALS"
 nday_key = "N_DAYS"
@@ -16,6 +27,7 @@ house_infect_key = "PROB_HOUSE_INFECTION"
 work_infection_key = "PROB_WORK_INFECTION"
 store_infection_key = "PROB_STORE_INFECTION"
 transport_infection_key = "PROB_TRANSPORT_INFECTION"
+transport_exact_key = "TRANSPORT_EXACT"
 # Bounds
 contagion_bounds_key = "CONTAGION_BOUNDS"
 hospitalization_bounds_key = "HOSPITALIZATION_BOUNDS"
@@ -24,6 +36,14 @@ immunity_bounds_key = "IMMUNITY_BOUNDS"
 
 params = {
     nrun_key: 1,  # Number of runs
+    njob_key: 1,  # Number of worker processes running the simulations
+    seed_key: None,  # Seed of the random streams, a seeded launch always gives the same results
+    batch_key: False,  # All the runs advanced together in the same arrays instead of one after the other
+    env_cache_key: None,  # Directory where built environments are kept and reused (no cache if None)
+    env_cache_size_key: 1024,  # Size of the environment cache in MB, least recently used ones are removed beyond
+    mmap_dir_key: None,  # Directory of the memory mapped environment and population states (in memory if None)
+    profile_key: None,  # File receiving the time and counters of each phase of each day (no profiling if None)
+    engine_key: array_engine,  # Propagation through group members arrays, or sparse incidence matrix products
     nindividual_key: 1000,  # Number of people
     nday_key: 180,  # Number of simulated days
     innoculation_pct_key: 0.005,  # Proportion of people innoculated at day 0
@@ -38,9 +58,14 @@ params = {
     work_infection_key: 0.1,  # Probabilty of infecting a random co-worker
     store_infection_key: 0.05,  # Probabilty of infecting someone who goes to the same store
     transport_infection_key: 0.05,  # Probabilty of infecting someone who goes to the same geographical block
+    transport_exact_key: False,  # One transport draw per exposed person instead of one per infected block
 
     contagion_bounds_key: (2, 7),  # Bounds defining a draw for contagion period
     hospitalization_bounds_key: (14, 20),  # Bounds defining a draw for hospitalization period
     death_bounds_key: (21, 39),  # Bounds defining a draw for time to death/immunity
     immunity_bounds_key: (600, 900)  # Bounds defining a draw for immunity period
 }
+
+# Parameters the environment is built from, the others only drive the simulation
+environment_keys = (nindividual_key, same_house_p_key, store_per_house_key, store_preference_key, nb_block_key,
+                    remote_work_key)
@@ -2,26 +2,53 @@ import matplotlib.pyplot as plt
 import numpy as np
 from scipy import stats
 
+# Beyond this number of days, series are drawn as areas and lines instead of one bar per day
+MAX_BAR_DAYS = 200
 
-def draw_population_state_daily(stats_arg, x_tick=10):
+# (stats column, color, name) of each population state, in their stacking order
+DEAD_STATE = (3, "#151515", "Dead")
+HEALTHY_STATE = (0, "#3F88C5", "Healthy")
+INFECTED_STATE = (1, "#A63D40", "Infected")
+HOSPITALIZED_STATE = (2, "#5000FA", "Hospitalized")
+IMMUNE_STATE = (4, "#90A959", "Immune")
+STACKED_STATES = (DEAD_STATE, HEALTHY_STATE, INFECTED_STATE, HOSPITALIZED_STATE, IMMUNE_STATE)
+STYLE_STATES = {'H': HEALTHY_STATE, 'I': INFECTED_STATE, 'P': HOSPITALIZED_STATE, 'D': DEAD_STATE, 'M': IMMUNE_STATE}
+NEW_CASES_COLUMN = 5
+
+
+def use_headless_backend():
+    # Non interactive backend, figures can only be saved (no display needed)
+    plt.switch_backend('Agg')
+
+
+def show_or_save(fig, output_arg=None):
+    # Shows the figure, or saves it to output_arg (format given by its extension, e.g. .png or .svg)
+    if output_arg is None:
+        plt.show()
+    else:
+        fig.savefig(output_arg)
+        plt.close(fig)
+
+
+def draw_population_state_daily(stats_arg, x_tick=10, output=None):
     fig, ax = plt.subplots(figsize=(15, 10))
     set_ax_population_state_daily(ax, stats_arg, x_tick)
-    plt.show()
+    show_or_save(fig, output)
 
 
-def draw_specific_population_state_daily(stats_arg, x_tick=10, style="P"):
+def draw_specific_population_state_daily(stats_arg, x_tick=10, style="P", output=None):
     fig, ax = plt.subplots(figsize=(15, 10))
     set_ax_specific_population_state_daily(ax, stats_arg, x_tick, style)
-    plt.show()
+    show_or_save(fig, output)
 
 
-def draw_new_daily_cases(stats_arg, x_tick=10):
+def draw_new_daily_cases(stats_arg, x_tick=10, output=None):
     fig, ax = plt.subplots(figsize=(15, 10))
     set_ax_new_daily_cases(ax, stats_arg, x_tick)
-    plt.show()
+    show_or_save(fig, output)
 
 
-def draw_summary(stats_arg, x_tick=10):
+def draw_summary(stats_arg, x_tick=10, output=None):
     fig, (ax1, ax2, ax3) = plt.subplots(3, 1, figsize=(16, 10))
     set_ax_population_state_daily(ax1, stats_arg, x_tick)
     set_ax_new_daily_cases(ax2, stats_arg, x_tick)
@@ -30,7 +57,7 @@ def draw_summary(stats_arg, x_tick=10):
     ax2.set_xlabel('')
     ax2.set_title('')
     ax3.set_title('')
-    plt.show()
+    show_or_save(fig, output)
 
 
 # Print iterations progress
@@ -57,102 +84,70 @@ def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, lengt
         print()
 
 
+def set_day_ticks(ax, n_day_arg, x_tick=10):
+    ticks = np.arange(0, n_day_arg, max(1, n_day_arg // x_tick))
+    ax.set_xticks(ticks)
+    ax.set_xticklabels([str(t) for t in ticks])
+
+
 def set_ax_population_state_daily(ax, stats_arg, x_tick=10):
     n_day_arg = stats_arg.shape[1]
     n_individual_arg = 1.1*np.max(stats_arg)
     stats_mean_arg = np.mean(stats_arg, axis=0)
-    dead_serie = [stats_mean_arg[i][3] for i in range(n_day_arg)]
-
-    healthy_serie = [stats_mean_arg[i][0] for i in range(n_day_arg)]
-
-    infected_serie = [stats_mean_arg[i][1] for i in range(n_day_arg)]
-    infected_serie_stacked = [stats_mean_arg[i][0] + stats_mean_arg[i][3] for i in range(n_day_arg)]
-
-    hospital_serie = [stats_mean_arg[i][2] for i in range(n_day_arg)]
-    hospital_serie_stacked = [stats_mean_arg[i][0] + stats_mean_arg[i][1] + stats_mean_arg[i][3] for i in range(n_day_arg)]
-
-    immune_serie = [stats_mean_arg[i][4] for i in range(n_day_arg)]
-    immune_serie_stacked = [stats_mean_arg[i][0] + stats_mean_arg[i][1] + stats_mean_arg[i][2] + stats_mean_arg[i][3]
-                            for i in range(n_day_arg)]
-
+    # (n_state, n_day) series and the bottom of each one once stacked
+    series = stats_mean_arg[:, [column for column, _, _ in STACKED_STATES]].T
+    colors = [color for _, color, _ in STACKED_STATES]
     indices = np.arange(n_day_arg)
-    width = 0.7
 
-    p1 = ax.bar(indices, dead_serie, width, color="#151515")
-    p2 = ax.bar(indices, healthy_serie, width, bottom=dead_serie, color="#3F88C5")
-    p3 = ax.bar(indices, infected_serie, width, bottom=infected_serie_stacked, color="#A63D40")
-    p4 = ax.bar(indices, hospital_serie, width, bottom=hospital_serie_stacked, color="#5000FA")
-    p5 = ax.bar(indices, immune_serie, width, bottom=immune_serie_stacked, color="#90A959")
+    if n_day_arg > MAX_BAR_DAYS:
+        handles = ax.stackplot(indices, series, colors=colors)
+    else:
+        bottoms = np.cumsum(series, axis=0) - series
+        handles = [ax.bar(indices, serie, 0.7, bottom=bottom, color=color)[0]
+                   for serie, bottom, color in zip(series, bottoms, colors)]
 
     ax.set_ylabel('Total population')
     ax.set_xlabel('Days since innoculation')
     ax.set_title('Pandemic evolution')
-    ax.set_xticks(np.arange(0, n_day_arg, int(n_day_arg / x_tick)), tuple([(str(int(i * n_day_arg / x_tick)))
-                                                                           for i in range(x_tick)]))
+    set_day_ticks(ax, n_day_arg, x_tick)
     ax.set_yticks(np.arange(0, n_individual_arg, (n_individual_arg/15)))
-    ax.legend((p1[0], p2[0], p3[0], p4[0], p5[0]), ('Dead', 'Healthy', 'Infected', 'Hospitalized', 'Immune'))
+    ax.legend(handles, [name for _, _, name in STACKED_STATES])
 
 
-def set_ax_specific_population_state_daily(ax, stats_arg, x_tick=10, style="P"):
+def set_ax_daily_serie(ax, stats_arg, column_arg, color_arg):
+    # Mean over the runs of a stats column, with its standard error as error bars (or band)
     n_day_arg = stats_arg.shape[1]
-    type_state = 0
-    plot_color = "#3F88C5"
-    name_state = "Healthy"
-    if style == 'I':
-        type_state = 1
-        plot_color = "#A63D40"
-        name_state = "Infected"
-    if style == 'P':
-        type_state = 2
-        plot_color = "#5000FA"
-        name_state = "Hospitalized"
-    if style == 'D':
-        type_state = 3
-        plot_color = "#151515"
-        name_state = "Dead"
-    if style == 'M':
-        type_state = 4
-        plot_color = "#90A959"
-        name_state = "Immune"
-
-    stats_mean_arg = np.mean(stats_arg, axis=0)
-    stats_err_arg = stats.sem(stats_arg, axis=0)
-    serie = [stats_mean_arg[i][type_state] for i in range(n_day_arg)]
-    err = [stats_err_arg[i][type_state] for i in range(n_day_arg)]
+    serie = np.mean(stats_arg[:, :, column_arg], axis=0)
+    # No error with a single run
+    err = stats.sem(stats_arg[:, :, column_arg], axis=0) if stats_arg.shape[0] > 1 else np.zeros(n_day_arg)
     indices = np.arange(n_day_arg)
-    width = 0.6
+    if n_day_arg > MAX_BAR_DAYS:
+        ax.fill_between(indices, serie - err, serie + err, alpha=0.3, color="#808080")
+        handle = ax.plot(indices, serie, color=color_arg)[0]
+    else:
+        handle = ax.bar(indices, serie, 0.6, yerr=err, align='center', alpha=0.5, ecolor="#808080",
+                        color=color_arg)[0]
+    return serie, handle
 
-    p = ax.bar(indices, serie, width, yerr=err, align='center', alpha=0.5, ecolor="#808080", color=plot_color)
+
+def set_ax_specific_population_state_daily(ax, stats_arg, x_tick=10, style="P"):
+    type_state, plot_color, name_state = STYLE_STATES.get(style, HEALTHY_STATE)
+    serie, handle = set_ax_daily_serie(ax, stats_arg, type_state, plot_color)
 
     ax.set_ylabel(name_state + " population")
     ax.set_xlabel('Days since innoculation')
     ax.set_title('Pandemic evolution')
-
-    ax.set_xticks(np.arange(0, n_day_arg, int(n_day_arg / x_tick)), tuple([(str(int(i * n_day_arg / x_tick)))
-                                                                           for i in range(x_tick)]))
+    set_day_ticks(ax, stats_arg.shape[1], x_tick)
     ax.set_yticks(np.arange(0, int(max(serie)*1.1), int(1+max(serie)/10)))
-    ax.legend((p[0],), (name_state, ))
+    ax.legend((handle,), (name_state, ))
 
 
 def set_ax_new_daily_cases(ax, stats_arg, x_tick=10):
-    n_day_arg = stats_arg.shape[1]
-    stats_mean_arg = np.mean(stats_arg, axis=0)
-    stats_err_arg = stats.sem(stats_arg, axis=0)
-    new_cases_serie = [stats_mean_arg[i][5] for i in range(n_day_arg)]
-    err = [stats_err_arg[i][5] for i in range(n_day_arg)]
-
-    indices = np.arange(n_day_arg)
-    width = 0.6
-
-    p1 = ax.bar(indices, new_cases_serie, width, yerr=err, align='center', alpha=0.5, ecolor="#808080", color="#44A1A0")
+    new_cases_serie, handle = set_ax_daily_serie(ax, stats_arg, NEW_CASES_COLUMN, "#44A1A0")
 
     ax.set_ylabel('New cases')
     ax.set_xlabel('Days since innoculation')
     ax.set_title('New infected cases evolution')
-    ax.set_xticks(np.arange(0, n_day_arg, int(n_day_arg / x_tick)), tuple([(str(int(i * n_day_arg / x_tick)))
-                                                                           for i in range(x_tick)]))
-    ax.set_yticks(np.arange(0, int(max(new_cases_serie) * 1.1), int(max(new_cases_serie) / 10)))
-    ax.legend((p1[0],), ('New cases',))
-
-
-
+    set_day_ticks(ax, stats_arg.shape[1], x_tick)
+    ax.set_yticks(np.arange(0, int(max(new_cases_serie) * 1.1), int(1 + max(new_cases_serie) / 10)))
+    ax.legend((handle,), ('New cases',))
@@ -0,0 +1,98 @@
+import contextlib
+import csv
+import json
+import time
+
+from simulator.keys import *
+
+# Phases of a simulated day
+HOUSES_PHASE = 'houses'
+TRANSPORT_PHASE = 'transport'
+WORK_PHASE = 'work'
+STORES_PHASE = 'stores'
+PROGRESSION_PHASE = 'progression'
+# Daily statistics handed to the stats sink
+STATS_PHASE = 'stats'
+# Initial population of a run (day -1)
+POPULATION_PHASE = 'population'
+# Environment (run and day -1), built or read back, then the building steps when it is built
+ENVIRONMENT_PHASE = 'environment'
+ENV_INDIVIDUALS_PHASE = 'env_individuals'
+ENV_GROUPS_PHASE = 'env_groups'
+ENV_GEOGRAPHY_PHASE = 'env_geography'
+ENV_STORES_PHASE = 'env_stores'
+ENV_TRANSPORT_PHASE = 'env_transport'
+
+# exposures : infection draws made by the propagation steps (array and sparse engines)
+# draws : uniforms taken from the random stream (BlockRandom streams only)
+# new_infections : healthy people infected during the phase
+PROFILE_COLUMNS = ('run', 'day', 'phase', 'seconds', 'exposures', 'draws', 'new_infections')
+
+# Shared by every phase when profiling is disabled, entering it costs next to nothing
+NO_PROFILE = contextlib.nullcontext()
+
+
+def get_profile_counters(virus_dic, rng):
+    # (exposures, draws, new infections) counted so far, 0 when the objects do not keep count
+    if rng is None:
+        rng = getattr(virus_dic, 'rng', None)
+    return (getattr(virus_dic, 'exposures', 0), getattr(rng, 'draws', 0),
+            virus_dic[NC_K] if virus_dic is not None else 0)
+
+
+class Profiler:
+    # Wall time and counters of each phase of each day of each run, one row per phase
+    # Runs are numbered as in the stats, -1 stands for the environment or for all the batched runs
+
+    def __init__(self):
+        self.rows = []
+        self.run = -1
+        self.day = -1
+
+    def set_day(self, run_arg, day_arg):
+        self.run = run_arg
+        self.day = day_arg
+
+    @contextlib.contextmanager
+    def phase(self, phase_arg, virus_dic=None, rng=None):
+        counters = get_profile_counters(virus_dic, rng)
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        self.rows.append((self.run, self.day, phase_arg, seconds) +
+                         tuple(after - before for after, before in zip(get_profile_counters(virus_dic, rng),
+                                                                         counters)))
+
+    def get_summary(self):
+        # Phase -> totals over every row of the phase, in the order phases first appeared
+        summary = {}
+        for run, day, phase, seconds, exposures, draws, new_infections in self.rows:
+            totals = summary.setdefault(phase, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'exposures': 0,
+                                                'draws': 0, 'new_infections': 0})
+            totals['calls'] += 1
+            totals['seconds'] += seconds
+            totals['max_seconds'] = max(totals['max_seconds'], seconds)
+            totals['exposures'] += exposures
+            totals['draws'] += draws
+            totals['new_infections'] += new_infections
+        for totals in summary.values():
+            totals['mean_seconds'] = totals['seconds'] / totals['calls']
+        return summary
+
+    def save(self, path_arg):
+        # CSV of the rows for .csv files, JSON of the per phase summary and of the rows otherwise
+        if path_arg.endswith('.csv'):
+            with open(path_arg, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(PROFILE_COLUMNS)
+                writer.writerows(self.rows)
+        else:
+            with open(path_arg, 'w') as f:
+                json.dump({'phases': self.get_summary(), 'columns': PROFILE_COLUMNS, 'rows': self.rows}, f)
+
+
+def profile_phase(profiler_arg, phase_arg, virus_dic=None, rng=None):
+    # Context timing a phase when profiling (counters are read from virus_dic and rng, or virus_dic.rng)
+    if profiler_arg is None:
+        return NO_PROFILE
+    return profiler_arg.phase(phase_arg, virus_dic, rng)
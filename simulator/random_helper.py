@@ -0,0 +1,49 @@
+import numpy as np
+
+# Number of uniforms drawn at once by a BlockRandom
+DEFAULT_BLOCK_SIZE = 1 << 16
+
+
+class BlockRandom:
+    # Uniform [0, 1) draws handed out from blocks pre-drawn by a numpy generator
+    # Draws come in the generator order whatever their chunking: random(2) then random(3) is random(5)
+
+    def __init__(self, generator, block_size=DEFAULT_BLOCK_SIZE):
+        self.generator = generator
+        self.block_size = block_size
+        self.block = np.empty(0)
+        self.position = 0
+        # Number of uniforms handed out so far
+        self.draws = 0
+
+    def random(self, n=None):
+        if n is None:
+            return float(self.random(1)[0])
+        n = int(n)
+        if self.position + n > len(self.block):
+            rest = self.block[self.position:]
+            self.block = np.concatenate((rest, self.generator.random(max(self.block_size, n - len(rest)))))
+            # Draws are read only views of the block
+            self.block.flags.writeable = False
+            self.position = 0
+        draws = self.block[self.position:self.position + n]
+        self.position += n
+        self.draws += n
+        return draws
+
+
+def get_seed_sequence(seed_arg=None):
+    # Root of all the random streams of a launch, fresh entropy when no seed is given
+    return np.random.SeedSequence(seed_arg)
+
+
+def get_child_seed_sequence(seed_sequence_arg, stream_arg):
+    # Same as seed_sequence_arg.spawn(n)[stream_arg], without spawning the previous ones
+    # so that any process can build the stream of a given run
+    return np.random.SeedSequence(seed_sequence_arg.entropy,
+                                  spawn_key=tuple(seed_sequence_arg.spawn_key) + (stream_arg,))
+
+
+def get_random_stream(seed_sequence_arg, stream_arg):
+    return BlockRandom(np.random.default_rng(get_child_seed_sequence(seed_sequence_arg, stream_arg)))
+
@@ -1,58 +1,280 @@
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
 import numpy as np
 
+from simulator.cache_helper import get_cached_environment
 from simulator.dynamic_helper import propagate_to_stores, propagate_to_houses, propagate_to_workplaces, \
-    increment_pandemic_1_day, is_weekend, get_pandemic_statistics, propagate_to_transportation
+    increment_pandemic_1_day, is_weekend, get_pandemic_statistics, propagate_to_transportation, get_replica_statistics
 from simulator.parameters import *
-from simulator.plot_helper import draw_new_daily_cases, draw_population_state_daily, print_progress_bar, \
-    draw_specific_population_state_daily, draw_summary
-from simulator.run_helper import get_parser
-from simulator.simulation_helper import get_environment_simulation, get_virus_simulation_t0
+from simulator.profile_helper import Profiler, profile_phase, HOUSES_PHASE, TRANSPORT_PHASE, WORK_PHASE, \
+    STORES_PHASE, PROGRESSION_PHASE, STATS_PHASE, POPULATION_PHASE, ENVIRONMENT_PHASE
+from simulator.random_helper import get_seed_sequence, get_random_stream
+from simulator.observer_helper import ProgressObserver, get_observer
+from simulator.plot_helper import draw_new_daily_cases, draw_population_state_daily, \
+    draw_specific_population_state_daily, draw_summary, use_headless_backend
+from simulator.run_helper import get_parser, check_store_params
+from simulator.simulation_helper import get_environment_simulation_arrays, get_virus_state_t0, \
+    get_replicated_environment
+from simulator.sparse_helper import get_sparse_environment
+from simulator.stats_helper import MemoryStatsSink, get_stats_sink, read_stats
+from simulator.store_helper import get_stored_environment
+
+
+# Environment, seed and stats array of the parallel runs, set before the worker processes are forked
+# so that they inherit them instead of receiving a pickled copy per task
+# Random streams : 0 builds the environment, r + 1 drives the run r whatever the process running it
+# (batched runs all draw from stream 1)
+shared_run_dic = {}
+# Seconds the parent process waits for a run to complete before looking for runs started by the workers
+RUN_START_POLL_SECONDS = 0.1
+
+
+def get_run_store_dir(run_arg):
+    # Memory mapped VirusState arrays of the run (None when everything stays in memory)
+    if params[mmap_dir_key] is None:
+        return None
+    return os.path.join(params[mmap_dir_key], 'run_%d' % run_arg)
+
+
+def run_simulation(env_dic, stats_sink_arg, run_arg, rng_arg, observer_arg=None, store_dir_arg=None,
+                   profiler_arg=None):
+    # One simulation whose daily statistics are streamed to stats_sink_arg and handed to observer_arg
+    if observer_arg is not None:
+        observer_arg.on_run_start(run_arg)
+    if profiler_arg is not None:
+        profiler_arg.set_day(run_arg, -1)
+    with profile_phase(profiler_arg, POPULATION_PHASE, rng=rng_arg):
+        virus_dic = get_virus_state_t0(params[nindividual_key], params[innoculation_pct_key],
+                                       params[contagion_bounds_key], params[hospitalization_bounds_key],
+                                       params[death_bounds_key], params[immunity_bounds_key], rng=rng_arg,
+                                       store_dir_arg=store_dir_arg)
+    for i in range(params[nday_key]):
+        if profiler_arg is not None:
+            profiler_arg.set_day(run_arg, i)
+        simulate_day(env_dic, virus_dic, i, profiler_arg)
+        with profile_phase(profiler_arg, STATS_PHASE):
+            run_stats = get_pandemic_statistics(virus_dic)
+            stats_sink_arg.write(run_arg, i, run_stats)
+            if observer_arg is not None:
+                observer_arg.on_day_end(run_arg, i, run_stats)
+    if observer_arg is not None:
+        observer_arg.on_run_end(run_arg)
+
+
+def simulate_day(env_dic, virus_dic, day_arg, profiler_arg=None):
+    with profile_phase(profiler_arg, HOUSES_PHASE, virus_dic):
+        propagate_to_houses(env_dic, virus_dic, params[house_infect_key])
+    if not is_weekend(day_arg):
+        with profile_phase(profiler_arg, TRANSPORT_PHASE, virus_dic):
+            propagate_to_transportation(env_dic, virus_dic, params[transport_infection_key],
+                                        params[transport_exact_key])
+        with profile_phase(profiler_arg, WORK_PHASE, virus_dic):
+            propagate_to_workplaces(env_dic, virus_dic, params[work_infection_key])
+    if is_weekend(day_arg):
+        with profile_phase(profiler_arg, STORES_PHASE, virus_dic):
+            propagate_to_stores(env_dic, virus_dic, params[store_infection_key])
+    with profile_phase(profiler_arg, PROGRESSION_PHASE, virus_dic):
+        increment_pandemic_1_day(env_dic, virus_dic)
+
+
+def run_batched_simulation(env_dic, stats_sink_arg, rng_arg, observer_arg=None, profiler_arg=None):
+    # All the runs advanced together : individual i of run r is r * N + i in a single VirusState
+    # over a replicated environment, so every step goes through the whole ensemble at once
+    # (profiled as run -1, observed one day of every run at a time)
+    runs = list(range(params[nrun_key]))
+    if observer_arg is not None:
+        for r in runs:
+            observer_arg.on_run_start(r)
+    with profile_phase(profiler_arg, POPULATION_PHASE, rng=rng_arg):
+        virus_dic = get_virus_state_t0(params[nindividual_key], params[innoculation_pct_key],
+                                       params[contagion_bounds_key], params[hospitalization_bounds_key],
+                                       params[death_bounds_key], params[immunity_bounds_key], rng=rng_arg,
+                                       n_replicas_arg=params[nrun_key])
+        replicated_env_dic = get_engine_environment(get_replicated_environment(env_dic, params[nrun_key]))
+    for i in range(params[nday_key]):
+        if profiler_arg is not None:
+            profiler_arg.set_day(-1, i)
+        simulate_day(replicated_env_dic, virus_dic, i, profiler_arg)
+        with profile_phase(profiler_arg, STATS_PHASE):
+            runs_stats = get_replica_statistics(virus_dic).tolist()
+            for r, run_stats in zip(runs, runs_stats):
+                stats_sink_arg.write(r, i, run_stats)
+            if observer_arg is not None:
+                observer_arg.on_days_end(runs, [i] * len(runs), runs_stats)
+    if observer_arg is not None:
+        for r in runs:
+            observer_arg.on_run_end(r)
+
+
+def run_simulation_worker(run_arg):
+    # The start of the run is sent to the parent process right away when it is observed,
+    # its profile rows go back with its id once it is over
+    if shared_run_dic['run_starts'] is not None:
+        shared_run_dic['run_starts'].put(run_arg)
+    profiler = Profiler() if shared_run_dic['profile'] else None
+    run_simulation(shared_run_dic['env'], MemoryStatsSink(shared_run_dic['stats']), run_arg,
+                   get_random_stream(shared_run_dic['seed'], run_arg + 1), store_dir_arg=get_run_store_dir(run_arg),
+                   profiler_arg=profiler)
+    return run_arg, profiler.rows if profiler is not None else None
+
 
+def notify_run_starts(observer_arg, started_arg, run_arg=None):
+    # Hands the runs started by the workers to observer_arg, waiting for the start of run_arg when given
+    run_starts = shared_run_dic['run_starts']
+    while not run_starts.empty() or (run_arg is not None and run_arg not in started_arg):
+        r = run_starts.get()
+        started_arg.add(r)
+        observer_arg.on_run_start(r)
 
-def launch_run():
+
+def get_next_parallel_run(results_arg, observer_arg, started_arg):
+    # (run, profile rows) of the next completed run, observer_arg being told about the runs started meanwhile
+    if observer_arg is None:
+        return results_arg.next()
+    while True:
+        notify_run_starts(observer_arg, started_arg)
+        try:
+            r, profile_rows = results_arg.next(timeout=RUN_START_POLL_SECONDS)
+        except multiprocessing.TimeoutError:
+            continue
+        notify_run_starts(observer_arg, started_arg, r)
+        return r, profile_rows
+
+
+def launch_parallel_runs(env_dic, seed_sequence_arg, stats_sink_arg, observer_arg=None, profiler_arg=None):
+    # Runs are spread over a pool of forked processes, each one writing its row of a shared memory stats array
+    # handed over to stats_sink_arg and observer_arg as soon as the run is over
+    # observer_arg gets on_run_start when a worker starts the run, but its days only once the run is over
+    context = multiprocessing.get_context('fork')
+    stats_shape = (params[nrun_key], params[nday_key], 6)
+    stats_memory = shared_memory.SharedMemory(create=True, size=int(np.prod(stats_shape)) * 8)
+    try:
+        shared_run_dic['env'] = env_dic
+        shared_run_dic['seed'] = seed_sequence_arg
+        shared_run_dic['stats'] = np.ndarray(stats_shape, dtype=np.float64, buffer=stats_memory.buf)
+        shared_run_dic['stats'][:] = 0
+        shared_run_dic['profile'] = profiler_arg is not None
+        shared_run_dic['run_starts'] = context.SimpleQueue() if observer_arg is not None else None
+        started = set()
+        days = list(range(params[nday_key]))
+        with context.Pool(params[njob_key]) as pool:
+            results = pool.imap_unordered(run_simulation_worker, range(params[nrun_key]))
+            for _ in range(params[nrun_key]):
+                r, profile_rows = get_next_parallel_run(results, observer_arg, started)
+                if profiler_arg is not None:
+                    profiler_arg.rows.extend(profile_rows)
+                runs_stats = shared_run_dic['stats'][r].astype(np.int64).tolist()
+                for i, run_stats in zip(days, runs_stats):
+                    stats_sink_arg.write(r, i, run_stats)
+                stats_sink_arg.flush()
+                if observer_arg is not None:
+                    observer_arg.on_days_end([r] * len(days), days, runs_stats)
+                    observer_arg.on_run_end(r)
+    finally:
+        if shared_run_dic.get('run_starts') is not None:
+            shared_run_dic['run_starts'].close()
+        shared_run_dic.clear()
+        stats_memory.close()
+        stats_memory.unlink()
+
+
+def get_environment(seed_sequence_arg, profiler_arg=None):
+    def build_environment(store_dir_arg=None):
+        return get_environment_simulation_arrays(params[nindividual_key], params[same_house_p_key],
+                                                 params[store_per_house_key], params[store_preference_key],
+                                                 params[nb_block_key], params[remote_work_key],
+                                                 rng=get_random_stream(seed_sequence_arg, 0), profiler_arg=profiler_arg,
+                                                 store_dir_arg=store_dir_arg)
+
+    # Without seed, the environment cached for these parameters is reused whatever its seed was
+    environment_params = {k: params[k] for k in environment_keys}
+    with profile_phase(profiler_arg, ENVIRONMENT_PHASE):
+        if params[mmap_dir_key] is not None:
+            # The environment is read from memory mapped files, built straight into them only when
+            # they hold another environment
+            return get_stored_environment(os.path.join(params[mmap_dir_key], 'env'), environment_params,
+                                          params[seed_key], build_environment, params[env_cache_key],
+                                          params[env_cache_size_key])
+        if params[env_cache_key] is not None:
+            return get_cached_environment(params[env_cache_key], params[env_cache_size_key], environment_params,
+                                          params[seed_key], build_environment)
+        return build_environment()
+
+
+def get_engine_environment(env_dic):
+    # Array environment as used by the engine chosen in the parameters
+    if params[engine_key] == sparse_engine:
+        return get_sparse_environment(env_dic)
+    return env_dic
+
+
+def launch_run(stats_sink_arg=None, profiler_arg=None, observers_arg=None):
+    # Statistics are streamed to stats_sink_arg, and returned as a (nrun, nday, 6) array if it can give them back
+    # Phases are profiled into profiler_arg, or into a profile saved to the PROFILE_FILE parameter
+    # observers_arg (see RunObserver) follow the runs, a progress bar by default
+    check_store_params(params)
+    if stats_sink_arg is None:
+        stats_sink_arg = MemoryStatsSink(np.zeros((params[nrun_key], params[nday_key], 6)))
+    if observers_arg is None:
+        observers_arg = [ProgressObserver(params[nrun_key] * params[nday_key])]
+    observer = get_observer(observers_arg)
+    if profiler_arg is None and params[profile_key] is not None:
+        profiler_arg = Profiler()
+    seed_sequence = get_seed_sequence(params[seed_key])
     print('Preparing environment...')
-    env_dic = get_environment_simulation(params[nindividual_key], params[same_house_p_key],
-                                         params[store_per_house_key], params[store_preference_key],
-                                         params[nb_block_key], params[remote_work_key])
-
-    stats = np.zeros((params[nrun_key], params[nday_key], 6))
-    print_progress_bar(0, params[nrun_key] * params[nday_key], prefix='Progress:', suffix='Complete', length=50)
-    for r in range(params[nrun_key]):
-        virus_dic = get_virus_simulation_t0(params[nindividual_key], params[innoculation_pct_key],
-                                            params[contagion_bounds_key], params[hospitalization_bounds_key],
-                                            params[death_bounds_key], params[immunity_bounds_key])
-        for i in range(params[nday_key]):
-            print_progress_bar(r * params[nday_key] + i + 1, params[nrun_key] * params[nday_key],
-                               prefix='Progress:', suffix='Complete', length=50)
-            propagate_to_houses(env_dic, virus_dic, params[house_infect_key])
-            if not is_weekend(i):
-                propagate_to_transportation(env_dic, virus_dic, params[transport_infection_key])
-                propagate_to_workplaces(env_dic, virus_dic, params[work_infection_key])
-            if is_weekend(i):
-                propagate_to_stores(env_dic, virus_dic, params[store_infection_key])
-            increment_pandemic_1_day(env_dic, virus_dic)
-            stats[r][i][0], stats[r][i][1], stats[r][i][2], stats[r][i][3], stats[r][i][4], stats[r][i][5] = \
-                get_pandemic_statistics(virus_dic)
-
-    return stats
+    env_dic = get_environment(seed_sequence, profiler_arg)
+
+    try:
+        if params[batch_key]:
+            run_batched_simulation(env_dic, stats_sink_arg, get_random_stream(seed_sequence, 1), observer,
+                                   profiler_arg=profiler_arg)
+        elif params[njob_key] > 1:
+            launch_parallel_runs(get_engine_environment(env_dic), seed_sequence, stats_sink_arg, observer,
+                                 profiler_arg)
+        else:
+            engine_env_dic = get_engine_environment(env_dic)
+            for r in range(params[nrun_key]):
+                run_simulation(engine_env_dic, stats_sink_arg, r, get_random_stream(seed_sequence, r + 1), observer,
+                               store_dir_arg=get_run_store_dir(r), profiler_arg=profiler_arg)
+                stats_sink_arg.flush()
+    finally:
+        stats_sink_arg.close()
+        if profiler_arg is not None and params[profile_key] is not None:
+            profiler_arg.save(params[profile_key])
+
+    return stats_sink_arg.get_stats()
 
 
 if __name__ == '__main__':
-    args = get_parser().parse_args()
+    parser = get_parser()
+    args = parser.parse_args()
     for arg in vars(args):
         v = getattr(args, arg)
         if arg in params and v is not None:
             params[arg] = v
+    try:
+        check_store_params(params)
+    except ValueError as e:
+        parser.error(str(e))
 
-    stats_result = launch_run()
+    if args.from_stats is not None:
+        stats_result = read_stats(args.from_stats)
+    elif args.stats_file is not None:
+        stats_result = launch_run(get_stats_sink(args.stats_file, params[nday_key]))
+    else:
+        stats_result = launch_run()
+    if args.output is not None:
+        use_headless_backend()
     if args.population_state:
-        draw_population_state_daily(stats_result)
+        draw_population_state_daily(stats_result, output=args.output)
     elif args.new_cases:
-        draw_new_daily_cases(stats_result)
+        draw_new_daily_cases(stats_result, output=args.output)
     elif args.hospitalized_cases:
-        draw_specific_population_state_daily(stats_result)
+        draw_specific_population_state_daily(stats_result, output=args.output)
     elif args.summary:
-        draw_summary(stats_result)
+        draw_summary(stats_result, output=args.output)
     else:
-        draw_population_state_daily(stats_result)
+        draw_population_state_daily(stats_result, output=args.output)
 
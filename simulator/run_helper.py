@@ -3,10 +3,23 @@ import argparse
 from simulator.parameters import *
 
 
-def get_parser():
+def get_parser(plot_arg=True):
     parser = argparse.ArgumentParser(description='Please feed model parameters')
 
     parser.add_argument('--nrun', type=int, help='Number of simulations', dest=nrun_key)
+    parser.add_argument('--jobs', type=int, help='Number of processes running the simulations', dest=njob_key)
+    parser.add_argument('--seed', type=int, help='Seed of the random number generators', dest=seed_key)
+    parser.add_argument('--batch', help='Advance all the simulations together in the same arrays',
+                        action='store_true', default=None, dest=batch_key)
+    parser.add_argument('--env-cache', type=str, help='Directory caching the built environments', dest=env_cache_key)
+    parser.add_argument('--env-cache-size', type=int, help='Size of the environment cache in MB',
+                        dest=env_cache_size_key)
+    parser.add_argument('--mmap-dir', type=str, help='Directory of the memory mapped environment and population '
+                                                     'states', dest=mmap_dir_key)
+    parser.add_argument('--engine', type=str, choices=(array_engine, sparse_engine),
+                        help='Propagation through group members arrays or sparse incidence matrices', dest=engine_key)
+    parser.add_argument('--profile', type=str, help='File receiving the time spent in each phase of each day '
+                                                    '(CSV if it ends with .csv, JSON otherwise)', dest=profile_key)
 
     parser.add_argument('--nind', type=int, help='Number of individuals', dest=nindividual_key)
     parser.add_argument('--nday', type=int, help='Number of days', dest=nday_key)
@@ -25,6 +38,11 @@ def get_parser():
     parser.add_argument('--p-house', type=float, help='Probability of house infection', dest=house_infect_key)
     parser.add_argument('--p-store', type=float, help='Probability of store infection', dest=store_infection_key)
     parser.add_argument('--p-work', type=float, help='Probability of workplace infection', dest=work_infection_key)
+    parser.add_argument('--p-transport', type=float, help='Probability of public transport infection',
+                        dest=transport_infection_key)
+    parser.add_argument('--transport-exact', help='Single transport draw per exposed person instead of one per '
+                                                  'infected block', action='store_true', default=None,
+                        dest=transport_exact_key)
 
     parser.add_argument('--contagion-bounds', type=int, nargs=2, help='Contagion bounds', dest=contagion_bounds_key)
     parser.add_argument('--hospitalization-bounds', type=int, nargs=2, help='Hospitalization bounds',
@@ -32,9 +50,30 @@ def get_parser():
     parser.add_argument('--death-bounds', type=int, nargs=2, help='Death bounds', dest=death_bounds_key)
     parser.add_argument('--immunity-bounds', type=int, nargs=2, help='Immunity bounds', dest=immunity_bounds_key)
 
+    parser.add_argument('--stats-file', type=str, help='File the daily statistics are streamed to (CSV if it ends with '
+                                                       '.csv, columnar binary otherwise)')
+    parser.add_argument('--from-stats', type=str, help='Draw the statistics of a streamed file instead of running '
+                                                       'simulations')
+
+    if not plot_arg:
+        return parser
     parser.add_argument('--population-state', '--pop', help='Draw population state graph', action='store_true')
     parser.add_argument('--hospitalized-cases', '--hos', help='Draw hospitalized cases graph', action='store_true')
     parser.add_argument('--new-cases', '--new', help='Draw new cases graph', action='store_true')
     parser.add_argument('--summary', '--sum', help='Draw a pandemic summary', action='store_true')
+    parser.add_argument('--output', type=str, help='Save the graph to this file (e.g. .png or .svg) instead of '
+                                                   'showing it, no display needed')
 
     return parser
+
+
+def check_store_params(params_arg):
+    # The memory mapped store holds the arrays of one run over one environment, the modes which would
+    # build in memory copies of them are rejected instead of silently bypassing it
+    if params_arg[mmap_dir_key] is None:
+        return
+    if params_arg[batch_key]:
+        raise ValueError('--mmap-dir cannot be used with --batch, whose replicated arrays are held in memory')
+    if params_arg[engine_key] == sparse_engine:
+        raise ValueError('--mmap-dir cannot be used with --engine sparse, whose incidence matrices are held in '
+                         'memory')
@@ -1,37 +1,58 @@
+import numpy as np
+
 from initiator.core import build_individual_houses_map, build_house_individual_map, build_individual_work_map, \
     build_individual_adult_map, build_workplace_individual_map, build_individual_age_map, build_house_adult_map, \
     build_house_store_map, build_store_house_map, \
     build_geo_positions_house, build_geo_positions_store, build_geo_positions_workplace, build_block_assignment, \
-    build_individual_workblock_map, build_workblock_individual_map, build_individual_individual_transport_map
-from initiator.helper import get_r, get_infection_parameters
+    build_individual_workblock_map, build_workblock_individual_map, build_individual_individual_transport_map, \
+    build_house_individual_csr, build_house_adult_csr, build_store_house_csr, build_workplace_individual_csr, \
+    build_individual_workblock_csr, build_workblock_individual_csr, build_individual_rate_array, \
+    build_individual_houses_array, build_individual_adult_array, build_individual_age_array, \
+    build_individual_work_array, build_geo_positions_house_array, build_geo_positions_store_array, \
+    build_geo_positions_workplace_array, build_block_assignment_array, build_house_store_array, \
+    build_individual_workblock_routes_csr
+from initiator.helper import get_r, get_infection_parameters, map_to_array, covid_hospitalization_rate_table, \
+    covid_mortality_rate_table, replicate_array, replicate_csr
 from simulator.keys import *
+from simulator.profile_helper import profile_phase, ENV_INDIVIDUALS_PHASE, ENV_GROUPS_PHASE, ENV_GEOGRAPHY_PHASE, \
+    ENV_STORES_PHASE, ENV_TRANSPORT_PHASE
+from simulator.random_helper import BlockRandom
+from simulator.store_helper import new_store_array, store_environment_array
+from simulator.virus_state import VirusState, draw_infection_periods, get_chunk_slices
 
 
 def get_environment_simulation(number_of_individuals_arg, same_house_rate_arg, number_store_per_house_arg,
-                               preference_store_arg, nb_block_arg, probability_remote_work_arg):
-    indiv_house = build_individual_houses_map(number_of_individuals_arg, same_house_rate_arg)
-    house_indiv = build_house_individual_map(indiv_house)
-    indiv_adult = build_individual_adult_map(indiv_house)
-    indiv_age = build_individual_age_map(indiv_house)
+                               preference_store_arg, nb_block_arg, probability_remote_work_arg, profiler_arg=None):
+    with profile_phase(profiler_arg, ENV_INDIVIDUALS_PHASE):
+        indiv_house = build_individual_houses_map(number_of_individuals_arg, same_house_rate_arg)
+        indiv_adult = build_individual_adult_map(indiv_house)
+        indiv_age = build_individual_age_map(indiv_house)
+        indiv_workplace = build_individual_work_map(indiv_adult, probability_remote_work_arg)
 
-    indiv_workplace = build_individual_work_map(indiv_adult, probability_remote_work_arg)
-    workplace_indiv = build_workplace_individual_map(indiv_workplace)
-    house_adult = build_house_adult_map(indiv_house, indiv_adult)
+    with profile_phase(profiler_arg, ENV_GROUPS_PHASE):
+        house_indiv = build_house_individual_map(indiv_house)
+        workplace_indiv = build_workplace_individual_map(indiv_workplace)
+        house_adult = build_house_adult_map(indiv_house, indiv_adult)
 
-    geo_house = build_geo_positions_house(len(house_indiv))
-    geo_workplace = build_geo_positions_workplace(len(workplace_indiv))
-    geo_store = build_geo_positions_store(int(len(house_indiv) / number_store_per_house_arg))
+    with profile_phase(profiler_arg, ENV_GEOGRAPHY_PHASE):
+        geo_house = build_geo_positions_house(len(house_indiv))
+        geo_workplace = build_geo_positions_workplace(len(workplace_indiv))
+        geo_store = build_geo_positions_store(int(len(house_indiv) / number_store_per_house_arg))
 
-    house_store = build_house_store_map(geo_store, geo_house, preference_store_arg)
-    store_house = build_store_house_map(house_store)
+    with profile_phase(profiler_arg, ENV_STORES_PHASE):
+        house_store = build_house_store_map(geo_store, geo_house, preference_store_arg)
+        store_house = build_store_house_map(house_store)
 
-    house_block = build_block_assignment(geo_house, nb_block_arg)
-    workplace_block = build_block_assignment(geo_workplace, nb_block_arg)
+    with profile_phase(profiler_arg, ENV_TRANSPORT_PHASE):
+        house_block = build_block_assignment(geo_house, nb_block_arg)
+        workplace_block = build_block_assignment(geo_workplace, nb_block_arg)
 
-    indiv_transport_block = build_individual_workblock_map(indiv_house, indiv_workplace, house_block, workplace_block)
-    transport_block_indiv = build_workblock_individual_map(indiv_transport_block)
+        indiv_transport_block = build_individual_workblock_map(indiv_house, indiv_workplace, house_block,
+                                                               workplace_block)
+        transport_block_indiv = build_workblock_individual_map(indiv_transport_block)
 
-    indiv_transport_indiv = build_individual_individual_transport_map(indiv_transport_block, transport_block_indiv)
+        indiv_transport_indiv = build_individual_individual_transport_map(indiv_transport_block,
+                                                                          transport_block_indiv)
 
     a = 1
     return {
@@ -48,6 +69,135 @@ def get_environment_simulation(number_of_individuals_arg, same_house_rate_arg, n
     }
 
 
+def get_environment_simulation_arrays(number_of_individuals_arg, same_house_rate_arg, number_store_per_house_arg,
+                                      preference_store_arg, nb_block_arg, probability_remote_work_arg, rng=None,
+                                      profiler_arg=None, store_dir_arg=None):
+    # Same environment as get_environment_simulation, stored as arrays (individual -> value)
+    # and CSR (offsets, indices) pairs (group -> members). The individual x individual
+    # transport map is replaced by the block <-> individual relations it is derived from
+    # With store_dir_arg, each array is written to the store as soon as it is built and read back
+    # from there by the next steps, so that the environment is never held in memory as a whole
+    rng = rng if rng is not None else BlockRandom(np.random.default_rng())
+    n = number_of_individuals_arg
+
+    def keep(k, v):
+        return store_environment_array(store_dir_arg, k, v)
+
+    with profile_phase(profiler_arg, ENV_INDIVIDUALS_PHASE, rng=rng):
+        indiv_house = keep(IH_K, build_individual_houses_array(n, same_house_rate_arg, rng))
+        indiv_adult = keep(IAD_K, build_individual_adult_array(indiv_house))
+        indiv_age = keep(IAG_K, build_individual_age_array(indiv_adult, rng))
+        indiv_workplace = keep(IW_K, build_individual_work_array(indiv_adult, probability_remote_work_arg, rng))
+        number_house = int(indiv_house.max()) + 1
+        number_workplace = int(indiv_workplace.max()) + 1
+
+    with profile_phase(profiler_arg, ENV_GROUPS_PHASE, rng=rng):
+        house_indiv = keep(HI_K, build_house_individual_csr(indiv_house, number_house))
+        house_adult = keep(HA_K, build_house_adult_csr(indiv_house, indiv_adult, number_house))
+        workplace_indiv = keep(WI_K, build_workplace_individual_csr(indiv_workplace, number_workplace))
+
+    with profile_phase(profiler_arg, ENV_GEOGRAPHY_PHASE, rng=rng):
+        geo_house = build_geo_positions_house_array(number_house, rng)
+        geo_workplace = build_geo_positions_workplace_array(number_workplace, rng)
+        geo_store = build_geo_positions_store_array(int(number_house / number_store_per_house_arg), rng)
+
+    with profile_phase(profiler_arg, ENV_STORES_PHASE, rng=rng):
+        house_store = keep(HS_K, build_house_store_array(geo_store, geo_house, preference_store_arg, rng))
+        store_house = keep(SH_K, build_store_house_csr(house_store, len(geo_store)))
+
+    with profile_phase(profiler_arg, ENV_TRANSPORT_PHASE, rng=rng):
+        house_block = build_block_assignment_array(geo_house, nb_block_arg)
+        workplace_block = build_block_assignment_array(geo_workplace, nb_block_arg)
+
+        indiv_transport_block = keep(IB_K, build_individual_workblock_routes_csr(indiv_house, indiv_workplace,
+                                                                                house_block, workplace_block,
+                                                                                nb_block_arg))
+        transport_block_indiv = keep(BI_K, build_workblock_individual_csr(indiv_transport_block, nb_block_arg))
+
+    return {
+        IH_K: indiv_house,
+        HI_K: house_indiv,
+        IAD_K: indiv_adult,
+        IAG_K: indiv_age,
+        IHR_K: keep(IHR_K, build_individual_rate_array(indiv_age, covid_hospitalization_rate_table)),
+        IMR_K: keep(IMR_K, build_individual_rate_array(indiv_age, covid_mortality_rate_table)),
+        IW_K: indiv_workplace,
+        WI_K: workplace_indiv,
+        HA_K: house_adult,
+        HS_K: house_store,
+        SH_K: store_house,
+        IB_K: indiv_transport_block,
+        BI_K: transport_block_indiv,
+    }
+
+
+def get_replicated_environment(env_dic, n_replicas_arg):
+    # Array environment holding n_replicas_arg copies of env_dic, individual i of replica r being r * N + i
+    # and every group (house, workplace, store, block) offset the same way, so that the propagation
+    # kernels advance every replica at once. Costs n_replicas_arg times the memory of env_dic
+    n = len(env_dic[IH_K])
+    number_house = len(env_dic[HI_K][0]) - 1
+    # Key -> number of rows of what its values point to
+    targets = {
+        IH_K: number_house,
+        HI_K: n,
+        IW_K: len(env_dic[WI_K][0]) - 1,
+        WI_K: n,
+        HA_K: n,
+        HS_K: len(env_dic[SH_K][0]) - 1,
+        SH_K: number_house,
+        IB_K: len(env_dic[BI_K][0]) - 1,
+        BI_K: n,
+    }
+    replicated_env_dic = {}
+    for k, v in env_dic.items():
+        if isinstance(v, tuple):
+            replicated_env_dic[k] = replicate_csr(v, n_replicas_arg, targets[k])
+        elif k in targets:
+            replicated_env_dic[k] = replicate_array(v, n_replicas_arg, targets[k])
+        else:
+            replicated_env_dic[k] = np.tile(v, n_replicas_arg)
+    return replicated_env_dic
+
+
+def is_array_environment(env_dic):
+    return isinstance(env_dic[IH_K], np.ndarray)
+
+
+def to_array_environment(env_dic):
+    # Converts a dictionary environment (as returned by get_environment_simulation) to the array layout
+    # Without block information, each commuter i is given a pseudo block holding ITI_K[i]
+    n = len(env_dic[IH_K])
+    indiv_house = map_to_array(env_dic[IH_K], n)
+    indiv_adult = map_to_array(env_dic[IAD_K], n).astype(np.int8)
+    indiv_workplace = map_to_array(env_dic[IW_K], n)
+    indiv_age = map_to_array(env_dic[IAG_K], n).astype(np.int16)
+    number_house = int(indiv_house.max()) + 1
+    house_store = map_to_array(env_dic[HS_K], number_house)
+    if IB_K in env_dic:
+        indiv_transport_block, transport_block_indiv = env_dic[IB_K], env_dic[BI_K]
+    else:
+        commuters = sorted(env_dic.get(ITI_K, {}).keys())
+        indiv_transport_block = build_individual_workblock_csr({i: [(0, i)] for i in commuters}, n, n)
+        transport_block_indiv = build_individual_workblock_csr(
+            {i: [(0, j) for j in sorted(env_dic[ITI_K][i])] for i in commuters}, n, n)
+    return {
+        IH_K: indiv_house,
+        HI_K: build_house_individual_csr(indiv_house, number_house),
+        IAD_K: indiv_adult,
+        IAG_K: indiv_age,
+        IHR_K: build_individual_rate_array(indiv_age, covid_hospitalization_rate_table),
+        IMR_K: build_individual_rate_array(indiv_age, covid_mortality_rate_table),
+        IW_K: indiv_workplace,
+        WI_K: build_workplace_individual_csr(indiv_workplace, int(indiv_workplace.max()) + 1),
+        HA_K: build_house_adult_csr(indiv_house, indiv_adult, number_house),
+        HS_K: house_store,
+        SH_K: build_store_house_csr(house_store, int(house_store.max()) + 1),
+        IB_K: indiv_transport_block,
+        BI_K: transport_block_indiv,
+    }
+
+
 def get_virus_simulation_t0(number_of_individuals_arg, infection_initialization_rate_arg,
                             contagion_bound_args, hospitalization_args, death_bound_args, immunity_bound_args):
     inn_ind_cov = dict(zip(range(number_of_individuals_arg),
@@ -84,3 +234,29 @@ def get_virus_simulation_t0(number_of_individuals_arg, infection_initialization_
         FN_K: get_infection_params,
         NC_K: 0
     }
+
+
+def get_virus_state_t0(number_of_individuals_arg, infection_initialization_rate_arg,
+                       contagion_bound_args, hospitalization_args, death_bound_args, immunity_bound_args, rng=None,
+                       check_counts=False, n_replicas_arg=1, store_dir_arg=None):
+    # Same draws as get_virus_simulation_t0 but stored as contiguous arrays
+    # With n_replicas_arg > 1, holds the populations of that many batched runs one after the other
+    # With store_dir_arg, the arrays are memory mapped files of that directory, drawn into them chunk by chunk
+    # (same draws whatever the chunks, see BlockRandom)
+    rng = rng if rng is not None else BlockRandom(np.random.default_rng())
+    n = number_of_individuals_arg * n_replicas_arg
+    infection_bounds = (tuple(contagion_bound_args), tuple(hospitalization_args),
+                        tuple(death_bound_args), tuple(immunity_bound_args))
+    periods = [new_store_array(store_dir_arg, name, n, np.int32)
+               for name in ('contagion', 'hospitalization', 'death', 'immunity')]
+    for period, bounds in zip(periods, infection_bounds):
+        for chunk in get_chunk_slices(n):
+            period[chunk] = draw_infection_periods((bounds,), chunk.stop - chunk.start, rng)[0]
+
+    life_state = new_store_array(store_dir_arg, 'state', n, np.int8)
+    for chunk in get_chunk_slices(n):
+        life_state[chunk] = np.where(rng.random(chunk.stop - chunk.start) <= infection_initialization_rate_arg,
+                                     INFECTED_V, HEALTHY_V)
+
+    return VirusState(life_state, *periods, infection_bounds=infection_bounds, rng=rng, check_counts=check_counts,
+                      replica_size=number_of_individuals_arg, store_dir=store_dir_arg)
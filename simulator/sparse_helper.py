@@ -0,0 +1,108 @@
+import numpy as np
+from scipy import sparse
+
+from simulator.kernel_helper import get_exposure_probability, pick_shoppers
+from simulator.keys import *
+
+
+# Sparse engine : each transmission layer is an individual x group incidence matrix M stored with its transpose,
+# the exposures of a day being the two mat-vec products M @ (M.T @ contagious indicator)
+# Same transmission model as the propagation kernels of kernel_helper, one code path for every layer
+
+
+def get_incidence_matrix(individual_group_arg, n_groups_arg):
+    # Individual x group 0/1 matrix of an individual -> group array (-1 for no group)
+    groups = np.asarray(individual_group_arg)
+    is_member = groups >= 0
+    offsets = np.zeros(len(groups) + 1, dtype=np.int64)
+    np.cumsum(is_member, out=offsets[1:])
+    return sparse.csr_matrix((np.ones(offsets[-1], dtype=np.int32), groups[is_member], offsets),
+                             shape=(len(groups), n_groups_arg))
+
+
+def get_csr_incidence_matrix(csr_arg, n_columns_arg):
+    # 0/1 matrix of a row -> members (offsets, indices) pair, sharing its arrays
+    offsets, indices = csr_arg
+    return sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, offsets),
+                             shape=(len(offsets) - 1, n_columns_arg))
+
+
+def get_sparse_environment(env_dic):
+    # Array environment plus the incidence matrices of its layers, individuals x houses, x workplaces,
+    # x stores (through their house) and x transport blocks
+    n = len(env_dic[IH_K])
+    number_house = len(env_dic[HI_K][0]) - 1
+    number_store = len(env_dic[SH_K][0]) - 1
+    individual_store = get_incidence_matrix(env_dic[HS_K][env_dic[IH_K]], number_store)
+    sparse_env_dic = dict(env_dic)
+    sparse_env_dic.update({
+        IHX_K: get_incidence_matrix(env_dic[IH_K], number_house),
+        HIX_K: get_csr_incidence_matrix(env_dic[HI_K], n),
+        IWX_K: get_incidence_matrix(env_dic[IW_K], len(env_dic[WI_K][0]) - 1),
+        WIX_K: get_csr_incidence_matrix(env_dic[WI_K], n),
+        ISX_K: individual_store,
+        SIX_K: individual_store.T.tocsr(),
+        IBX_K: get_csr_incidence_matrix(env_dic[IB_K], len(env_dic[BI_K][0]) - 1),
+        BIX_K: get_csr_incidence_matrix(env_dic[BI_K], n),
+    })
+    return sparse_env_dic
+
+
+def is_sparse_environment(env_dic):
+    return IHX_K in env_dic
+
+
+def get_contagious_indicator(virus_dic):
+    contagious = np.zeros(len(virus_dic), dtype=np.int32)
+    contagious[virus_dic.get_contagious_people()] = 1
+    return contagious
+
+
+def get_exposure_counts(individual_group_arg, group_individual_arg, contagious_arg, infected_groups_only_arg=False):
+    # Number of contagious people each individual meets in its groups,
+    # or number of its groups holding at least one contagious person
+    contagious_per_group = group_individual_arg @ contagious_arg
+    if infected_groups_only_arg:
+        contagious_per_group = (contagious_per_group > 0).astype(np.int32)
+    return individual_group_arg @ contagious_per_group
+
+
+def infect_exposed(virus_dic, exposure_counts_arg, probability_arg):
+    # One draw per exposed individual, infected with probability 1 - (1 - p)^exposures
+    exposed = np.flatnonzero(exposure_counts_arg)
+    virus_dic.exposures += len(exposed)
+    virus_dic.infect(exposed[virus_dic.rng.random(len(exposed)) <
+                             get_exposure_probability(probability_arg, exposure_counts_arg[exposed])])
+
+
+def propagate_to_houses_sparse(env_dic, virus_dic, probability_home_infection_arg):
+    infect_exposed(virus_dic, get_exposure_counts(env_dic[IHX_K], env_dic[HIX_K], get_contagious_indicator(virus_dic)),
+                   probability_home_infection_arg)
+
+
+def propagate_to_workplaces_sparse(env_dic, virus_dic, probability_work_infection_arg):
+    infect_exposed(virus_dic, get_exposure_counts(env_dic[IWX_K], env_dic[WIX_K], get_contagious_indicator(virus_dic)),
+                   probability_work_infection_arg)
+
+
+def propagate_to_transportation_sparse(env_dic, virus_dic, probability_transport_infection_arg,
+                                       transport_exact_arg=False):
+    # Commuters are exposed once per block on their way crossed by a contagious commuter,
+    # or once whatever the number of such blocks with transport_exact_arg
+    exposures = get_exposure_counts(env_dic[IBX_K], env_dic[BIX_K], get_contagious_indicator(virus_dic),
+                                    infected_groups_only_arg=True)
+    if transport_exact_arg:
+        exposures = np.minimum(exposures, 1)
+    infect_exposed(virus_dic, exposures, probability_transport_infection_arg)
+
+
+def propagate_to_stores_sparse(env_dic, virus_dic, probability_store_infection_arg):
+    # One living adult per house goes to its store, shoppers going to a store visited by a contagious shopper
+    # get a single draw
+    if virus_dic.living_adults is None:
+        virus_dic.track_living_adults(env_dic[HA_K], env_dic[IH_K])
+    shoppers = np.zeros(len(virus_dic), dtype=np.int32)
+    shoppers[pick_shoppers(virus_dic, np.flatnonzero(virus_dic.living_adult_counts > 0))] = 1
+    exposures = get_exposure_counts(env_dic[ISX_K], env_dic[SIX_K], get_contagious_indicator(virus_dic) * shoppers,
+                                    infected_groups_only_arg=True)
+    infect_exposed(virus_dic, exposures * shoppers, probability_store_infection_arg)
@@ -0,0 +1,198 @@
+import csv
+import struct
+
+import numpy as np
+
+# Columns of a get_pandemic_statistics row
+STATS_COLUMNS = ('healthy', 'infected', 'hospitalized', 'dead', 'immune', 'new_cases')
+# Rows kept in memory before a file sink writes them
+DEFAULT_BUFFER_ROWS = 4096
+
+# Columnar binary file : magic, number of stats columns, number of days of a complete run, then chunks made of
+# a row count followed by the run column, the day column and each stats column (little endian int32 / int32 / int64)
+BINARY_STATS_MAGIC = b'PANDSTA2'
+BINARY_STATS_HEADER = struct.Struct('<8sII')
+BINARY_STATS_CHUNK_HEADER = struct.Struct('<I')
+# CSV file : a comment line starting with this prefix followed by the number of days of a complete run,
+# then the columns header
+CSV_STATS_NDAY_PREFIX = '# nday='
+
+
+class MemoryStatsSink:
+    # Rows written into a (nrun, nday, 6) array, the former in-memory stats tensor
+
+    def __init__(self, stats_arg):
+        self.stats = stats_arg
+
+    def write(self, run_arg, day_arg, row_arg):
+        self.stats[run_arg, day_arg] = row_arg
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_stats(self):
+        return self.stats
+
+
+class BufferedStatsSink:
+    # Rows are buffered and written by chunks of buffer_rows, and whenever flush is called
+    # (launch_run flushes at the end of every run so that a crash only loses the running ones)
+    # nday_arg, the number of days of a complete run, is written in the header of the file
+
+    def __init__(self, path_arg, nday_arg, buffer_rows_arg=DEFAULT_BUFFER_ROWS):
+        self.path = path_arg
+        self.nday = nday_arg
+        self.buffer_rows = buffer_rows_arg
+        self.runs = []
+        self.days = []
+        self.rows = []
+        self.file = None
+
+    def write(self, run_arg, day_arg, row_arg):
+        self.runs.append(run_arg)
+        self.days.append(day_arg)
+        self.rows.append(row_arg)
+        if len(self.rows) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if self.file is None:
+            self.file = self.open_file()
+        if len(self.rows) > 0:
+            self.write_chunk(np.array(self.runs, dtype=np.int32), np.array(self.days, dtype=np.int32),
+                             np.array(self.rows, dtype=np.int64).reshape(-1, len(STATS_COLUMNS)))
+            self.runs, self.days, self.rows = [], [], []
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None and self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+
+    def get_stats(self):
+        self.close()
+        return read_stats(self.path)
+
+    def open_file(self):
+        raise NotImplementedError
+
+    def write_chunk(self, runs_arg, days_arg, rows_arg):
+        raise NotImplementedError
+
+
+class CsvStatsSink(BufferedStatsSink):
+
+    def open_file(self):
+        f = open(self.path, 'w', newline='')
+        f.write('%s%d\n' % (CSV_STATS_NDAY_PREFIX, self.nday))
+        csv.writer(f).writerow(('run', 'day') + STATS_COLUMNS)
+        return f
+
+    def write_chunk(self, runs_arg, days_arg, rows_arg):
+        csv.writer(self.file).writerows(np.column_stack((runs_arg, days_arg, rows_arg)).tolist())
+
+
+class BinaryStatsSink(BufferedStatsSink):
+
+    def open_file(self):
+        f = open(self.path, 'wb')
+        f.write(BINARY_STATS_HEADER.pack(BINARY_STATS_MAGIC, len(STATS_COLUMNS), self.nday))
+        return f
+
+    def write_chunk(self, runs_arg, days_arg, rows_arg):
+        self.file.write(BINARY_STATS_CHUNK_HEADER.pack(len(runs_arg)))
+        self.file.write(runs_arg.astype('<i4').tobytes())
+        self.file.write(days_arg.astype('<i4').tobytes())
+        self.file.write(np.ascontiguousarray(rows_arg.T).astype('<i8').tobytes())
+
+
+class CallbackStatsSink:
+    # Every row handed to callback_arg(run, day, row) as soon as it is produced
+
+    def __init__(self, callback_arg):
+        self.callback = callback_arg
+
+    def write(self, run_arg, day_arg, row_arg):
+        self.callback(run_arg, day_arg, row_arg)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_stats(self):
+        return None
+
+
+def get_stats_sink(path_arg, nday_arg, buffer_rows_arg=DEFAULT_BUFFER_ROWS):
+    # CSV for .csv files, columnar binary otherwise
+    if path_arg.endswith('.csv'):
+        return CsvStatsSink(path_arg, nday_arg, buffer_rows_arg)
+    return BinaryStatsSink(path_arg, nday_arg, buffer_rows_arg)
+
+
+def read_stats_rows(path_arg):
+    # (nday, runs, days, rows) of a CSV or binary stats file, nday being the number of days of a complete run
+    if path_arg.endswith('.csv'):
+        with open(path_arg, newline='') as f:
+            first_line = f.readline()
+            if not first_line.startswith(CSV_STATS_NDAY_PREFIX):
+                raise ValueError('%s is not a stats file' % path_arg)
+            nday = int(first_line[len(CSV_STATS_NDAY_PREFIX):])
+            lines = f.readlines()[1:]
+        # Like a cut chunk of a binary file, a last line cut by a crash is ignored
+        if len(lines) > 0 and not lines[-1].endswith('\n'):
+            lines.pop()
+        values = []
+        for i, row in enumerate(csv.reader(lines)):
+            try:
+                if len(row) != 2 + len(STATS_COLUMNS):
+                    raise ValueError('row %d of %s has %d columns' % (i, path_arg, len(row)))
+                values.append([int(x) for x in row])
+            except ValueError:
+                if i < len(lines) - 1:
+                    raise
+        values = np.array(values, dtype=np.int64).reshape(-1, 2 + len(STATS_COLUMNS))
+        return nday, values[:, 0], values[:, 1], values[:, 2:]
+    runs, days, rows = [], [], []
+    with open(path_arg, 'rb') as f:
+        magic, n_columns, nday = BINARY_STATS_HEADER.unpack(f.read(BINARY_STATS_HEADER.size))
+        if magic != BINARY_STATS_MAGIC:
+            raise ValueError('%s is not a stats file' % path_arg)
+        while True:
+            chunk_header = f.read(BINARY_STATS_CHUNK_HEADER.size)
+            if len(chunk_header) < BINARY_STATS_CHUNK_HEADER.size:
+                break
+            n = BINARY_STATS_CHUNK_HEADER.unpack(chunk_header)[0]
+            chunk = f.read(n * (8 + 8 * n_columns))
+            if len(chunk) < n * (8 + 8 * n_columns):
+                # Chunk cut by a crash
+                break
+            runs.append(np.frombuffer(chunk, dtype='<i4', count=n))
+            days.append(np.frombuffer(chunk, dtype='<i4', count=n, offset=4 * n))
+            rows.append(np.frombuffer(chunk, dtype='<i8', offset=8 * n).reshape(n_columns, n).T)
+    if len(runs) == 0:
+        return nday, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros((0, len(STATS_COLUMNS)))
+    return nday, np.concatenate(runs), np.concatenate(days), np.concatenate(rows)
+
+
+def read_stats_runs(path_arg):
+    # (run ids, (len(run ids), nday, 6) stats) of the runs of a streamed file which went through every day,
+    # sorted by run id (runs may have been written in any order, and crashed ones are missing)
+    nday, runs, days, rows = read_stats_rows(path_arg)
+    run_ids, run_index = np.unique(runs, return_inverse=True)
+    is_complete = np.bincount(run_index, minlength=len(run_ids)) == nday
+    stats = np.zeros((len(run_ids), nday, len(STATS_COLUMNS)))
+    stats[run_index, days] = rows
+    return run_ids[is_complete], stats[is_complete]
+
+
+def read_stats(path_arg):
+    # (nrun, nday, 6) stats of the complete runs of a streamed file, as returned by launch_run
+    # (their ids are given by read_stats_runs)
+    return read_stats_runs(path_arg)[1]
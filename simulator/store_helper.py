@@ -0,0 +1,154 @@
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from simulator.cache_helper import OFFSETS_SUFFIX, INDICES_SUFFIX, get_environment_cache_key, \
+    get_environment_cache_path, save_environment, evict_environment_cache
+
+# Directory of one array per .npy file, opened as memory maps so that only the pages touched by
+# the propagation steps are read, and shared read only by every process opening them
+STORE_EXTENSION = '.npy'
+# Holds the key (see get_environment_cache_key) of the environment saved in a store
+STORE_KEY_FILE = 'key'
+# Per individual arrays of a VirusState kept in memory mapped files
+VIRUS_STATE_ARRAYS = ('state', 'contagion', 'hospitalization', 'death', 'immunity', 'since')
+# Living adults of each house, stored once the first weekend tracks them (see VirusState.track_living_adults)
+LIVING_ADULT_ARRAYS = ('living_adults', 'living_adult_counts', 'living_adult_positions')
+
+
+def new_store_array(store_dir_arg, name_arg, shape_arg, dtype_arg):
+    # Zeroed array, kept in the memory mapped file name_arg of store_dir_arg when there is one
+    if store_dir_arg is None:
+        return np.zeros(shape_arg, dtype=dtype_arg)
+    os.makedirs(store_dir_arg, exist_ok=True)
+    return open_memmap(os.path.join(store_dir_arg, name_arg + STORE_EXTENSION), mode='w+', dtype=dtype_arg,
+                       shape=shape_arg if isinstance(shape_arg, tuple) else (shape_arg,))
+
+
+def save_store_array(store_dir_arg, name_arg, array_arg):
+    # Memory map of array_arg once saved, so that the in memory copy can be dropped
+    path = os.path.join(store_dir_arg, name_arg + STORE_EXTENSION)
+    np.save(path, array_arg)
+    return np.load(path, mmap_mode='r')
+
+
+def store_environment_array(store_dir_arg, k, v):
+    # Array (or CSR pair) of an environment being built, given back as a memory map of the store
+    # when there is one, and as is otherwise
+    if store_dir_arg is None:
+        return v
+    if isinstance(v, tuple):
+        return (save_store_array(store_dir_arg, k + OFFSETS_SUFFIX, v[0]),
+                save_store_array(store_dir_arg, k + INDICES_SUFFIX, v[1]))
+    return save_store_array(store_dir_arg, k, v)
+
+
+def clear_environment_store(store_dir_arg):
+    # Removes the key then the arrays of the stored environment, so that arrays of an environment
+    # with other keys (replicas, sparse matrices, ...) never come back with the next one
+    os.makedirs(store_dir_arg, exist_ok=True)
+    key_path = os.path.join(store_dir_arg, STORE_KEY_FILE)
+    if os.path.exists(key_path):
+        os.remove(key_path)
+    for name in os.listdir(store_dir_arg):
+        if name.endswith(STORE_EXTENSION):
+            os.remove(os.path.join(store_dir_arg, name))
+
+
+def set_environment_store_key(store_dir_arg, key_arg):
+    # The store is only valid once every array is written
+    with open(os.path.join(store_dir_arg, STORE_KEY_FILE), 'w') as f:
+        f.write(key_arg)
+
+
+def save_environment_store(store_dir_arg, env_dic, key_arg=None):
+    clear_environment_store(store_dir_arg)
+    for k, v in env_dic.items():
+        store_environment_array(store_dir_arg, k, v)
+    if key_arg is not None:
+        set_environment_store_key(store_dir_arg, key_arg)
+
+
+def get_environment_store_key(store_dir_arg):
+    try:
+        with open(os.path.join(store_dir_arg, STORE_KEY_FILE)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def open_environment_store(store_dir_arg, mode_arg='r'):
+    # Environment whose arrays are memory maps of the store files
+    env_dic = {}
+    for name in sorted(os.listdir(store_dir_arg)):
+        if not name.endswith(STORE_EXTENSION):
+            continue
+        k = name[:-len(STORE_EXTENSION)]
+        if k.endswith(OFFSETS_SUFFIX):
+            k = k[:-len(OFFSETS_SUFFIX)]
+            env_dic[k] = (np.load(os.path.join(store_dir_arg, name), mmap_mode=mode_arg),
+                          np.load(os.path.join(store_dir_arg, k + INDICES_SUFFIX + STORE_EXTENSION),
+                                  mmap_mode=mode_arg))
+        elif not k.endswith(INDICES_SUFFIX):
+            env_dic[k] = np.load(os.path.join(store_dir_arg, name), mmap_mode=mode_arg)
+    return env_dic
+
+
+def copy_cached_environment(store_dir_arg, cache_path_arg):
+    # Fills the store from an environment cache file one array at a time, False when it cannot be read
+    if not os.path.exists(cache_path_arg):
+        return False
+    try:
+        with np.load(cache_path_arg) as arrays:
+            for name in arrays.files:
+                np.save(os.path.join(store_dir_arg, name + STORE_EXTENSION), arrays[name])
+        os.utime(cache_path_arg)
+        return True
+    except (OSError, ValueError, KeyError):
+        # Unreadable file (e.g. evicted while copying), built again
+        clear_environment_store(store_dir_arg)
+        return False
+
+
+def get_stored_environment(store_dir_arg, environment_params_arg, seed_arg, build_fn, cache_dir_arg=None,
+                           cache_size_mb_arg=None):
+    # Memory mapped environment, written to the store by build_fn(store_dir_arg) unless the store already holds
+    # the one of these parameters and seed. With cache_dir_arg, the store is copied from the environment cache
+    # when it holds this environment, and the built one is added to the cache otherwise
+    key = get_environment_cache_key(environment_params_arg, seed_arg)
+    if get_environment_store_key(store_dir_arg) != key:
+        clear_environment_store(store_dir_arg)
+        if cache_dir_arg is None:
+            build_fn(store_dir_arg)
+        else:
+            os.makedirs(cache_dir_arg, exist_ok=True)
+            cache_path = get_environment_cache_path(cache_dir_arg, environment_params_arg, seed_arg)
+            if not copy_cached_environment(store_dir_arg, cache_path):
+                build_fn(store_dir_arg)
+                save_environment(cache_path, open_environment_store(store_dir_arg))
+                evict_environment_cache(cache_dir_arg, cache_size_mb_arg * 1024 * 1024)
+        set_environment_store_key(store_dir_arg, key)
+    return open_environment_store(store_dir_arg)
+
+
+def map_virus_state(virus_dic, store_dir_arg):
+    # Moves the arrays of an in memory VirusState to memory mapped files, updated in place
+    # (get_virus_state_t0 draws a new population straight into the files instead)
+    virus_dic.store_dir = store_dir_arg
+    for name in VIRUS_STATE_ARRAYS + LIVING_ADULT_ARRAYS:
+        values = getattr(virus_dic, name)
+        if values is None:
+            continue
+        mapped = new_store_array(store_dir_arg, name, values.shape, values.dtype)
+        mapped[:] = values
+        setattr(virus_dic, name, mapped)
+    return virus_dic
+
+
+def open_virus_state_store(store_dir_arg, mode_arg='r'):
+    # Arrays of a mapped VirusState, e.g. to follow a run from another process
+    # (living adults arrays are only there once tracked)
+    return {name: np.load(os.path.join(store_dir_arg, name + STORE_EXTENSION), mmap_mode=mode_arg)
+            for name in VIRUS_STATE_ARRAYS + LIVING_ADULT_ARRAYS
+            if os.path.exists(os.path.join(store_dir_arg, name + STORE_EXTENSION))}
@@ -0,0 +1,206 @@
+import itertools
+import json
+import multiprocessing
+import os
+import tempfile
+
+import numpy as np
+
+from simulator.parameters import *
+from simulator.cache_helper import get_environment_cache_path, save_environment, load_environment
+from simulator.observer_helper import ProgressObserver
+from simulator.random_helper import get_seed_sequence, get_random_stream
+from simulator.run import get_environment, get_engine_environment, run_simulation, run_batched_simulation
+from simulator.run_helper import get_parser
+from simulator.stats_helper import MemoryStatsSink
+
+# Base parameters, points and environment directory of the sweep, set before the worker processes are forked
+shared_sweep_dic = {}
+# Key (see get_point_environment_key), environment and seed sequence of the last point run by this process
+worker_environment_dic = {}
+# Parameters which only drive how a sweep is computed, left out of the base parameters written with its results
+run_control_keys = (njob_key, env_cache_key, env_cache_size_key, mmap_dir_key, profile_key)
+
+
+def get_grid_points(grid_dic_arg):
+    # Every combination of the values of a {parameter key: [values]} grid, in a stable order
+    keys = sorted(grid_dic_arg.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid_dic_arg[k] for k in keys])]
+
+
+def get_point_environment_key(base_params_arg, point_arg):
+    # Points sharing this key share their environment
+    point_params = dict(base_params_arg, **point_arg)
+    return json.dumps([point_params[k] for k in environment_keys + (seed_key,)])
+
+
+def group_points(base_params_arg, points_arg):
+    # Point ids grouped by environment, in the order of their first point
+    groups = {}
+    for point_id, point in enumerate(points_arg):
+        groups.setdefault(get_point_environment_key(base_params_arg, point), []).append(point_id)
+    return list(groups.values())
+
+
+def get_sweep_base_params(params_arg):
+    # Parameters the results of a sweep depend on, as written in its output file
+    return json.loads(json.dumps({k: v for k, v in params_arg.items() if k not in run_control_keys}))
+
+
+def set_point_params(point_id_arg):
+    params.clear()
+    params.update(shared_sweep_dic['params'])
+    params.update(shared_sweep_dic['points'][point_id_arg])
+
+
+def get_point_environment_path(point_id_arg):
+    # File of the sweep environment directory holding the environment of a point whose parameters are set
+    return get_environment_cache_path(shared_sweep_dic['env_dir'], {k: params[k] for k in environment_keys},
+                                      params[seed_key])
+
+
+def build_group_environment(point_id_arg):
+    # Builds (or reads from the environment cache) the environment of the group of a point once,
+    # and saves it for the workers running the points of the group
+    set_point_params(point_id_arg)
+    save_environment(get_point_environment_path(point_id_arg), get_environment(get_seed_sequence(params[seed_key])))
+    return point_id_arg
+
+
+def get_point_environment(point_id_arg):
+    # (environment, seed sequence) of a point whose parameters are set, loaded from the file saved by
+    # build_group_environment only when the previous point run by this process had another environment
+    key = get_point_environment_key(shared_sweep_dic['params'], shared_sweep_dic['points'][point_id_arg])
+    if worker_environment_dic.get('key') != key:
+        # The previous environment is released before the next one is loaded
+        worker_environment_dic.clear()
+        worker_environment_dic.update({'key': key, 'env': load_environment(get_point_environment_path(point_id_arg)),
+                                       'seed': get_seed_sequence(params[seed_key])})
+    return worker_environment_dic['env'], worker_environment_dic['seed']
+
+
+def read_done_points(output_path_arg, points_arg, base_params_arg):
+    # Ids of the points already in the output file, which must come from the same sweep
+    # (same base parameters, see get_sweep_base_params, and same point parameters)
+    done = set()
+    if not os.path.exists(output_path_arg):
+        return done
+    with open(output_path_arg) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # Line cut by a crash, the point is run again
+                continue
+            if result.get('base') != base_params_arg:
+                raise ValueError('%s holds the results of a sweep with other base parameters' % output_path_arg)
+            if not 0 <= result['point'] < len(points_arg) or \
+                    result['params'] != json.loads(json.dumps(points_arg[result['point']])):
+                raise ValueError('%s holds the results of another sweep' % output_path_arg)
+            done.add(result['point'])
+    return done
+
+
+def run_sweep_point(point_id_arg):
+    # Runs of one point, in a worker process whose params are those of the point, one after the other
+    # or all together in batched mode
+    set_point_params(point_id_arg)
+    stats = np.zeros((params[nrun_key], params[nday_key], 6))
+    env_dic, seed_sequence = get_point_environment(point_id_arg)
+    if params[batch_key]:
+        run_batched_simulation(env_dic, MemoryStatsSink(stats), get_random_stream(seed_sequence, 1))
+    else:
+        engine_env_dic = get_engine_environment(env_dic)
+        for r in range(params[nrun_key]):
+            run_simulation(engine_env_dic, MemoryStatsSink(stats), r, get_random_stream(seed_sequence, r + 1))
+    return point_id_arg, stats.astype(np.int64).tolist()
+
+
+def check_sweep_params(params_arg):
+    if params_arg[mmap_dir_key] is not None:
+        raise ValueError('--mmap-dir cannot be used by a sweep, whose workers would share the same store')
+
+
+def launch_sweep(points_arg, output_path_arg):
+    # Each point gets the results of launch_run with its parameters, written as one JSON line
+    # {"point": id, "params": overrides, "base": base parameters, "stats": (nrun, nday, 6) list} as soon as it is done
+    # Points already in the output file are skipped, so that an interrupted sweep can be resumed
+    # The pool first builds the environment of each group once into a directory next to the output file,
+    # then every pending point goes to the same pool, whose workers load the environments they need
+    check_sweep_params(params)
+    base_params = dict(params)
+    sweep_base_params = get_sweep_base_params(params)
+    done = read_done_points(output_path_arg, points_arg, sweep_base_params)
+    groups = [[point_id for point_id in group if point_id not in done]
+              for group in group_points(base_params, points_arg)]
+    groups = [group for group in groups if len(group) > 0]
+    progress = ProgressObserver(len(points_arg))
+    progress.advance(len(done))
+    env_parent_dir = os.path.dirname(os.path.abspath(output_path_arg))
+    try:
+        with tempfile.TemporaryDirectory(prefix='.sweep-env-', dir=env_parent_dir) as env_dir:
+            shared_sweep_dic.update({'params': base_params, 'points': points_arg, 'env_dir': env_dir})
+            with open(output_path_arg, 'a') as f, multiprocessing.get_context('fork').Pool(params[njob_key]) as pool:
+                for _ in pool.imap_unordered(build_group_environment, [group[0] for group in groups]):
+                    pass
+                for point_id, stats in pool.imap_unordered(run_sweep_point, [i for group in groups for i in group]):
+                    f.write(json.dumps({'point': point_id, 'params': points_arg[point_id], 'base': sweep_base_params,
+                                        'stats': stats}) + '\n')
+                    f.flush()
+                    progress.advance()
+    finally:
+        shared_sweep_dic.clear()
+        params.clear()
+        params.update(base_params)
+
+
+def read_sweep(output_path_arg):
+    # Point id -> (overrides, (nrun, nday, 6) stats array) of a sweep output file
+    results = {}
+    with open(output_path_arg) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            results[result['point']] = (result['params'], np.array(result['stats'], dtype=np.float64))
+    return results
+
+
+def get_sweep_parser():
+    parser = get_parser(plot_arg=False)
+    parser.description = 'Please feed the base model parameters and the swept ones'
+    parser.add_argument('--grid', type=str, action='append', default=[],
+                        help='Swept parameter as KEY=JSON_LIST, e.g. PROB_HOUSE_INFECTION=[0.1,0.3] '
+                             '(repeat for a grid)')
+    parser.add_argument('--points', type=str, help='JSON file holding a list of parameter overrides')
+    parser.add_argument('--output', type=str, required=True, help='JSON lines file receiving the results')
+    return parser
+
+
+if __name__ == '__main__':
+    sweep_parser = get_sweep_parser()
+    args = sweep_parser.parse_args()
+    for arg in vars(args):
+        v = getattr(args, arg)
+        if arg in params and v is not None:
+            params[arg] = v
+    try:
+        check_sweep_params(params)
+    except ValueError as e:
+        sweep_parser.error(str(e))
+
+    grid = {}
+    for grid_arg in args.grid:
+        k, values = grid_arg.split('=', 1)
+        if k not in params:
+            raise ValueError('Unknown parameter %s' % k)
+        grid[k] = json.loads(values)
+    if args.points is not None:
+        with open(args.points) as points_file:
+            sweep_points = json.load(points_file)
+    else:
+        sweep_points = get_grid_points(grid)
+    launch_sweep(sweep_points, args.output)
@@ -0,0 +1,375 @@
+import numpy as np
+from numpy.lib.mixins import NDArrayOperatorsMixin
+
+from initiator.helper import get_infection_parameters
+from simulator.keys import *
+from simulator.random_helper import BlockRandom
+from simulator.store_helper import new_store_array
+
+
+N_STATES = max(HEALTHY_V, INFECTED_V, IMMUNE_V, DEAD_V, HOSPITALIZED_V) + 1
+# States whose members are indexed, daily work only goes through those people
+TRACKED_STATES = (INFECTED_V, HOSPITALIZED_V, IMMUNE_V)
+# States during which the contagion, hospitalization and death periods are running
+SICK_STATES = (INFECTED_V, HOSPITALIZED_V)
+
+# Disease course transitions handled by the calendar queue
+HOSPITAL_EVENT = 0
+DECISION_EVENT = 1
+IMMUNITY_EVENT = 2
+
+# Rows handled at once by the loops going through every individual (or house), bounding their temporaries
+# to a chunk when the arrays are memory mapped
+CHUNK_SIZE = 1 << 20
+
+
+def get_chunk_slices(n, chunk_size=CHUNK_SIZE):
+    return [slice(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+
+
+def draw_infection_periods(infection_bounds, n, rng):
+    # Vectorized get_infection_parameters : one array of n periods per (lower, upper) bound
+    return tuple((lower + (upper - lower) * rng.random(n)).astype(np.int32) for lower, upper in infection_bounds)
+
+
+class CalendarQueue:
+    """
+    Individuals bucketed by the day and kind of their next transition.
+    Each entry remembers the start day of the period it was scheduled for, so that
+    transitions made obsolete by an earlier one (death before hospitalization, ...) are dropped when drained
+    """
+
+    def __init__(self):
+        self.buckets = {}
+
+    def __len__(self):
+        return sum(len(individuals) for bucket in self.buckets.values() for individuals, _ in bucket)
+
+    def push(self, days_arg, event_arg, individuals_arg, since_arg):
+        order = np.argsort(days_arg, kind='stable')
+        days, individuals, since = days_arg[order], individuals_arg[order], since_arg[order]
+        bucket_days, starts = np.unique(days, return_index=True)
+        for day, bucket_individuals, bucket_since in zip(bucket_days.tolist(), np.split(individuals, starts[1:]),
+                                                         np.split(since, starts[1:])):
+            self.buckets.setdefault((day, event_arg), []).append((bucket_individuals, bucket_since))
+
+    def pop(self, day_arg, event_arg):
+        bucket = self.buckets.pop((day_arg, event_arg), [])
+        if len(bucket) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+        return np.concatenate([individuals for individuals, _ in bucket]), \
+            np.concatenate([since for _, since in bucket])
+
+
+class Countdown(NDArrayOperatorsMixin):
+    """
+    Read only view of a period array as decremented every day while the individual is in one of the running states.
+    Lookups only compute the rows they ask for, arithmetic and comparisons go through the whole array.
+    Periods cannot be written through it, they are held as of the start day of the running period (see VirusState)
+    """
+
+    def __init__(self, virus_state, period_arg, running_states_arg):
+        self.virus_state = virus_state
+        self.period = period_arg
+        self.running_states = running_states_arg
+
+    def __len__(self):
+        return len(self.period)
+
+    def __getitem__(self, individuals_arg):
+        period = self.period[individuals_arg]
+        is_running = np.isin(self.virus_state.state[individuals_arg], self.running_states)
+        elapsed = self.virus_state.day - self.virus_state.since[individuals_arg]
+        return (period - np.where(is_running, elapsed, 0)).astype(self.period.dtype)
+
+    def __setitem__(self, individuals_arg, value):
+        raise TypeError('Countdowns are read only, periods are set by the VirusState transitions')
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = tuple(x[:] if isinstance(x, Countdown) else x for x in inputs)
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def tolist(self):
+        return self[:].tolist()
+
+
+class VirusState:
+    """
+    Struct-of-arrays container for the virus state of every individual.
+    It answers the same key lookups as the legacy virus_dic (virus_dic[STA_K][i], virus_dic[NC_K], ...)
+    so that code written against the dictionary layout keeps running on it.
+
+    Periods are not decremented every day. The contagion, hospitalization and death periods hold their value
+    as of since[i], the day individual i got infected, and the immunity period its value as of the day i became
+    immune. Absolute transition days (since + period) are stored in a calendar queue and only processed on
+    the day they fire. virus_dic[CON_K] and the other period lookups return read only countdown views
+
+    With store_dir, the arrays created by the state (start days, living adults) are memory mapped files
+    of that directory, as the given ones should be (see get_virus_state_t0)
+    """
+
+    def __init__(self, state, contagion, hospitalization, death, immunity, infection_bounds=None,
+                 infection_params_fn=None, rng=None, check_counts=False, replica_size=None, store_dir=None):
+        self.store_dir = store_dir
+        self.state = np.asanyarray(state, dtype=np.int8)
+        # Number of individuals per state, updated by every transition (see set_state)
+        self.counts = np.zeros(N_STATES, dtype=np.int64)
+        for chunk in get_chunk_slices(len(self.state)):
+            self.counts += np.bincount(self.state[chunk], minlength=N_STATES)
+        # Batched runs : individual i of replica r is r * replica_size + i, counters are also kept per replica
+        self.replica_size = replica_size if replica_size is not None else len(self.state)
+        self.n_replicas = len(self.state) // self.replica_size if self.replica_size > 0 else 1
+        self.replica_counts = None
+        self.replica_new_cases = None
+        if self.n_replicas > 1:
+            self.replica_counts = self.count_replica_states()
+            self.replica_new_cases = np.zeros(self.n_replicas, dtype=np.int64)
+        # Debug mode : counters are checked against a full recount whenever they are read
+        self.check_counts = check_counts
+        # Sorted members of each tracked state, plus the individuals who entered it since the last read
+        self.members = {v: self.find_members(v) for v in TRACKED_STATES}
+        self.pending_members = {v: [] for v in TRACKED_STATES}
+        self.contagion = np.asanyarray(contagion, dtype=np.int32)
+        self.hospitalization = np.asanyarray(hospitalization, dtype=np.int32)
+        self.death = np.asanyarray(death, dtype=np.int32)
+        self.immunity = np.asanyarray(immunity, dtype=np.int32)
+        # Number of simulated days and start day of the running periods
+        self.day = 0
+        self.since = new_store_array(store_dir, 'since', len(self.state), np.int32)
+        self.events = CalendarQueue()
+        # ((lower, upper) contagion, hospitalization, death, immunity) used to draw new periods
+        self.infection_bounds = infection_bounds
+        self.infection_params_fn = infection_params_fn
+        self.rng = rng if rng is not None else BlockRandom(np.random.default_rng())
+        self.new_cases = 0
+        # Infection draws made by the propagation kernels
+        self.exposures = 0
+        # Living adults of each house, see track_living_adults
+        self.living_adult_offsets = None
+        self.living_adults = None
+        self.living_adult_counts = None
+        self.living_adult_positions = None
+        self.adult_house = None
+        self.schedule_infection(np.concatenate([self.members[INFECTED_V], self.members[HOSPITALIZED_V]]))
+        self.schedule_immunity(self.members[IMMUNE_V])
+
+    def __len__(self):
+        return len(self.state)
+
+    def __contains__(self, key):
+        return key in (CON_K, HOS_K, DEA_K, IMM_K, STA_K, FN_K, NC_K)
+
+    def __getitem__(self, key):
+        if key == STA_K:
+            return self.state
+        if key == CON_K:
+            return Countdown(self, self.contagion, SICK_STATES)
+        if key == HOS_K:
+            return Countdown(self, self.hospitalization, SICK_STATES)
+        if key == DEA_K:
+            return Countdown(self, self.death, SICK_STATES)
+        if key == IMM_K:
+            return Countdown(self, self.immunity, (IMMUNE_V,))
+        if key == FN_K:
+            return self.get_infection_params
+        if key == NC_K:
+            return self.new_cases
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == NC_K:
+            self.new_cases = value
+        else:
+            raise KeyError(key)
+
+    def set_state(self, individuals_arg, state_value_arg):
+        # Every state transition goes through here to keep the counters up to date (individuals must be unique)
+        individuals = np.asarray(individuals_arg, dtype=np.int64)
+        self.counts -= np.bincount(self.state[individuals], minlength=N_STATES)
+        self.counts[state_value_arg] += len(individuals)
+        if self.replica_counts is not None:
+            replicas = individuals // self.replica_size
+            np.subtract.at(self.replica_counts, (replicas, self.state[individuals]), 1)
+            np.add.at(self.replica_counts, (replicas, state_value_arg), 1)
+        self.state[individuals] = state_value_arg
+        if state_value_arg in self.pending_members and len(individuals) > 0:
+            self.pending_members[state_value_arg].append(individuals)
+
+    def get_members(self, state_value_arg):
+        # Individuals in a tracked state, in O(number of members) : people who left the state are dropped lazily
+        members = self.members[state_value_arg]
+        if len(self.pending_members[state_value_arg]) > 0:
+            members = np.unique(np.concatenate([members] + self.pending_members[state_value_arg]))
+            self.pending_members[state_value_arg] = []
+        members = members[self.state[members] == state_value_arg]
+        self.members[state_value_arg] = members
+        return members
+
+    def find_members(self, state_value_arg):
+        # Full scan for the individuals in a state, chunk by chunk
+        return np.concatenate([np.zeros(0, dtype=np.int64)] +
+                              [chunk.start + np.flatnonzero(self.state[chunk] == state_value_arg)
+                               for chunk in get_chunk_slices(len(self.state))])
+
+    def is_contagious(self, individuals_arg):
+        return (self.state[individuals_arg] == INFECTED_V) & \
+            (self.contagion[individuals_arg] < self.day - self.since[individuals_arg])
+
+    def get_contagious_people(self):
+        infected = self.get_members(INFECTED_V)
+        return infected[self.is_contagious(infected)]
+
+    def schedule_infection(self, individuals_arg):
+        # Hospitalization check and death/immunity decision happen the day their countdown reaches 0
+        individuals = np.asarray(individuals_arg, dtype=np.int64)
+        self.since[individuals] = self.day
+        for period, event in [(self.hospitalization, HOSPITAL_EVENT), (self.death, DECISION_EVENT)]:
+            # A countdown already at 0 or below never reaches 0 again
+            scheduled = individuals[period[individuals] >= 1]
+            self.events.push(self.day + period[scheduled] - 1, event, scheduled, self.since[scheduled])
+
+    def end_infection(self, individuals_arg):
+        # Freezes the periods of individuals leaving the sick states during the current day
+        individuals = np.asarray(individuals_arg, dtype=np.int64)
+        elapsed = self.day + 1 - self.since[individuals]
+        self.contagion[individuals] -= elapsed
+        self.hospitalization[individuals] -= elapsed
+        self.death[individuals] -= elapsed
+
+    def schedule_immunity(self, individuals_arg):
+        individuals = np.asarray(individuals_arg, dtype=np.int64)
+        self.since[individuals] = self.day
+        scheduled = individuals[self.immunity[individuals] >= 1]
+        self.events.push(self.day + self.immunity[scheduled] - 1, IMMUNITY_EVENT, scheduled, self.since[scheduled])
+
+    def pop_events(self, event_arg, states_arg):
+        # Individuals whose transition fires today, dropping the ones scheduled for a period which is over
+        individuals, since = self.events.pop(self.day, event_arg)
+        is_valid = (self.since[individuals] == since) & np.isin(self.state[individuals], states_arg)
+        return individuals[is_valid]
+
+    def get_counts(self):
+        if self.check_counts:
+            recount = np.bincount(self.state, minlength=N_STATES)
+            if not (recount == self.counts).all():
+                raise RuntimeError('State counters %s do not match a full recount %s' % (self.counts, recount))
+        return self.counts
+
+    def count_replica_states(self):
+        replicas = np.arange(len(self.state)) // self.replica_size
+        return np.bincount(replicas * N_STATES + self.state,
+                           minlength=self.n_replicas * N_STATES).reshape(self.n_replicas, N_STATES)
+
+    def get_replica_counts(self):
+        # (n_replicas, N_STATES) counters of batched runs
+        if self.replica_counts is None:
+            return self.get_counts().reshape(1, N_STATES)
+        if self.check_counts:
+            recount = self.count_replica_states()
+            if not (recount == self.replica_counts).all():
+                raise RuntimeError('Replica state counters do not match a full recount')
+        return self.replica_counts
+
+    def get_replica_states(self):
+        # (n_replicas, replica_size) view of the states
+        return self.state.reshape(self.n_replicas, self.replica_size)
+
+    def infect(self, individuals_arg):
+        # Vectorized update_infection_period : only healthy individuals get infected
+        individuals = np.unique(np.asarray(individuals_arg, dtype=np.int64))
+        newly_infected = individuals[self.state[individuals] == HEALTHY_V]
+        self.set_state(newly_infected, INFECTED_V)
+        self.schedule_infection(newly_infected)
+        self.new_cases = self.new_cases + len(newly_infected)
+        if self.replica_new_cases is not None:
+            self.replica_new_cases += np.bincount(newly_infected // self.replica_size, minlength=self.n_replicas)
+        return newly_infected
+
+    def kill(self, individuals_arg):
+        individuals = np.asarray(individuals_arg, dtype=np.int64)
+        self.set_state(individuals, DEAD_V)
+        if self.living_adults is not None:
+            for i in individuals[self.living_adult_positions[individuals] >= 0]:
+                self.remove_living_adult(i)
+
+    def track_living_adults(self, house_adult_arg, individual_house_arg):
+        # House -> living adults, as a copy of the house -> adults CSR where the living adults of house h
+        # are the first living_adult_counts[h] members. Deaths swap the adult out of that prefix (see kill)
+        offsets, adults = house_adult_arg
+        number_house = len(offsets) - 1
+        self.living_adult_offsets = offsets
+        self.living_adults = new_store_array(self.store_dir, 'living_adults', len(adults), adults.dtype)
+        self.living_adult_counts = new_store_array(self.store_dir, 'living_adult_counts', number_house, np.int64)
+        self.living_adult_positions = new_store_array(self.store_dir, 'living_adult_positions', len(self.state),
+                                                      np.int64)
+        self.living_adult_positions[:] = -1
+        for chunk in get_chunk_slices(number_house):
+            start, stop = offsets[chunk.start], offsets[chunk.stop]
+            houses = np.repeat(np.arange(chunk.start, chunk.stop), np.diff(offsets[chunk.start:chunk.stop + 1]))
+            is_dead = self.state[adults[start:stop]] == DEAD_V
+            order = np.lexsort((is_dead, houses))
+            living_adults = adults[start:stop][order]
+            positions = np.arange(start, stop)
+            positions[is_dead[order]] = -1
+            self.living_adults[start:stop] = living_adults
+            self.living_adult_counts[chunk] = np.bincount(houses[~is_dead] - chunk.start,
+                                                          minlength=chunk.stop - chunk.start)
+            self.living_adult_positions[living_adults] = positions
+        self.adult_house = individual_house_arg
+
+    def remove_living_adult(self, individual_arg):
+        house = self.adult_house[individual_arg]
+        position = self.living_adult_positions[individual_arg]
+        last_position = self.living_adult_offsets[house] + self.living_adult_counts[house] - 1
+        last_adult = self.living_adults[last_position]
+        self.living_adults[position], self.living_adults[last_position] = last_adult, individual_arg
+        self.living_adult_positions[last_adult] = position
+        self.living_adult_positions[individual_arg] = -1
+        self.living_adult_counts[house] = self.living_adult_counts[house] - 1
+
+    def get_infection_params(self):
+        # Scalar draw, same contract as the FN_K function of the legacy virus_dic
+        if self.infection_params_fn is not None:
+            return self.infection_params_fn()
+        (lc, uc), (lh, uh), (ld, ud), (li, ui) = self.infection_bounds
+        return get_infection_parameters(lc, uc, lh, uh, ld, ud, li, ui)
+
+    def draw_infection_params(self, n):
+        # Vectorized draw of n (contagion, hospitalization, death, immunity) periods
+        if self.infection_bounds is None:
+            draws = np.array([self.get_infection_params() for _ in range(n)], dtype=np.int32).reshape(n, 4)
+            return draws[:, 0], draws[:, 1], draws[:, 2], draws[:, 3]
+        return draw_infection_periods(self.infection_bounds, n, self.rng)
+
+    def to_dict(self):
+        # Export the legacy dictionary view
+        return {
+            CON_K: dict(enumerate(self[CON_K].tolist())),
+            HOS_K: dict(enumerate(self[HOS_K].tolist())),
+            DEA_K: dict(enumerate(self[DEA_K].tolist())),
+            IMM_K: dict(enumerate(self[IMM_K].tolist())),
+            STA_K: dict(enumerate(self.state.tolist())),
+            FN_K: self.get_infection_params,
+            NC_K: self.new_cases
+        }
+
+    @classmethod
+    def from_dict(cls, virus_dic, infection_bounds=None, rng=None, check_counts=False):
+        n = len(virus_dic[STA_K])
+
+        def to_array(key):
+            if key not in virus_dic:
+                return np.zeros(n, dtype=np.int32)
+            return np.array([virus_dic[key][i] for i in range(n)])
+
+        virus_state = cls(to_array(STA_K), to_array(CON_K), to_array(HOS_K), to_array(DEA_K), to_array(IMM_K),
+                          infection_bounds=infection_bounds, infection_params_fn=virus_dic.get(FN_K), rng=rng,
+                          check_counts=check_counts)
+        virus_state.new_cases = virus_dic.get(NC_K, 0)
+        return virus_state
@@ -1,8 +1,12 @@
 import random
 import unittest
 
+import numpy as np
+
 from initiator.helper import invert_map, flatten, get_random_choice_list, get_infection_parameters, \
-    get_mortalty_rate, get_hospitalization_rate, rec_get_manhattan_walk, invert_map_list
+    get_mortalty_rate, get_hospitalization_rate, rec_get_manhattan_walk, invert_map_list, invert_array, invert_csr, \
+    get_csr_members, map_to_array, get_rates, covid_mortality_rate_table, covid_hospitalization_rate_table, \
+    get_age_table, get_redraw_cumsum, pick_age, pick_ages, get_manhattan_walk, get_manhattan_walk_csr, replicate_array, replicate_csr
 
 
 class TestHelpers(unittest.TestCase):
@@ -26,6 +30,34 @@ class TestHelpers(unittest.TestCase):
         self.assertEqual(result[(2, 1)], [0, 1, 2])
         self.assertEqual(result[(1, 3)], [2])
 
+    def test_invert_array(self):
+        offsets, indices = invert_array(np.array([1, 1, 2, -1, 0, 2]), 4)
+        self.assertEqual(offsets.tolist(), [0, 1, 3, 5, 5])
+        self.assertEqual(indices.tolist(), [4, 0, 1, 2, 5])
+
+    def test_invert_csr(self):
+        # {0: [1, 2], 1: [], 2: [2, 0]}
+        offsets, indices = invert_csr((np.array([0, 2, 2, 4]), np.array([1, 2, 2, 0])), 3)
+        self.assertEqual(offsets.tolist(), [0, 1, 2, 4])
+        self.assertEqual(indices.tolist(), [2, 0, 0, 2])
+
+    def test_get_csr_members(self):
+        csr = (np.array([0, 2, 2, 5]), np.array([7, 8, 4, 5, 6]))
+        self.assertEqual(get_csr_members(csr, [2, 0, 1, 2]).tolist(), [4, 5, 6, 7, 8, 4, 5, 6])
+        self.assertEqual(get_csr_members(csr, []).tolist(), [])
+
+    def test_replicate_array(self):
+        self.assertEqual(replicate_array([1, -1, 0], 3, 2).tolist(), [1, -1, 0, 3, -1, 2, 5, -1, 4])
+
+    def test_replicate_csr(self):
+        offsets, indices = replicate_csr((np.array([0, 2, 2, 3]), np.array([1, 0, 4])), 2, 5)
+        self.assertEqual(offsets.tolist(), [0, 2, 2, 3, 5, 5, 6])
+        self.assertEqual(indices.tolist(), [1, 0, 4, 6, 5, 9])
+        self.assertEqual(get_csr_members((offsets, indices), [3, 2]).tolist(), [6, 5, 4])
+
+    def test_map_to_array(self):
+        self.assertEqual(map_to_array({1: 1, 4: 1, 5: 0}, 6).tolist(), [-1, 1, -1, -1, 1, 0])
+
     def test_flatten(self):
         input_list = [[1, 2], [0], [1, 3]]
         result = flatten(input_list)
@@ -53,6 +85,36 @@ class TestHelpers(unittest.TestCase):
         self.assertEqual(get_hospitalization_rate(44), 0.025)
         self.assertEqual(get_hospitalization_rate(19), 0.01)
 
+    def test_get_rates(self):
+        ages = np.arange(126)
+        self.assertEqual(get_rates(ages, covid_mortality_rate_table).tolist(),
+                         [get_mortalty_rate(age) for age in ages])
+        self.assertEqual(get_rates(ages, covid_hospitalization_rate_table).tolist(),
+                         [get_hospitalization_rate(age) for age in ages])
+
+    def test_get_age_table(self):
+        cumsum, min_age, max_age = get_age_table([["0-4", 1, 1], ["5-9", 1, 1], ["10-14", 1, 0]])
+        self.assertEqual(cumsum.tolist(), [0.4, 0.8, 1.0])
+        self.assertEqual(min_age.tolist(), [0, 5, 10])
+        self.assertEqual(max_age.tolist(), [4, 9, 14])
+
+    def test_get_redraw_cumsum(self):
+        # 0.4, then 0.8 of the remaining 0.6, then the rest
+        np.testing.assert_allclose(get_redraw_cumsum(np.array([0.4, 0.8, 1.0])), [0.4, 0.88, 1.0])
+
+    def test_pick_ages(self):
+        is_child = np.array([True, False] * 50000)
+        result = pick_ages(is_child, np.random.default_rng(12))
+        # 0-4 is around 15.5% of the children (under 35), 20-24 around 11.6% of the adults
+        self.assertAlmostEqual(np.mean(result[is_child] < 5), 0.155, delta=0.01)
+        self.assertAlmostEqual(np.mean(result[~is_child] < 25), 0.116, delta=0.01)
+        # Same distribution as pick_age, whose mean adult age is around 33.5 years
+        children = np.array([pick_age(True) for _ in range(50000)])
+        adults = np.array([pick_age(False) for _ in range(50000)])
+        self.assertAlmostEqual(result[is_child].mean(), children.mean(), delta=0.3)
+        self.assertAlmostEqual(result[~is_child].mean(), adults.mean(), delta=0.3)
+        self.assertAlmostEqual(np.mean(result[~is_child] < 45), np.mean(adults < 45), delta=0.01)
+
     def test_rec_get_manhattan_walk(self):
         result = rec_get_manhattan_walk([], (1, 1), (3, 3))
         self.assertEqual(result, [(1, 1), (3, 3), (1, 2), (3, 3), (1, 3), (3, 3), (3, 3), (2, 3), (3, 3)])
@@ -61,6 +123,21 @@ class TestHelpers(unittest.TestCase):
         result = rec_get_manhattan_walk([], (1, 1), (1, 1))
         self.assertEqual(result, [(1, 1)])
 
+    def test_get_manhattan_walk(self):
+        self.assertEqual(get_manhattan_walk((3, 3), (1, 1)), [(1, 1), (1, 2), (1, 3), (2, 3), (3, 3)])
+        self.assertEqual(get_manhattan_walk((1, 2), (3, 2)), [(1, 2), (2, 2), (3, 2)])
+        self.assertEqual(get_manhattan_walk((1, 1), (1, 1)), [(1, 1)])
+        self.assertEqual(set(get_manhattan_walk((4, 1), (1, 3))), set(rec_get_manhattan_walk([], (4, 1), (1, 3))))
+
+    def test_get_manhattan_walk_csr(self):
+        p1 = [(3, 3), (1, 2), (1, 1), (4, 1)]
+        p2 = [(1, 1), (3, 2), (1, 1), (1, 3)]
+        offsets, indices = get_manhattan_walk_csr(p1, p2, 10)
+        self.assertEqual(offsets.tolist(), [0, 5, 8, 9, 15])
+        for k in range(len(p1)):
+            self.assertEqual(indices[offsets[k]:offsets[k + 1]].tolist(),
+                             [x * 10 + y for x, y in get_manhattan_walk(p1[k], p2[k])])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -5,8 +5,10 @@ import numpy
 
 from initiator.core import build_individual_houses_map, build_individual_adult_map, build_individual_age_map, \
     build_house_adult_map, build_house_store_map, build_individual_work_map, build_individual_workblock_map, \
-    build_individual_individual_transport_map
+    build_individual_individual_transport_map, build_individual_houses_array, build_individual_adult_array, \
+    build_individual_age_array, build_individual_work_array, build_individual_workblock_routes_csr
 from initiator.helper import invert_map, invert_map_list
+from initiator.parameters import GE_MAX_EMPLOYEES
 
 
 class TestInitiation(unittest.TestCase):
@@ -61,6 +63,37 @@ class TestInitiation(unittest.TestCase):
             9: 20
         })
 
+    def test_build_individual_houses_array(self):
+        rng = numpy.random.default_rng(12)
+        result = build_individual_houses_array(100000, 0.5, rng)
+        self.assertEqual(len(result), 100000)
+        self.assertTrue(numpy.all(numpy.diff(result) >= 0))
+        # A house gets a second person when its draw is above 0.5, and never a third one
+        house_sizes = numpy.bincount(result)
+        self.assertEqual(house_sizes.max(), 2)
+        self.assertAlmostEqual(numpy.mean(house_sizes[:-1] == 2), 0.5, delta=0.01)
+        self.assertEqual(build_individual_houses_array(5, 0.95, rng).tolist(), [0, 1, 2, 3, 4])
+
+    def test_build_individual_adult_array(self):
+        result = build_individual_adult_array(numpy.array([0, 0, 0, 0, 1, 1, 1, 2, 2, 3]))
+        self.assertEqual(result.tolist(), [1, 1, 0, 0, 1, 1, 0, 1, 1, 1])
+
+    def test_build_individual_age_array(self):
+        individual_adult = numpy.array([1, 0] * 5000)
+        result = build_individual_age_array(individual_adult, numpy.random.default_rng(12))
+        # Adults are picked from 20 years old and children under 35
+        self.assertGreaterEqual(result[individual_adult == 1].min(), 20)
+        self.assertLess(result[individual_adult == 0].max(), 35)
+
+    def test_build_individual_work_array(self):
+        individual_adult = numpy.array([1, 1, 0, 0] * 10000)
+        result = build_individual_work_array(individual_adult, 0.5, numpy.random.default_rng(12))
+        self.assertTrue(numpy.all(result[individual_adult == 0] == -1))
+        self.assertAlmostEqual(numpy.mean(result[individual_adult == 1] >= 0), 0.5, delta=0.02)
+        # Every company is filled but the last one
+        self.assertLess(numpy.bincount(result[result >= 0]).max(), GE_MAX_EMPLOYEES)
+        self.assertEqual(numpy.bincount(result[result >= 0]).min(), 1)
+
     def test_build_house_adult_map(self):
         input_individual_houses_map = {
             0: 0, 1: 0, 2: 0, 3: 0,
@@ -99,13 +132,22 @@ class TestInitiation(unittest.TestCase):
             [(2, 3), (7, 8)], [(3, 1), (9, 5)]
         )
         expected = {
-            0: [(3, 2), (3, 1), (2, 3), (3, 3)],
-            1: [(5, 5), (4, 5), (7, 5), (2, 3), (9, 5), (2, 5), (8, 5), (2, 4), (6, 5), (3, 5)],
-            2: [(7, 8), (3, 2), (3, 3), (6, 8), (4, 8), (3, 1), (3, 8), (3, 6), (3, 7), (3, 4), (5, 8), (3, 5)],
-            3: [(9, 8), (8, 8), (9, 6), (9, 5), (7, 8), (9, 7)]
+            0: [(3, 1), (3, 2), (3, 3), (2, 3)],
+            1: [(2, 3), (2, 4), (2, 5), (3, 5), (4, 5), (5, 5), (6, 5), (7, 5), (8, 5), (9, 5)],
+            2: [(3, 1), (3, 2), (3, 3), (3, 4), (3, 5), (3, 6), (3, 7), (3, 8), (4, 8), (5, 8), (6, 8), (7, 8)],
+            3: [(9, 5), (9, 6), (9, 7), (9, 8), (8, 8), (7, 8)]
         }
         self.assertEqual(result, expected)
 
+    def test_build_individual_workblock_routes_csr(self):
+        offsets, indices = build_individual_workblock_routes_csr(
+            numpy.array([0, 0, 1, 1, 1]), numpy.array([0, 1, 0, -1, 1]),
+            numpy.array([(2, 3), (7, 8)]), numpy.array([(3, 1), (9, 5)]), 10
+        )
+        self.assertEqual(offsets.tolist(), [0, 4, 14, 26, 26, 32])
+        self.assertEqual(indices[:4].tolist(), [31, 32, 33, 23])
+        self.assertEqual(indices[26:].tolist(), [95, 96, 97, 98, 88, 78])
+
     def test_build_individual_individual_transport_map(self):
         ind_workblock = {
             0: [(1, 1), (1, 2), (1, 3), (2, 3)],
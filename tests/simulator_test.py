@@ -1,11 +1,37 @@
+import copy
+import os
 import random
+import tempfile
+import time
 import unittest
 
+import numpy as np
+
 from initiator.helper import get_infection_parameters
 from simulator.dynamic_helper import update_infection_period, increment_pandemic_1_day, \
-    propagate_to_houses, propagate_to_stores, propagate_to_workplaces, propagate_to_transportation
+    propagate_to_houses, propagate_to_stores, propagate_to_workplaces, propagate_to_transportation, \
+    get_pandemic_statistics, get_replica_statistics
 from simulator.keys import *
-from simulator.simulation_helper import get_environment_simulation, get_virus_simulation_t0
+from initiator.core import build_individual_workblock_csr, build_workblock_individual_csr
+from initiator.helper import get_csr_members
+from simulator.simulation_helper import get_environment_simulation, get_virus_simulation_t0, get_virus_state_t0, \
+    get_environment_simulation_arrays, to_array_environment, get_replicated_environment
+from simulator.virus_state import VirusState
+from simulator.sparse_helper import get_sparse_environment
+from simulator.cache_helper import get_cached_environment, evict_environment_cache
+from simulator.stats_helper import get_stats_sink, read_stats, read_stats_runs, read_stats_rows, \
+    CallbackStatsSink
+from simulator.store_helper import get_stored_environment, map_virus_state, open_virus_state_store, \
+    save_environment_store
+from simulator.random_helper import BlockRandom, get_seed_sequence, get_random_stream
+from simulator import run
+from simulator import sweep
+from benchmarks import run_benchmarks
+from simulator.parameters import params, nrun_key, njob_key, nday_key, nindividual_key, seed_key, house_infect_key, \
+    profile_key, batch_key, mmap_dir_key, engine_key, sparse_engine
+from simulator.profile_helper import Profiler
+from simulator.observer_helper import RunObserver, ObserverGroup, ProgressObserver
+from simulator.plot_helper import use_headless_backend, draw_summary, draw_population_state_daily, MAX_BAR_DAYS
 
 H = HEALTHY_V
 F = INFECTED_V
@@ -61,6 +87,36 @@ class TestSimulation(unittest.TestCase):
         expected_result = TestSimulation.get_10_01_2_environment_dic()
         self.assertEqual(result, expected_result)
 
+    def test_build_environment_arrays(self):
+        result = get_environment_simulation_arrays(1000, 0.1, 2, 0.5, 5, 0.5)
+        house_sizes = np.diff(result[HI_K][0])
+        self.assertEqual(house_sizes.sum(), 1000)
+        self.assertTrue((house_sizes > 0).all())
+        self.assertTrue((result[IH_K][result[HI_K][1]] == np.repeat(np.arange(len(house_sizes)), house_sizes)).all())
+        self.assertTrue((result[IAD_K][result[HA_K][1]] == 1).all())
+        self.assertEqual(len(result[WI_K][1]), np.sum(result[IW_K] >= 0))
+        self.assertEqual(len(result[SH_K][1]), len(house_sizes))
+        # Only workers use public transport
+        commuters = np.flatnonzero(np.diff(result[IB_K][0]) > 0)
+        self.assertTrue((result[IW_K][commuters] >= 0).all())
+        # Block -> individuals is the exact inverse of individual -> blocks
+        individual_blocks = set(zip(np.repeat(np.arange(1000), np.diff(result[IB_K][0])).tolist(),
+                                    result[IB_K][1].tolist()))
+        block_individuals = set(zip(result[BI_K][1].tolist(),
+                                    np.repeat(np.arange(25), np.diff(result[BI_K][0])).tolist()))
+        self.assertEqual(individual_blocks, block_individuals)
+
+    def test_to_array_environment(self):
+        result = to_array_environment(TestSimulation.get_10_01_2_environment_dic())
+        self.assertEqual(result[IH_K].tolist(), [0, 0, 0, 0, 1, 1, 1, 1, 2, 2])
+        self.assertEqual(get_csr_members(result[HI_K], [1]).tolist(), [4, 5, 6, 7])
+        self.assertEqual(get_csr_members(result[HA_K], [2]).tolist(), [8, 9])
+        self.assertEqual(result[IW_K].tolist(), [-1, 1, -1, -1, 1, 0, -1, -1, -1, -1])
+        self.assertEqual(get_csr_members(result[WI_K], [1]).tolist(), [1, 4])
+        self.assertEqual(get_csr_members(result[SH_K], [0]).tolist(), [0, 1, 2])
+        blocks = get_csr_members(result[IB_K], [4])
+        self.assertEqual(get_csr_members(result[BI_K], blocks).tolist(), [1, 4, 5])
+
     def test_build_virus_dic(self):
         result = get_virus_simulation_t0(10, 0.1, (2, 7), (7, 21), (21, 39), (35, 65))
         expected_result = TestSimulation.get_virus_dic()
@@ -367,6 +423,676 @@ class TestSimulation(unittest.TestCase):
         self.assertEqual(virus_dic[STA_K][4], H)
         self.assertEqual(virus_dic[STA_K][5], F)
 
+    def test_build_virus_state(self):
+        result = get_virus_state_t0(1000, 0.1, (2, 7), (7, 21), (21, 39), (35, 65), rng=np.random.default_rng(12))
+        self.assertEqual(len(result), 1000)
+        self.assertTrue(((result[CON_K] >= 2) & (result[CON_K] < 7)).all())
+        self.assertTrue(((result[IMM_K] >= 35) & (result[IMM_K] < 65)).all())
+        self.assertEqual(set(np.unique(result[STA_K])), {H, F})
+        self.assertTrue(50 < np.sum(result[STA_K] == F) < 150)
+        self.assertEqual(result[NC_K], 0)
+
+    def test_virus_state_dict_view(self):
+        virus_dic = TestSimulation.get_virus_dic()
+        result = VirusState.from_dict(virus_dic).to_dict()
+        for key in [CON_K, HOS_K, DEA_K, IMM_K, STA_K, NC_K]:
+            self.assertEqual(result[key], virus_dic[key])
+
+    def test_update_infection_period_virus_state(self):
+        virus_dic = VirusState.from_dict(TestSimulation.get_10_01_virus_dic())
+        update_infection_period([1, 4, 9], virus_dic)
+        self.assertEqual(virus_dic[STA_K].tolist(), [H, F, H, H, F, H, H, H, H, F])
+        self.assertEqual(virus_dic[NC_K], 2)
+
+    def test_increment_pandemic_1_day_virus_state(self):
+        env_dic = TestSimulation.get_10_01_2_environment_dic()
+        virus_dic = VirusState.from_dict({
+            CON_K: {0: 4,  1: -2, 2: -5, 3: -4, 4:  6, 5: -9, 6: -3, 7:  2, 8: -9, 9:  5},
+            HOS_K: {0: 12, 1: 12, 2: 20, 3:  1, 4: 16, 5: 12, 6: 14, 7: 13, 8: -7, 9: 8},
+            DEA_K: {0: 31, 1:  1, 2:  0, 3: 22, 4: 22, 5:  0, 6:  1, 7: 22, 8: -4, 9: 38},
+            IMM_K: {0: 53, 1: 47, 2: 52, 3: 51, 4: 58, 5: 58, 6: 44, 7: 53, 8:  1, 9: 55},
+            STA_K: {0:  H, 1:  F, 2:  D, 3:  F, 4:  F, 5:  M, 6:  F, 7:  F, 8:  M, 9:  H},
+        }, infection_bounds=((2, 7), (7, 21), (21, 39), (30, 60)), rng=np.random.default_rng(22))
+        increment_pandemic_1_day(env_dic, virus_dic)
+        result = virus_dic.to_dict()
+        # Healthy and dead people are left untouched
+        self.assertEqual((result[CON_K][0], result[HOS_K][0], result[DEA_K][0], result[STA_K][0]), (4, 12, 31, H))
+        self.assertEqual((result[CON_K][2], result[HOS_K][2], result[DEA_K][2], result[STA_K][2]), (-5, 20, 0, D))
+        # Infected people periods are decremented
+        self.assertEqual((result[CON_K][3], result[HOS_K][3], result[DEA_K][3]), (-5, 0, 21))
+        self.assertEqual((result[CON_K][7], result[HOS_K][7], result[DEA_K][7], result[STA_K][7]), (1, 12, 21, F))
+        # Children do not die
+        self.assertEqual((result[DEA_K][6], result[STA_K][6]), (0, M))
+        self.assertIn(result[STA_K][1], [M, D])
+        # Immunity is lost and parameters have been reset
+        self.assertEqual(result[IMM_K][5], 57)
+        self.assertEqual(result[STA_K][8], H)
+        self.assertTrue(2 <= result[CON_K][8] < 7)
+        self.assertTrue(30 <= result[IMM_K][8] < 60)
+
+    def test_increment_pandemic_1_day_array(self):
+        env_dic = to_array_environment(TestSimulation.get_10_01_2_environment_dic())
+        env_dic[IAG_K][3] = 82
+        env_dic[IHR_K][3] = 1
+        virus_dic = VirusState.from_dict({
+            CON_K: {0: 4,  1: -2, 2: -5, 3: -4, 4:  6, 5: -9, 6: -3, 7:  2, 8: -9, 9:  5},
+            HOS_K: {0: 12, 1: 12, 2: 20, 3:  1, 4: 16, 5: 12, 6: 14, 7: 13, 8: -7, 9: 8},
+            DEA_K: {0: 31, 1:  1, 2:  0, 3: 22, 4: 22, 5:  0, 6:  1, 7: 22, 8: -4, 9: 38},
+            IMM_K: {0: 53, 1: 47, 2: 52, 3: 51, 4: 58, 5: 58, 6: 44, 7: 53, 8:  1, 9: 55},
+            STA_K: {0:  H, 1:  F, 2:  D, 3:  F, 4:  F, 5:  M, 6:  F, 7:  F, 8:  M, 9:  H},
+        }, infection_bounds=((2, 7), (7, 21), (21, 39), (30, 60)), rng=np.random.default_rng(22))
+        increment_pandemic_1_day(env_dic, virus_dic)
+        self.assertEqual(virus_dic[STA_K].tolist(), [H, M, D, P, F, M, M, F, H, H])
+        self.assertEqual(virus_dic[HOS_K].tolist()[:8], [12, 11, 20, 0, 15, 12, 13, 12])
+        self.assertEqual(virus_dic[IMM_K].tolist()[:8], [53, 46, 52, 51, 58, 57, 43, 53])
+
+    def test_get_pandemic_statistics_counters(self):
+        env_dic = get_environment_simulation_arrays(500, 0.1, 5, 0.7, 5, 0.5)
+        virus_dic = get_virus_state_t0(500, 0.05, (2, 7), (7, 21), (10, 20), (5, 10), rng=np.random.default_rng(12),
+                                       check_counts=True)
+        for day in range(60):
+            propagate_to_houses(env_dic, virus_dic, 0.5)
+            propagate_to_transportation(env_dic, virus_dic, 0.1)
+            propagate_to_workplaces(env_dic, virus_dic, 0.1)
+            propagate_to_stores(env_dic, virus_dic, 0.1)
+            increment_pandemic_1_day(env_dic, virus_dic)
+            stats = get_pandemic_statistics(virus_dic)
+            self.assertEqual(sum(stats[:5]), 500)
+            for state_value in [F, P, M]:
+                self.assertEqual(virus_dic.get_members(state_value).tolist(),
+                                 np.flatnonzero(virus_dic[STA_K] == state_value).tolist())
+        # Counters which are out of sync are reported in debug mode
+        virus_dic[STA_K][0] = (virus_dic[STA_K][0] + 1) % 5
+        self.assertRaises(RuntimeError, get_pandemic_statistics, virus_dic)
+
+    def test_increment_pandemic_calendar_queue(self):
+        env_dic = to_array_environment(TestSimulation.get_10_01_2_environment_dic())
+        env_dic[IHR_K][:] = 0
+        env_dic[IMR_K][:] = 0
+        virus_dic = VirusState.from_dict({
+            CON_K: {0: 1, 1: 1, 2: 2, 3: 2, 4: 2, 5: 2, 6: 2, 7: 2, 8: 2, 9: 2},
+            HOS_K: {0: 3, 1: 3, 2: 9, 3: 9, 4: 9, 5: 9, 6: 9, 7: 9, 8: 9, 9: 9},
+            DEA_K: {0: 4, 1: 4, 2: 9, 3: 9, 4: 9, 5: 9, 6: 9, 7: 9, 8: 9, 9: 9},
+            IMM_K: {0: 2, 1: 2, 2: 9, 3: 9, 4: 9, 5: 9, 6: 9, 7: 9, 8: 9, 9: 9},
+            STA_K: {0: F, 1: H, 2: H, 3: H, 4: H, 5: H, 6: H, 7: H, 8: H, 9: H},
+        }, infection_bounds=((5, 6), (5, 6), (5, 6), (5, 6)), rng=np.random.default_rng(12))
+        contagious, states = [], []
+        for day in range(6):
+            if day == 1:
+                update_infection_period([1], virus_dic)
+            contagious.append(virus_dic.get_contagious_people().tolist())
+            increment_pandemic_1_day(env_dic, virus_dic)
+            states.append(virus_dic[STA_K][:2].tolist())
+            if day == 3:
+                self.assertEqual([virus_dic[key][0] for key in [CON_K, HOS_K, DEA_K, IMM_K]], [-3, -1, 0, 1])
+                self.assertEqual([virus_dic[key][1] for key in [CON_K, HOS_K, DEA_K, IMM_K]], [-2, 0, 1, 2])
+        self.assertEqual(contagious, [[], [], [0], [0, 1], [1], []])
+        self.assertEqual(states, [[F, H], [F, F], [F, F], [M, F], [H, M], [H, H]])
+        # Immunity was lost, periods have been drawn again
+        self.assertEqual([virus_dic[key][0] for key in [CON_K, HOS_K, DEA_K, IMM_K]], [5, 5, 5, 5])
+        self.assertEqual(len(virus_dic.events), 0)
+
+    def test_propagate_to_houses_virus_state(self):
+        env_dic = TestSimulation.get_10_01_2_environment_dic()
+        virus_dic = VirusState.from_dict({
+            CON_K: {0: -9, 1:  3, 2:  2, 3:  2, 4: -9, 5:  4, 6:  4, 7:  2, 8:  6, 9:  5},
+            STA_K: {0:  F, 1:  H, 2:  H, 3:  H, 4:  D, 5:  H, 6:  H, 7:  H, 8:  M, 9:  H},
+        })
+        propagate_to_houses(env_dic, virus_dic, 0.99)
+        self.assertEqual(virus_dic[STA_K].tolist(), [F, F, F, F, D, H, H, H, M, H])
+        self.assertEqual(get_pandemic_statistics(virus_dic), (4, 4, 0, 1, 1, 3))
+
+    def test_propagate_to_houses_array(self):
+        env_dic = to_array_environment(TestSimulation.get_10_01_2_environment_dic())
+        virus_dic = VirusState.from_dict({
+            CON_K: {0: -9, 1:  3, 2:  2, 3:  2, 4: -9, 5:  4, 6:  4, 7:  2, 8:  6, 9:  5},
+            STA_K: {0:  F, 1:  H, 2:  H, 3:  H, 4:  D, 5:  H, 6:  H, 7:  H, 8:  M, 9:  H},
+        }, rng=np.random.default_rng(12))
+        propagate_to_houses(env_dic, virus_dic, 1)
+        # Dead and immune people do not contaminate
+        self.assertEqual(virus_dic[STA_K].tolist(), [F, F, F, F, D, H, H, H, M, H])
+        self.assertEqual(virus_dic[NC_K], 3)
+
+    def test_propagate_to_houses_array_equivalence(self):
+        # Two contagious people in house 0 : each housemate is exposed twice
+        env_dic = TestSimulation.get_10_01_2_environment_dic()
+        virus_dic = {
+            CON_K: {0: -9, 1: -9, 2:  2, 3:  2, 4: -9, 5:  4, 6:  4, 7:  2, 8:  6, 9:  5},
+            STA_K: {0:  F, 1:  F, 2:  H, 3:  H, 4:  D, 5:  H, 6:  H, 7:  H, 8:  M, 9:  H},
+            NC_K: 0
+        }
+        array_env_dic = to_array_environment(env_dic)
+        rng = np.random.default_rng(12)
+        n_trials = 4000
+        dict_cases, array_cases = 0, 0
+        for _ in range(n_trials):
+            dict_virus_dic = {STA_K: dict(virus_dic[STA_K]), CON_K: virus_dic[CON_K], NC_K: 0}
+            propagate_to_houses(env_dic, dict_virus_dic, 0.3)
+            dict_cases = dict_cases + dict_virus_dic[NC_K]
+            array_virus_dic = VirusState.from_dict(virus_dic, rng=rng)
+            propagate_to_houses(array_env_dic, array_virus_dic, 0.3)
+            array_cases = array_cases + array_virus_dic[NC_K]
+        # 2 housemates infected with probability 1 - 0.7 ** 2
+        self.assertAlmostEqual(dict_cases / n_trials, 1.02, delta=0.05)
+        self.assertAlmostEqual(array_cases / n_trials, 1.02, delta=0.05)
+
+    def test_propagate_to_workplaces_array(self):
+        env_dic = to_array_environment(TestSimulation.get_10_01_2_environment_dic())
+        virus_dic = VirusState.from_dict({
+            CON_K: {0: -2, 1: -2, 2: -2, 3: -2, 4: -5, 5: 4, 6: -2, 7: 2, 8: 6, 9: 5},
+            STA_K: {0:  F, 1:  H, 2:  F, 3:  F, 4:  F, 5:  H, 6:  F, 7: H, 8: H, 9: H},
+        }, rng=np.random.default_rng(12))
+        propagate_to_workplaces(env_dic, virus_dic, 1)
+        # Only 4 goes to work and is contagious, contaminating workplace 1
+        self.assertEqual(virus_dic[STA_K].tolist(), [F, F, F, F, F, H, F, H, H, H])
+        self.assertEqual(virus_dic[NC_K], 1)
+
+    def test_propagate_to_workplaces_array_equivalence(self):
+        # Two contagious workers in workplace 1 : 5 is exposed twice
+        env_dic = TestSimulation.get_10_01_2_environment_dic()
+        env_dic[IW_K] = {1: 1, 4: 1, 5: 1}
+        env_dic[WI_K] = {1: [1, 4, 5]}
+        virus_dic = {
+            CON_K: {0: -2, 1: -2, 2: -2, 3: -2, 4: -5, 5: 4, 6: -2, 7: 2, 8: 6, 9: 5},
+            STA_K: {0:  H, 1:  F, 2:  H, 3:  H, 4:  F, 5:  H, 6:  H, 7: H, 8: H, 9: H},
+        }
+        array_env_dic = to_array_environment(env_dic)
+        rng = np.random.default_rng(12)
+        n_trials = 4000
+        dict_cases, array_cases = 0, 0
+        for _ in range(n_trials):
+            dict_virus_dic = {STA_K: dict(virus_dic[STA_K]), CON_K: virus_dic[CON_K], NC_K: 0}
+            propagate_to_workplaces(env_dic, dict_virus_dic, 0.3)
+            dict_cases = dict_cases + dict_virus_dic[NC_K]
+            array_virus_dic = VirusState.from_dict(virus_dic, rng=rng)
+            propagate_to_workplaces(array_env_dic, array_virus_dic, 0.3)
+            array_cases = array_cases + array_virus_dic[NC_K]
+        self.assertAlmostEqual(dict_cases / n_trials, 0.51, delta=0.04)
+        self.assertAlmostEqual(array_cases / n_trials, 0.51, delta=0.04)
+
+    @staticmethod
+    def get_transport_virus_dic():
+        return {
+            CON_K: {0: -2, 1: -2, 2: -2, 3: -2, 4: 1, 5: 4, 6: -2, 7: 2, 8: 6, 9: 5},
+            STA_K: {0: F, 1: H, 2: F, 3: F, 4: H, 5: H, 6: F, 7: H, 8: H, 9: H},
+        }
+
+    def test_propagate_to_transportation_array_exact(self):
+        env_dic = TestSimulation.get_10_01_2_environment_dic()
+        env_dic[IW_K] = {0: 1, 1: 1, 4: 1, 5: 0}
+        env_dic[ITI_K] = {0: {0, 5}, 4: {4}, 5: {0, 5}}
+        virus_dic = VirusState.from_dict(TestSimulation.get_transport_virus_dic(), rng=np.random.default_rng(12))
+        propagate_to_transportation(to_array_environment(env_dic), virus_dic, 1, transport_exact_arg=True)
+        self.assertEqual(virus_dic[STA_K][4], H)
+        self.assertEqual(virus_dic[STA_K][5], F)
+
+    def test_propagate_to_transportation_array_blocks(self):
+        # 0 and 2 are contagious commuters, 0 shares 2 blocks with 5, 2 shares 1 block with 4
+        env_dic = to_array_environment(TestSimulation.get_10_01_2_environment_dic())
+        env_dic[IB_K] = build_individual_workblock_csr({0: [(0, 0), (0, 1)], 2: [(1, 1)], 4: [(1, 1), (1, 2)],
+                                                        5: [(0, 0), (0, 1), (1, 2)]}, 10, 3)
+        env_dic[BI_K] = build_workblock_individual_csr(env_dic[IB_K], 3)
+        rng = np.random.default_rng(12)
+        n_trials = 4000
+        for transport_exact, expected in [(False, [0.3, 0.51]), (True, [0.3, 0.3])]:
+            cases = np.zeros(10)
+            for _ in range(n_trials):
+                virus_dic = VirusState.from_dict(TestSimulation.get_transport_virus_dic(), rng=rng)
+                propagate_to_transportation(env_dic, virus_dic, 0.3, transport_exact)
+                cases = cases + (virus_dic[STA_K] == F)
+            self.assertAlmostEqual(cases[4] / n_trials, expected[0], delta=0.04)
+            self.assertAlmostEqual(cases[5] / n_trials, expected[1], delta=0.04)
+            self.assertEqual(cases[1], 0)
+
+    @staticmethod
+    def get_store_environment_dic():
+        env_dic = TestSimulation.get_10_01_2_environment_dic()
+        env_dic[HS_K] = {0: 0, 1: 1, 2: 0}
+        env_dic[SH_K] = {0: [0, 2], 1: [1]}
+        return to_array_environment(env_dic)
+
+    def test_propagate_to_stores_array_adult_contagious(self):
+        env_dic = TestSimulation.get_store_environment_dic()
+        rng = np.random.default_rng(12)
+        cases = np.zeros(10)
+        for _ in range(1000):
+            virus_dic = VirusState.from_dict({
+                CON_K: {0: 4,  1: -2, 2:  2, 3:  2, 4: -5, 5:  4, 6:  4, 7:  2, 8:  6, 9:  5},
+                STA_K: {0:  H, 1:  F, 2:  H, 3:  H, 4:  H, 5:  H, 6:  H, 7:  H, 8:  H, 9:  H},
+            }, rng=rng)
+            propagate_to_stores(env_dic, virus_dic, 1)
+            cases = cases + (virus_dic[STA_K] == F)
+        # 1 goes to store 0 half of the time, where one adult of house 2 is shopping
+        self.assertEqual(cases[[2, 3, 4, 5, 6, 7]].tolist(), [0] * 6)
+        self.assertAlmostEqual(cases[8] / 1000, 0.25, delta=0.04)
+        self.assertAlmostEqual(cases[9] / 1000, 0.25, delta=0.04)
+        self.assertEqual(cases[0], 0)
+
+    def test_propagate_to_stores_array_living_adults(self):
+        env_dic = TestSimulation.get_store_environment_dic()
+        virus_dic = VirusState.from_dict({
+            CON_K: {0: 4, 1: -2, 2: 2, 3: 2, 4: -5, 5: 4, 6: 4, 7: 2, 8: 6, 9: 5},
+            STA_K: {0: D, 1: F, 2: H, 3: H, 4: H, 5: H, 6: H, 7: H, 8: H, 9: H},
+        }, rng=np.random.default_rng(12))
+        propagate_to_stores(env_dic, virus_dic, 1)
+        # 1 is the only living adult of house 0, 8 and 9 share the same store
+        self.assertEqual(virus_dic.living_adult_counts.tolist(), [1, 2, 2])
+        self.assertEqual(np.sum(virus_dic[STA_K][[8, 9]] == F), 1)
+        virus_dic.kill([8, 4])
+        self.assertEqual(virus_dic.living_adult_counts.tolist(), [1, 1, 1])
+        self.assertEqual(get_csr_members((virus_dic.living_adult_offsets, virus_dic.living_adults), [1, 2]).tolist(),
+                         [5, 4, 9, 8])
+        for _ in range(10):
+            propagate_to_stores(env_dic, virus_dic, 1)
+        self.assertEqual(virus_dic[STA_K][9], F)
+
+    def test_block_random(self):
+        rng = BlockRandom(np.random.default_rng(12), block_size=4)
+        draws = np.concatenate([rng.random(n) for n in [2, 3, 0, 9, 1]] + [[rng.random()]])
+        self.assertEqual(draws.tolist(), np.random.default_rng(12).random(16).tolist())
+
+    def test_get_random_stream(self):
+        seed_sequence = get_seed_sequence(12)
+        children = seed_sequence.spawn(3)
+        self.assertEqual(get_random_stream(seed_sequence, 2).random(5).tolist(),
+                         np.random.default_rng(children[2]).random(5).tolist())
+        self.assertNotEqual(get_random_stream(seed_sequence, 1).random(5).tolist(),
+                            get_random_stream(seed_sequence, 2).random(5).tolist())
+
+    def test_launch_run_seed(self):
+        default_params = dict(params)
+        try:
+            params.update({nindividual_key: 500, nday_key: 20, nrun_key: 2, seed_key: 12})
+            stats = run.launch_run()
+            self.assertEqual(stats.tolist(), run.launch_run().tolist())
+            params[njob_key] = 2
+            self.assertEqual(stats.tolist(), run.launch_run().tolist())
+        finally:
+            params.update(default_params)
+
+    def test_get_cached_environment(self):
+        built = []
+
+        def build_environment():
+            built.append(1)
+            return get_environment_simulation_arrays(300, 0.1, 5, 0.7, 5, 0.5, rng=np.random.default_rng(12))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            env_dic = get_cached_environment(cache_dir, 10, {'n': 300}, 12, build_environment)
+            cached_env_dic = get_cached_environment(cache_dir, 10, {'n': 300}, 12, build_environment)
+            self.assertEqual(len(built), 1)
+            self.assertEqual(set(cached_env_dic.keys()), set(env_dic.keys()))
+            self.assertEqual(cached_env_dic[IAG_K].tolist(), env_dic[IAG_K].tolist())
+            self.assertEqual(cached_env_dic[IAG_K].dtype, env_dic[IAG_K].dtype)
+            self.assertEqual(cached_env_dic[BI_K][0].tolist(), env_dic[BI_K][0].tolist())
+            self.assertEqual(cached_env_dic[BI_K][1].tolist(), env_dic[BI_K][1].tolist())
+            get_cached_environment(cache_dir, 10, {'n': 300}, 13, build_environment)
+            self.assertEqual(len(built), 2)
+
+    def test_evict_environment_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for k, name in enumerate(['a.npz', 'b.npz', 'c.npz']):
+                with open(os.path.join(cache_dir, name), 'wb') as f:
+                    f.write(b'0' * 100)
+                os.utime(os.path.join(cache_dir, name), (time.time() + k, time.time() + k))
+            # a is the least recently used until it is touched
+            os.utime(os.path.join(cache_dir, 'a.npz'), (time.time() + 10, time.time() + 10))
+            evict_environment_cache(cache_dir, 250)
+            self.assertEqual(sorted(os.listdir(cache_dir)), ['a.npz', 'c.npz'])
+
+    def test_stored_environment(self):
+        def build_environment(store_dir_arg=None):
+            return get_environment_simulation_arrays(500, 0.1, 5, 0.7, 5, 0.5, rng=np.random.default_rng(12),
+                                                     store_dir_arg=store_dir_arg)
+
+        env_dic = build_environment()
+        with tempfile.TemporaryDirectory() as store_dir:
+            # Arrays of another environment never come back with the next one
+            save_environment_store(os.path.join(store_dir, 'env'), dict(env_dic, other=np.arange(3)), 'other')
+            stored_env_dic = get_stored_environment(os.path.join(store_dir, 'env'), {'n': 500}, 12, build_environment)
+            self.assertEqual(set(stored_env_dic.keys()), set(env_dic.keys()))
+            self.assertIsInstance(stored_env_dic[IH_K], np.memmap)
+            self.assertIsInstance(stored_env_dic[SH_K][1], np.memmap)
+            self.assertEqual(stored_env_dic[BI_K][1].tolist(), env_dic[BI_K][1].tolist())
+            self.assertEqual(get_stored_environment(os.path.join(store_dir, 'env'), {'n': 500}, 12, None)[SH_K][1]
+                             .tolist(), env_dic[SH_K][1].tolist())
+            # Copied from the environment cache once it holds the environment
+            cache_dir = os.path.join(store_dir, 'cache')
+            get_stored_environment(os.path.join(store_dir, 'cached'), {'n': 500}, 12, build_environment, cache_dir, 10)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            cached_env_dic = get_stored_environment(os.path.join(store_dir, 'copied'), {'n': 500}, 12, None, cache_dir,
+                                                    10)
+            self.assertEqual(cached_env_dic[SH_K][1].tolist(), env_dic[SH_K][1].tolist())
+            virus_dic = get_virus_state_t0(500, 0.05, (2, 7), (14, 20), (21, 39), (600, 900),
+                                           rng=np.random.default_rng(12), store_dir_arg=os.path.join(store_dir, 'run'))
+            in_memory_virus_dic = get_virus_state_t0(500, 0.05, (2, 7), (14, 20), (21, 39), (600, 900),
+                                                     rng=np.random.default_rng(12))
+            mapped_virus_dic = map_virus_state(get_virus_state_t0(500, 0.05, (2, 7), (14, 20), (21, 39), (600, 900),
+                                                                  rng=np.random.default_rng(12)),
+                                               os.path.join(store_dir, 'mapped'))
+            self.assertIsInstance(virus_dic.state, np.memmap)
+            self.assertIsInstance(virus_dic.since, np.memmap)
+            for _ in range(30):
+                for v in [virus_dic, in_memory_virus_dic, mapped_virus_dic]:
+                    propagate_to_houses(stored_env_dic, v, 0.5)
+                    propagate_to_stores(stored_env_dic, v, 0.2)
+                    increment_pandemic_1_day(stored_env_dic, v)
+            self.assertIsInstance(virus_dic.living_adult_positions, np.memmap)
+            self.assertEqual(virus_dic[CON_K].tolist(), in_memory_virus_dic[CON_K].tolist())
+            stats = get_pandemic_statistics(in_memory_virus_dic)
+            self.assertEqual(get_pandemic_statistics(virus_dic), stats)
+            self.assertEqual(get_pandemic_statistics(mapped_virus_dic), stats)
+            # Another process can read the run states without copying them
+            run_store = open_virus_state_store(os.path.join(store_dir, 'run'))
+            self.assertEqual(run_store['state'].tolist(), in_memory_virus_dic[STA_K].tolist())
+            self.assertEqual(run_store['living_adult_counts'].tolist(),
+                             in_memory_virus_dic.living_adult_counts.tolist())
+
+    def test_launch_run_store(self):
+        default_params = dict(params)
+        try:
+            params.update({nindividual_key: 500, nday_key: 20, nrun_key: 2, seed_key: 12})
+            stats = run.launch_run()
+            with tempfile.TemporaryDirectory() as store_dir:
+                params[mmap_dir_key] = store_dir
+                self.assertEqual(run.launch_run().tolist(), stats.tolist())
+                # The second launch reads the stored environment back
+                self.assertEqual(run.launch_run().tolist(), stats.tolist())
+                for k, v in [(batch_key, True), (engine_key, sparse_engine)]:
+                    params[k] = v
+                    with self.assertRaises(ValueError):
+                        run.launch_run(observers_arg=[])
+                    params[k] = default_params[k]
+        finally:
+            params.clear()
+            params.update(default_params)
+
+    def test_countdown_view(self):
+        virus_dic = TestSimulation.get_virus_dic()
+        virus_state = VirusState.from_dict(virus_dic)
+        virus_state.day = 2
+        countdown = virus_state[CON_K]
+        self.assertEqual(len(countdown), len(virus_dic[STA_K]))
+        # Rows are computed on demand, the running periods being decremented every day
+        for i in range(len(countdown)):
+            self.assertEqual(countdown[i], virus_dic[CON_K][i] - (2 if virus_dic[STA_K][i] in [F, P] else 0))
+        self.assertEqual(countdown[[0, 1]].tolist(), [countdown[0], countdown[1]])
+        self.assertEqual((countdown + 1).tolist(), [c + 1 for c in countdown.tolist()])
+        with self.assertRaises(TypeError):
+            countdown[0] = 3
+
+    def test_stats_sinks(self):
+        stats = np.arange(3 * 4 * 6).reshape(3, 4, 6)
+        with tempfile.TemporaryDirectory() as stats_dir:
+            for name in ['stats.csv', 'stats.bin']:
+                stats_sink = get_stats_sink(os.path.join(stats_dir, name), 4, 5)
+                for r in range(3):
+                    for i in range(4):
+                        stats_sink.write(r, i, stats[r, i].tolist())
+                    stats_sink.flush()
+                # The last run is not over
+                stats_sink.write(3, 0, stats[0, 0].tolist())
+                self.assertEqual(stats_sink.get_stats().tolist(), stats.tolist())
+            # A chunk cut while being written is ignored
+            with open(os.path.join(stats_dir, 'stats.bin'), 'ab') as f:
+                f.write(b'\x05\x00\x00\x00\x01')
+            self.assertEqual(read_stats(os.path.join(stats_dir, 'stats.bin')).tolist(), stats.tolist())
+            # So is a CSV line cut while being written, with or without all its columns
+            for cut_line in ['3,1,12,13', '3,1,12,13,14,15,16,1']:
+                with open(os.path.join(stats_dir, 'stats.csv')) as f:
+                    lines = f.readlines()
+                with open(os.path.join(stats_dir, 'cut.csv'), 'w', newline='') as f:
+                    f.writelines(lines[:-1] + [cut_line])
+                nday, runs, days, rows = read_stats_rows(os.path.join(stats_dir, 'cut.csv'))
+                self.assertEqual(len(runs), len(lines) - 3)
+                self.assertEqual(read_stats(os.path.join(stats_dir, 'cut.csv')).tolist(), stats.tolist())
+            # A malformed row before the last one is an error
+            with open(os.path.join(stats_dir, 'cut.csv'), 'w', newline='') as f:
+                f.writelines(lines[:3] + ['3,1,12\r\n'] + lines[3:])
+            with self.assertRaises(ValueError):
+                read_stats(os.path.join(stats_dir, 'cut.csv'))
+            for name in ['runs.csv', 'runs.bin']:
+                # Runs written out of order, run 1 crashed on day 2 and run 4 did not start
+                stats_sink = get_stats_sink(os.path.join(stats_dir, name), 4, 5)
+                for r, nday in [(2, 4), (1, 2), (0, 4)]:
+                    for i in range(nday):
+                        stats_sink.write(r, i, stats[r, i].tolist())
+                stats_sink.close()
+                run_ids, run_stats = read_stats_runs(os.path.join(stats_dir, name))
+                self.assertEqual(run_ids.tolist(), [0, 2])
+                self.assertEqual(run_stats.tolist(), stats[[0, 2]].tolist())
+                # Runs which all crashed on the same day are not complete
+                stats_sink = get_stats_sink(os.path.join(stats_dir, name), 4, 5)
+                for r in range(3):
+                    for i in range(2):
+                        stats_sink.write(r, i, stats[r, i].tolist())
+                self.assertEqual(stats_sink.get_stats().shape, (0, 4, 6))
+        rows = []
+        CallbackStatsSink(lambda r, i, row: rows.append((r, i, row))).write(1, 2, (3, 4, 5, 6, 7, 8))
+        self.assertEqual(rows, [(1, 2, (3, 4, 5, 6, 7, 8))])
+
+    def test_get_grid_points(self):
+        points = sweep.get_grid_points({'B': [1, 2], 'A': [(2, 7), (3, 8)]})
+        self.assertEqual(points, [{'A': (2, 7), 'B': 1}, {'A': (2, 7), 'B': 2},
+                                  {'A': (3, 8), 'B': 1}, {'A': (3, 8), 'B': 2}])
+        groups = sweep.group_points(params, [{nindividual_key: 10}, {house_infect_key: 0.2}, {nindividual_key: 10}])
+        self.assertEqual(groups, [[0, 2], [1]])
+
+    def test_launch_sweep(self):
+        default_params = dict(params)
+        try:
+            params.update({nindividual_key: 500, nday_key: 15, nrun_key: 2, seed_key: 12, njob_key: 2})
+            points = sweep.get_grid_points({house_infect_key: [0.2, 0.4], nindividual_key: [400, 500]})
+            with tempfile.TemporaryDirectory() as sweep_dir:
+                output_path = os.path.join(sweep_dir, 'sweep.jsonl')
+                builds_path = os.path.join(sweep_dir, 'builds')
+
+                def get_counted_environment(seed_sequence_arg):
+                    with open(builds_path, 'a') as builds_file:
+                        builds_file.write('%d\n' % params[nindividual_key])
+                    return original_get_environment(seed_sequence_arg)
+
+                original_get_environment = sweep.get_environment
+                sweep.get_environment = get_counted_environment
+                try:
+                    sweep.launch_sweep(points[:3], output_path)
+                    sweep.launch_sweep(points, output_path)
+                finally:
+                    sweep.get_environment = original_get_environment
+                # Each environment is built once per launch, whatever the number of workers
+                with open(builds_path) as f:
+                    self.assertEqual(sorted(f.read().split()), ['400', '500', '500'])
+                # The environments saved for the workers are removed
+                self.assertEqual(sorted(os.listdir(sweep_dir)), ['builds', 'sweep.jsonl'])
+                results = sweep.read_sweep(output_path)
+                with open(output_path) as f:
+                    self.assertEqual(len(f.readlines()), 4)
+                # The output of a sweep with other base parameters is not resumed
+                params[nday_key] = 16
+                with self.assertRaises(ValueError):
+                    sweep.launch_sweep(points, output_path)
+                params[nday_key] = 15
+            self.assertEqual(params[house_infect_key], default_params[house_infect_key])
+            # A point gives the same results as a launch with its parameters
+            params.update(points[1])
+            self.assertEqual(results[1][1].tolist(), run.launch_run().tolist())
+            params.clear()
+            params.update(default_params)
+            params.update({nindividual_key: 500, nday_key: 15, nrun_key: 3, seed_key: 12, njob_key: 2,
+                           batch_key: True})
+            with tempfile.TemporaryDirectory() as sweep_dir:
+                output_path = os.path.join(sweep_dir, 'sweep.jsonl')
+                sweep.launch_sweep(points, output_path)
+                results = sweep.read_sweep(output_path)
+                # The output of a larger sweep is not resumed
+                with self.assertRaises(ValueError):
+                    sweep.launch_sweep(points[:2], output_path)
+            # Batched points give the results of a batched launch
+            params.update(points[3])
+            self.assertEqual(results[3][1].tolist(), run.launch_run().tolist())
+        finally:
+            params.clear()
+            params.update(default_params)
+
+    def test_batched_replicas(self):
+        env_dic = get_environment_simulation_arrays(300, 0.1, 5, 0.7, 5, 0.5, rng=np.random.default_rng(12))
+        replicated_env_dic = get_replicated_environment(env_dic, 3)
+        self.assertEqual(replicated_env_dic[IH_K][300:600].tolist(),
+                         (env_dic[IH_K] + len(env_dic[HI_K][0]) - 1).tolist())
+        virus_dic = get_virus_state_t0(300, 0.05, (2, 7), (14, 20), (21, 39), (600, 900),
+                                       rng=np.random.default_rng(12), check_counts=True, n_replicas_arg=3)
+        # Only the last replica starts with infected people
+        virus_dic.set_state(np.flatnonzero(virus_dic.state[:600] == F), H)
+        for i in range(60):
+            propagate_to_houses(replicated_env_dic, virus_dic, 0.5)
+            propagate_to_transportation(replicated_env_dic, virus_dic, 0.2)
+            propagate_to_workplaces(replicated_env_dic, virus_dic, 0.2)
+            propagate_to_stores(replicated_env_dic, virus_dic, 0.2)
+            increment_pandemic_1_day(replicated_env_dic, virus_dic)
+            stats = get_replica_statistics(virus_dic)
+            self.assertEqual(stats.sum(axis=0)[:5].tolist(), virus_dic.get_counts()[[H, F, P, D, M]].tolist())
+        self.assertEqual(stats[:2, 0].tolist(), [300, 300])
+        self.assertLess(stats[2, 0], 300)
+        self.assertEqual(virus_dic.get_replica_states().shape, (3, 300))
+
+    def test_profiler(self):
+        default_params = dict(params)
+        try:
+            params.update({nrun_key: 2, nday_key: 30, nindividual_key: 2000, seed_key: 4})
+            stats = run.launch_run()
+            with tempfile.TemporaryDirectory() as profile_dir:
+                params[profile_key] = os.path.join(profile_dir, 'profile.csv')
+                # Profiling does not change the results
+                self.assertEqual(run.launch_run().tolist(), stats.tolist())
+                profile = np.genfromtxt(params[profile_key], delimiter=',', names=True, dtype=None, encoding=None)
+            self.assertEqual(set(profile['phase']), {'environment', 'env_individuals', 'env_groups', 'env_geography',
+                                                     'env_stores', 'env_transport', 'population', 'houses',
+                                                     'transport', 'work', 'stores', 'progression', 'stats'})
+            self.assertEqual(len(profile[profile['phase'] == 'houses']), 2 * 30)
+            self.assertEqual(profile['new_infections'].sum(), stats[:, :, 5].sum())
+            self.assertTrue((profile['exposures'] <= profile['draws']).all())
+            params.update({njob_key: 2, profile_key: None})
+            profiler = Profiler()
+            run.launch_run(profiler_arg=profiler)
+            summary = profiler.get_summary()
+            self.assertEqual(summary['houses']['calls'], 2 * 30)
+            self.assertEqual(summary['work']['new_infections'],
+                             profile['new_infections'][profile['phase'] == 'work'].sum())
+        finally:
+            params.clear()
+            params.update(default_params)
+
+    def test_sparse_engine(self):
+        env_dic = get_environment_simulation_arrays(400, 0.1, 5, 0.7, 5, 0.5, rng=np.random.default_rng(12))
+        sparse_env_dic = get_sparse_environment(env_dic)
+        for individual_group_key, group_individual_key in ((IHX_K, HIX_K), (IWX_K, WIX_K), (ISX_K, SIX_K),
+                                                           (IBX_K, BIX_K)):
+            self.assertEqual((sparse_env_dic[individual_group_key].T != sparse_env_dic[group_individual_key]).nnz, 0)
+        self.assertEqual(sparse_env_dic[ISX_K].indices.tolist(), env_dic[HS_K][env_dic[IH_K]].tolist())
+        virus_dic = get_virus_state_t0(400, 0.1, (2, 7), (14, 20), (21, 39), (600, 900),
+                                       rng=np.random.default_rng(12))
+        # Everyone infected at day 0 is contagious
+        virus_dic.day = 10
+        rng = np.random.default_rng(12)
+        n_trials = 200
+        for propagate, args in ((propagate_to_houses, (0.3,)), (propagate_to_workplaces, (0.2,)),
+                                (propagate_to_transportation, (0.05,)), (propagate_to_transportation, (0.05, True)),
+                                (propagate_to_stores, (0.3,))):
+            cases = []
+            for engine_env_dic in (env_dic, sparse_env_dic):
+                engine_cases = 0
+                for _ in range(n_trials):
+                    trial_virus_dic = copy.deepcopy(virus_dic)
+                    trial_virus_dic.rng = rng
+                    propagate(engine_env_dic, trial_virus_dic, *args)
+                    engine_cases = engine_cases + trial_virus_dic[NC_K]
+                cases.append(engine_cases / n_trials)
+            self.assertGreater(cases[0], 1)
+            self.assertAlmostEqual(cases[1] / cases[0], 1, delta=0.1)
+
+    def test_observers(self):
+        class RecordingObserver(RunObserver):
+            def __init__(self):
+                self.events = []
+
+            def on_run_start(self, run_arg):
+                self.events.append(('start', run_arg))
+
+            def on_day_end(self, run_arg, day_arg, row_arg):
+                self.events.append(('day', run_arg, day_arg, tuple(row_arg)))
+
+            def on_run_end(self, run_arg):
+                self.events.append(('end', run_arg))
+
+        default_params = dict(params)
+        try:
+            params.update({nrun_key: 3, nday_key: 20, nindividual_key: 500, seed_key: 5})
+            observer = RecordingObserver()
+            stats = run.launch_run(observers_arg=[observer])
+            self.assertEqual(observer.events[0], ('start', 0))
+            self.assertEqual(observer.events[-1], ('end', 2))
+            self.assertEqual([e[3] for e in observer.events if e[0] == 'day'],
+                             [tuple(row) for row in stats.reshape(-1, 6).astype(np.int64).tolist()])
+            # Parallel runs are reported as they complete
+            params[njob_key] = 2
+            parallel_observer = RecordingObserver()
+            run.launch_run(observers_arg=[parallel_observer])
+            self.assertEqual(sorted(parallel_observer.events, key=str), sorted(observer.events, key=str))
+            # but their starts as soon as a worker starts them, the first two runs being started together
+            params.update({nday_key: 60, nindividual_key: 2000})
+            parallel_observer = RecordingObserver()
+            run.launch_run(observers_arg=[parallel_observer])
+            self.assertEqual(sorted(parallel_observer.events[:2]), [('start', 0), ('start', 1)])
+            for r in range(3):
+                run_events = [e[0] for e in parallel_observer.events if e[1] == r]
+                self.assertEqual(run_events, ['start'] + ['day'] * 60 + ['end'])
+            params.update({nday_key: 20, nindividual_key: 500})
+            # Batched runs one day of every run at a time
+            params.update({njob_key: 1, batch_key: True})
+            batch_observer = RecordingObserver()
+            run.launch_run(observers_arg=[batch_observer])
+            self.assertEqual(batch_observer.events[:3], [('start', 0), ('start', 1), ('start', 2)])
+            self.assertEqual([e[1:3] for e in batch_observer.events[3:9]],
+                             [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (2, 1)])
+            self.assertEqual(len(batch_observer.events), 3 + 3 * 20 + 3)
+        finally:
+            params.clear()
+            params.update(default_params)
+        # Observers not overriding a hook are not called for it
+        group = ObserverGroup([observer, ProgressObserver(10)])
+        self.assertEqual(len(group.run_start_observers), 1)
+        self.assertEqual(len(group.day_end_observers), 2)
+
+    def test_draw_to_file(self):
+        use_headless_backend()
+        stats = np.random.default_rng(12).integers(0, 100, size=(3, MAX_BAR_DAYS + 100, 6))
+        with tempfile.TemporaryDirectory() as plot_dir:
+            # Bars for short horizons, areas and lines for long ones
+            for n_day in (7, stats.shape[1]):
+                draw_summary(stats[:, :n_day], output=os.path.join(plot_dir, 'summary_%d.png' % n_day))
+                with open(os.path.join(plot_dir, 'summary_%d.png' % n_day), 'rb') as f:
+                    self.assertEqual(f.read(8), b'\x89PNG\r\n\x1a\n')
+            draw_population_state_daily(stats[:1], output=os.path.join(plot_dir, 'population.svg'))
+            with open(os.path.join(plot_dir, 'population.svg')) as f:
+                self.assertIn('<svg', f.read())
+
+    def test_run_benchmarks(self):
+        default_params = dict(params)
+        results = run_benchmarks.run_benchmarks([300], max_dict_size_arg=300, repeat_arg=1, nday_arg=5,
+                                                filter_arg='^(build_individual_houses|propagate_to_houses|launch_run)')
+        self.assertEqual(params, default_params)
+        self.assertEqual([(r['name'], r['engine']) for r in results],
+                         [('build_individual_houses_array', 'array'), ('propagate_to_houses', 'array'),
+                          ('propagate_to_houses', 'sparse'), ('build_individual_houses_map', 'dict'),
+                          ('propagate_to_houses', 'dict'), ('launch_run', 'array')])
+        self.assertEqual(results[-1]['unit'], 'person-days/s')
+        self.assertAlmostEqual(results[-1]['throughput'], 300 * 5 / results[-1]['seconds'])
+        slower = [dict(r, seconds=2 * r['seconds']) for r in results]
+        comparisons = run_benchmarks.compare_results(results, slower + [dict(results[0], size=1)])
+        self.assertEqual(len(comparisons), 6)
+        self.assertTrue(all(c[3] for c in comparisons))
+        self.assertFalse(any(c[3] for c in run_benchmarks.compare_results(slower, results)))
+
 
 if __name__ == '__main__':
     unittest.main()